@@ -0,0 +1,167 @@
+import math
+import threading
+import time
+from flask import request, session, g, jsonify
+from cache import LRUCache
+
+
+#Admission control, run before any other work on a request
+#Requests fall into three classes by endpoint: cheap reads, writes, and the bcrypt heavy auth routes.
+#The averages below only count requests from the last ADMISSION_LATENCY_WINDOW seconds.
+#  - Every user (the session's user id, or the client address before login) has a token bucket of
+#    ADMISSION_USER_BURST requests refilled at ADMISSION_USER_RATE per second; an empty bucket is
+#    answered with 429 RATE_LIMITED. Behind a proxy the client address is the one ProxyFix takes from
+#    X-Forwarded-For (see PROXY_COUNT in app.py).
+#    Logged out clients behind one address would all share its bucket, so register, token and login
+#    requests take from a bucket for the username they name instead, and logout takes no token.
+#  - At most ADMISSION_MAX_IN_FLIGHT requests run at once, and each class only gets its share of
+#    that (ADMISSION_CLASS_SHARES), so auth traffic can never take the slots reads need.
+#  - While reads and writes take longer than ADMISSION_TARGET_LATENCY_MS on average, new auth requests
+#    are shed; past twice the target, writes are shed too. Reads are only limited by the in-flight cap.
+#    The average needs ADMISSION_MIN_SAMPLES requests within the window before it sheds anything, so
+#    one slow request after a quiet spell cannot shed the ones behind it.
+#  - Downloads, uploads, exports and imports run for as long as the client takes to send or read
+#    them, so they hold a slot but do not count towards the latency average.
+#Shed requests get 503 SERVICE_BUSY with a Retry-After estimated from the work already in flight.
+#The buckets, slots and averages belong to one process: under gunicorn every worker keeps its own,
+#so the limits a client meets are these multiplied by the number of workers.
+#Watch requests wait for changes for up to a few minutes, so they are rate limited but take no
+#in-flight slot; the change feed caps them on its own.
+
+AUTH_ENDPOINTS = frozenset(("register", "generate_token", "login"))
+READ_ENDPOINTS = frozenset(("index", "retrieve_data", "list_keys", "export_data", "download_blob", "dashboard", "logout"))
+EXEMPT_ENDPOINTS = frozenset(("static", "metrics"))
+UNLIMITED_ENDPOINTS = frozenset(("logout",))
+WATCH_ENDPOINTS = frozenset(("watch_data",))
+STREAMING_ENDPOINTS = frozenset(("export_data", "download_blob", "import_data", "upload_blob"))
+
+
+def request_class(endpoint):
+    if endpoint in AUTH_ENDPOINTS:
+        return "auth"
+    if endpoint in READ_ENDPOINTS:
+        return "read"
+    return "write"
+
+
+class AdmissionController:
+    def __init__(self, max_users=100000):
+        self._lock = threading.Lock()
+        self._buckets = LRUCache(max_entries=max_users, max_bytes=max_users)
+        self.in_flight = 0
+        self.latency = 0.0
+        self._latency_samples = 0
+        self._latency_updated = 0.0
+        self.shed = 0
+        self.rate_limited = 0
+
+    def take_token(self, identity, rate, burst):
+        #Returns 0 if the identity may proceed, otherwise seconds until its next token
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(identity)
+            if bucket is None:
+                bucket = [float(burst), now]
+                self._buckets.set(identity, bucket)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            self.rate_limited += 1
+            return (1 - bucket[0]) / rate
+
+    def enter(self, limit, share, shed_by_latency, latency_window, min_samples):
+        #Returns 0 if the request is admitted, otherwise a Retry-After in seconds
+        now = time.monotonic()
+        with self._lock:
+            recent = now - self._latency_updated < latency_window and self._latency_samples >= min_samples
+            latency = self.latency if recent else 0.0
+            if self.in_flight < limit * share and not shed_by_latency(latency):
+                self.in_flight += 1
+                return 0
+            self.shed += 1
+            # Roughly how long the requests already in flight need to drain
+            return max(1, math.ceil(self.in_flight * latency / max(1, limit)))
+
+    def leave(self, seconds, observe_latency, latency_window):
+        #Ends an admitted request; reads and writes also update the latency average
+        with self._lock:
+            self.in_flight -= 1
+            if observe_latency:
+                now = time.monotonic()
+                if now - self._latency_updated < latency_window:
+                    self.latency += 0.2 * (seconds - self.latency)
+                    self._latency_samples += 1
+                else:
+                    self.latency = seconds
+                    self._latency_samples = 1
+                self._latency_updated = now
+
+
+def init_admission(app):
+    app.config.setdefault('ADMISSION_ENABLED', True)
+    app.config.setdefault('ADMISSION_MAX_IN_FLIGHT', 64)
+    app.config.setdefault('ADMISSION_CLASS_SHARES', {"read": 1.0, "write": 0.75, "auth": 0.25})
+    app.config.setdefault('ADMISSION_TARGET_LATENCY_MS', 250)
+    app.config.setdefault('ADMISSION_LATENCY_WINDOW', 1.0)
+    app.config.setdefault('ADMISSION_MIN_SAMPLES', 8)
+    app.config.setdefault('ADMISSION_USER_RATE', 50)
+    app.config.setdefault('ADMISSION_USER_BURST', 100)
+    controller = AdmissionController()
+
+    @app.before_request
+    def _admit_request():
+        if not app.config['ADMISSION_ENABLED'] or request.endpoint in EXEMPT_ENDPOINTS:
+            return None
+
+        if request.endpoint in AUTH_ENDPOINTS:
+            identity = f"name:{request.form.get('username', '')}"
+        elif 'user_id' in session:
+            identity = str(session['user_id'])
+        else:
+            identity = f"addr:{request.remote_addr}"
+        wait = 0
+        if request.endpoint not in UNLIMITED_ENDPOINTS:
+            wait = controller.take_token(identity, app.config['ADMISSION_USER_RATE'], app.config['ADMISSION_USER_BURST'])
+        if wait:
+            return jsonify({
+                "status": "error",
+                "code": "RATE_LIMITED",
+                "message": "Too many requests. Please slow down."
+            }), 429, {"Retry-After": str(math.ceil(wait))}
+        if request.endpoint in WATCH_ENDPOINTS:
+            return None
+
+        kind = request_class(request.endpoint)
+        target = app.config['ADMISSION_TARGET_LATENCY_MS'] / 1000
+        if kind == "auth":
+            shed_by_latency = lambda latency: latency > target
+        elif kind == "write":
+            shed_by_latency = lambda latency: latency > 2 * target
+        else:
+            shed_by_latency = lambda latency: False
+        retry_after = controller.enter(app.config['ADMISSION_MAX_IN_FLIGHT'], app.config['ADMISSION_CLASS_SHARES'][kind],
+                                       shed_by_latency, app.config['ADMISSION_LATENCY_WINDOW'],
+                                       app.config['ADMISSION_MIN_SAMPLES'])
+        if retry_after:
+            return jsonify({
+                "status": "error",
+                "code": "SERVICE_BUSY",
+                "message": "The server is busy. Please try again shortly."
+            }), 503, {"Retry-After": str(retry_after)}
+
+        # Auth requests are slow by design and streams as slow as their client, so only the other reads
+        # and writes drive latency shedding
+        g.admission_observe = kind != "auth" and request.endpoint not in STREAMING_ENDPOINTS
+        g.admission_start = time.perf_counter()
+        return None
+
+    @app.teardown_request
+    def _release_request(exc):
+        start = g.pop('admission_start', None)
+        if start is not None:
+            controller.leave(time.perf_counter() - start, g.admission_observe,
+                             app.config['ADMISSION_LATENCY_WINDOW'])
+
+    return controller
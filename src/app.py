@@ -1,24 +1,238 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, g, Response, make_response, \
+    stream_with_context
 from werkzeug.security import check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_sqlalchemy import SQLAlchemy
 import re
-import bcrypt
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, decode_token
 import base64
+import hashlib
+import json
 import os
+import queue
+import time
+import threading
+from urllib.parse import urlsplit
+import click
+from contextlib import contextmanager
+from cache import LRUCache
+from hashing import PasswordHasher, HasherBusy, hash_rounds, calibrate_rounds
+from admission import init_admission
+from json_api import OrjsonProvider, wants_json, json_message
+from metrics import (init_metrics, cache_observer, observe_bcrypt, observe_group_commit, observe_decompression,
+                     observe_expiry_sweep, observe_expiry_backlog, record_error_code)
+from profiling import init_profiling, profile_phase
+from migrations import rebuild_table
+from sqlite_pool import WALDatabase, set_sqlite_pragmas
+from storage import (SqlAlchemyStorage, MemoryStorage, PreconditionFailed, VersionConflict, NotAnInteger,
+                     INTEGER_MIN, INTEGER_MAX, value_etag)
+from log_storage import LogStorage
+from sharding import ShardedStorage, StorageBusy, default_shard
+from blob_store import BlobStore, BlobTooLarge, BlobAbandoned
+from compression import ValueCodec
+from expiry import ExpirySweeper
+from change_feed import ChangeFeed, ChangesExpired, TooManyWatchers
+from notifier import WatchNotifier
 
 app = Flask(__name__)
+#jsonify and JSON message responses are encoded with orjson
+app.json = OrjsonProvider(app)
 
 
 # Database Configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.sqlite3'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///users.sqlite3')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config["JWT_SECRET_KEY"] = "your_jwt_secret_key_here"
 app.config['SECRET_KEY'] = os.urandom(24)
 
+# Batch API Configuration
+app.config['DATA_BATCH_MAX_OPERATIONS'] = 1000
+
+BATCH_OPERATIONS = ("store", "retrieve", "update", "delete")
+
+# Key Listing Configuration
+app.config['DATA_LIST_DEFAULT_LIMIT'] = 100
+app.config['DATA_LIST_MAX_LIMIT'] = 1000
+
+# Export/Import Configuration
+#Rows read per page by the export, and rows committed per transaction by the import
+app.config['DATA_EXPORT_CHUNK_SIZE'] = 1000
+app.config['DATA_IMPORT_BATCH_SIZE'] = 1000
+app.config['DATA_IMPORT_MAX_REPORTED_ERRORS'] = 1000
+
+# Large Value Configuration
+#Values uploaded to /api/data/blob are stored in chunks of BLOB_CHUNK_BYTES, which also bounds
+#the memory an upload or download uses; uploads larger than BLOB_MAX_BYTES are refused with 413
+#Uploads that stopped without a chunk for BLOB_INCOMPLETE_TIMEOUT seconds are deleted every
+#BLOB_CLEANUP_INTERVAL seconds, alongside the expiry sweeper
+app.config['BLOB_CHUNK_BYTES'] = 1024 * 1024
+app.config['BLOB_MAX_BYTES'] = int(os.environ.get('BLOB_MAX_BYTES', 512 * 1024 * 1024))
+app.config['BLOB_INCOMPLETE_TIMEOUT'] = int(os.environ.get('BLOB_INCOMPLETE_TIMEOUT', 3600))
+app.config['BLOB_CLEANUP_INTERVAL'] = 60.0
+app.config['BLOB_CLEANUP_BATCH_SIZE'] = 100
+
+# Data Cache Configuration
+#The cache is per process, so only enable it when a single process serves a database
+app.config['DATA_CACHE_ENABLED'] = False
+app.config['DATA_CACHE_MAX_ENTRIES'] = 10000
+app.config['DATA_CACHE_MAX_BYTES'] = 16 * 1024 * 1024
+app.config['DATA_CACHE_TTL'] = 300
+
+# Token Cache Configuration
+#Verified claims are cached by token digest until the token's exp
+app.config['TOKEN_CACHE_ENABLED'] = True
+app.config['TOKEN_CACHE_MAX_ENTRIES'] = 10000
+
+# Data Storage Configuration
+#DATA_STORAGE picks where key-value data lives: 'sqlalchemy' (the Data table), 'memory'
+#(lock-striped in-memory shards, optionally snapshotted to MEMORY_STORAGE_SNAPSHOT_PATH) or 'log'
+#(append-only segment files under LOG_STORAGE_PATH, for write heavy loads; single process only) or
+#'sharded' (DATA_SHARDS SQLite files under DATA_SHARD_DIRECTORY, users split between them by hash)
+#Users are always kept in the SQL database
+app.config['DATA_STORAGE'] = os.environ.get('DATA_STORAGE', 'sqlalchemy')
+app.config['MEMORY_STORAGE_SHARDS'] = 16
+app.config['MEMORY_STORAGE_SNAPSHOT_PATH'] = os.environ.get('MEMORY_STORAGE_SNAPSHOT_PATH')
+app.config['MEMORY_STORAGE_SNAPSHOT_INTERVAL'] = 60
+app.config['LOG_STORAGE_PATH'] = os.environ.get('LOG_STORAGE_PATH', os.path.join(app.instance_path, 'data_log'))
+app.config['LOG_STORAGE_SEGMENT_BYTES'] = 64 * 1024 * 1024
+app.config['LOG_STORAGE_FSYNC'] = True
+app.config['LOG_STORAGE_COMPACT_INTERVAL'] = 60
+app.config['LOG_STORAGE_COMPACT_MIN_GARBAGE'] = 0.5
+#Users can be moved between shards with: flask --app app move-user-shard USER_ID SHARD
+#Raising DATA_SHARDS re-routes users without a catalog entry, so run pin-user-shards first
+app.config['DATA_SHARDS'] = int(os.environ.get('DATA_SHARDS', 4))
+app.config['DATA_SHARD_DIRECTORY'] = os.environ.get('DATA_SHARD_DIRECTORY', app.instance_path)
+
+# Compression Configuration
+#DATA_COMPRESSION: 'none', 'zlib' or 'dictionary' (zlib primed with a dictionary trained on each user's
+#values, for small values). It applies to the sqlalchemy and sharded storages; rows keep the codec they
+#were written with, so the setting can change at any time. Rewrite existing rows, training the
+#dictionaries, with: flask --app app recompress-data
+app.config['DATA_COMPRESSION'] = os.environ.get('DATA_COMPRESSION', 'none')
+app.config['DATA_COMPRESSION_MIN_BYTES'] = 16
+app.config['DATA_COMPRESSION_LEVEL'] = 6
+app.config['DATA_COMPRESSION_DICTIONARY_SAMPLES'] = 1000
+
+# Key Expiry Configuration
+#Keys stored or updated with a ttl (seconds) stop being readable once it runs out; a background sweeper
+#then deletes them every EXPIRY_SWEEP_INTERVAL seconds, EXPIRY_SWEEP_BATCH_SIZE keys per transaction
+#with EXPIRY_SWEEP_PAUSE seconds between transactions
+app.config['EXPIRY_SWEEP_ENABLED'] = os.environ.get('EXPIRY_SWEEP_ENABLED', '1') == '1'
+app.config['EXPIRY_SWEEP_INTERVAL'] = float(os.environ.get('EXPIRY_SWEEP_INTERVAL', 1.0))
+app.config['EXPIRY_SWEEP_BATCH_SIZE'] = 500
+app.config['EXPIRY_SWEEP_PAUSE'] = 0.01
+app.config['EXPIRY_MAX_TTL'] = 10 * 365 * 24 * 3600
+
+# Change Feed Configuration
+#Every store, update and delete is logged for /api/data/watch; entries older than
+#CHANGE_FEED_RETENTION_SECONDS are compacted away every CHANGE_FEED_COMPACT_INTERVAL seconds, alongside the
+#expiry sweeper (EXPIRY_SWEEP_ENABLED turns both off)
+#Changes are logged in the same transaction as the write, so only DATA_STORAGE=sqlalchemy keeps a log
+#A long poll waits up to CHANGE_FEED_LONG_POLL_SECONDS; an event stream stays open for up to
+#CHANGE_FEED_STREAM_SECONDS, with a keepalive comment every CHANGE_FEED_KEEPALIVE_SECONDS, before the client
+#reconnects. Watches that wait are redirected (307) to the notifier (notifier.py) that every server process
+#runs on CHANGE_FEED_NOTIFIER_PORT, or to CHANGE_FEED_NOTIFIER_URL behind a proxy. It holds waiting watchers
+#without a thread each, on CHANGE_FEED_NOTIFIER_THREADS threads for reads; at most CHANGE_FEED_MAX_WATCHERS
+#requests per process watch at once.
+app.config['CHANGE_FEED_ENABLED'] = os.environ.get('CHANGE_FEED_ENABLED', '1') == '1'
+app.config['CHANGE_FEED_RETENTION_SECONDS'] = int(os.environ.get('CHANGE_FEED_RETENTION_SECONDS', 24 * 3600))
+app.config['CHANGE_FEED_COMPACT_INTERVAL'] = 60.0
+app.config['CHANGE_FEED_COMPACT_BATCH_SIZE'] = 1000
+app.config['CHANGE_FEED_LONG_POLL_SECONDS'] = 30
+app.config['CHANGE_FEED_STREAM_SECONDS'] = 300
+app.config['CHANGE_FEED_KEEPALIVE_SECONDS'] = 15
+app.config['CHANGE_FEED_MAX_WATCHERS'] = int(os.environ.get('CHANGE_FEED_MAX_WATCHERS', 1000))
+app.config['CHANGE_FEED_NOTIFIER_HOST'] = os.environ.get('HOST', '0.0.0.0')
+app.config['CHANGE_FEED_NOTIFIER_PORT'] = int(os.environ.get('CHANGE_FEED_NOTIFIER_PORT', 5001))
+app.config['CHANGE_FEED_NOTIFIER_URL'] = os.environ.get('CHANGE_FEED_NOTIFIER_URL')
+app.config['CHANGE_FEED_NOTIFIER_THREADS'] = 4
+app.config['CHANGE_FEED_POLL_INTERVAL'] = 1.0
+app.config['CHANGE_FEED_PAGE_SIZE'] = 100
+
+# SQLite Storage Configuration
+#In WAL mode every write goes through a single writer connection fed by a queue,
+#and retrieve_data/dashboard read from a pool of read only connections
+app.config['SQLITE_WAL_MODE'] = os.environ.get('SQLITE_WAL_MODE', '0') == '1'
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = 5000
+app.config['SQLITE_SYNCHRONOUS'] = 'NORMAL'
+#Group commit (WAL mode only): writes arriving within SQLITE_GROUP_COMMIT_WINDOW_MS of each other, up to
+#SQLITE_GROUP_COMMIT_MAX_OPS, are committed in one transaction and acknowledged once it is on disk
+#The commits are then cheap enough to fsync every one, so synchronous defaults to FULL
+app.config['SQLITE_GROUP_COMMIT_WINDOW_MS'] = float(os.environ.get('SQLITE_GROUP_COMMIT_WINDOW_MS', 0))
+app.config['SQLITE_GROUP_COMMIT_MAX_OPS'] = 256
+if app.config['SQLITE_GROUP_COMMIT_WINDOW_MS']:
+    app.config['SQLITE_SYNCHRONOUS'] = 'FULL'
+app.config['SQLITE_READ_POOL_SIZE'] = 8
+app.config['SQLITE_WRITE_QUEUE_SIZE'] = 1000
+
+# Password Hashing Configuration
+#bcrypt runs on BCRYPT_WORKERS threads; beyond BCRYPT_MAX_PENDING queued hashes requests get a 503
+#Pick BCRYPT_ROUNDS for this host with: flask --app app calibrate-bcrypt
+app.config['BCRYPT_ROUNDS'] = int(os.environ.get('BCRYPT_ROUNDS', 12))
+app.config['BCRYPT_WORKERS'] = os.cpu_count() or 1
+app.config['BCRYPT_MAX_PENDING'] = 32
+
+# Metrics Configuration
+#Per-route request counts, latency histograms, error codes, bcrypt and SQL timings at /metrics
+#For several worker processes set PROMETHEUS_MULTIPROC_DIR to an empty directory before starting them
+app.config['METRICS_ENABLED'] = True
+
+# Profiling Configuration
+#PROFILING_ENABLED adds a Server-Timing header (auth, db, render, session phases and query count)
+#to every response and logs statements repeated more than PROFILING_N_PLUS_ONE_THRESHOLD times
+#Statements slower than PROFILING_SLOW_QUERY_MS are always logged to dpd.slow_query with their query plan
+app.config['PROFILING_ENABLED'] = os.environ.get('PROFILING_ENABLED', '0') == '1'
+app.config['PROFILING_SLOW_QUERY_MS'] = int(os.environ.get('PROFILING_SLOW_QUERY_MS', 100))
+app.config['PROFILING_N_PLUS_ONE_THRESHOLD'] = 10
+
+# Admission Control Configuration
+#Each user gets ADMISSION_USER_BURST requests, refilled at ADMISSION_USER_RATE per second (429 past that)
+#At most ADMISSION_MAX_IN_FLIGHT requests run at once, split between reads, writes and auth by
+#ADMISSION_CLASS_SHARES; auth, then writes, are shed with 503 while reads and writes are slower than
+#ADMISSION_TARGET_LATENCY_MS on average
+app.config['ADMISSION_ENABLED'] = os.environ.get('ADMISSION_ENABLED', '1') == '1'
+app.config['ADMISSION_MAX_IN_FLIGHT'] = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 64))
+app.config['ADMISSION_CLASS_SHARES'] = {"read": 1.0, "write": 0.75, "auth": 0.25}
+app.config['ADMISSION_TARGET_LATENCY_MS'] = int(os.environ.get('ADMISSION_TARGET_LATENCY_MS', 250))
+app.config['ADMISSION_LATENCY_WINDOW'] = 1.0
+app.config['ADMISSION_USER_RATE'] = int(os.environ.get('ADMISSION_USER_RATE', 50))
+app.config['ADMISSION_USER_BURST'] = int(os.environ.get('ADMISSION_USER_BURST', 100))
+
+# Proxy Configuration
+#Behind PROXY_COUNT reverse proxies the client address (and scheme and host) come from the
+#X-Forwarded-* headers they add, so limits keyed by address apply to clients rather than to the proxy.
+#Keep it 0 when clients connect directly, as they could otherwise send any address they like.
+app.config['PROXY_COUNT'] = int(os.environ.get('PROXY_COUNT', 0))
+
+
+if app.config['PROXY_COUNT']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_COUNT'], x_proto=app.config['PROXY_COUNT'],
+                            x_host=app.config['PROXY_COUNT'])
 
 db = SQLAlchemy(app)
 jwt = JWTManager(app)
+data_cache = LRUCache(
+    max_entries=app.config['DATA_CACHE_MAX_ENTRIES'],
+    max_bytes=app.config['DATA_CACHE_MAX_BYTES'],
+    ttl=app.config['DATA_CACHE_TTL'],
+    on_event=cache_observer("data")
+)
+token_cache = LRUCache(
+    max_entries=app.config['TOKEN_CACHE_MAX_ENTRIES'],
+    max_bytes=app.config['TOKEN_CACHE_MAX_ENTRIES'] * 1024,
+    on_event=cache_observer("token")
+)
+password_hasher = PasswordHasher(
+    workers=app.config['BCRYPT_WORKERS'],
+    max_pending=app.config['BCRYPT_MAX_PENDING'],
+    observe=observe_bcrypt
+)
+
+# Metrics are registered first so request timings include every other hook
+init_metrics(app)
+init_profiling(app)
+# Admission runs before the token is decoded, so shed requests cost as little as possible
+admission_controller = init_admission(app)
 
 #User Database
 class User(db.Model):
@@ -31,16 +245,404 @@ class User(db.Model):
     gender = db.Column(db.String(20), nullable=False)
 
 #database to store key:value
+#Keys are unique per user; the (user_id, key) index also serves per-user scans in key order
 class Data(db.Model):
+    __table_args__ = (
+        db.Index('ix_data_user_id_key', 'user_id', 'key', unique=True),
+        db.Index('ix_data_expires_at', 'expires_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    key = db.Column(db.String(100), unique=True, nullable=False)
+    key = db.Column(db.String(100), nullable=False)
     value = db.Column(db.String(100), nullable=False)
+    #Compressed rows keep an empty value and their bytes in packed; codec says how to read them back
+    codec = db.Column(db.SmallInteger, nullable=False, default=0, server_default="0")
+    packed = db.Column(db.LargeBinary)
+    #Unix time the key expires at, or NULL for keys that never do
+    expires_at = db.Column(db.Float)
+    #Raised by every write to the value, for compare-and-swap
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    #value_etag of the value, so If-None-Match is answered without reading the value
+    etag = db.Column(db.String(24))
     user = db.relationship('User', back_populates="data")
 
 #User-Data Relationship
 User.data = db.relationship('Data', back_populates="user")
 
+#Change feed: one row per store, update or delete, numbered by id across all users
+#AUTOINCREMENT keeps ids from being reused once the oldest rows are compacted away
+class DataChange(db.Model):
+    __table_args__ = (
+        db.Index('ix_data_change_user_id_id', 'user_id', 'id'),
+        db.Index('ix_data_change_created_at', 'created_at'),
+        {'sqlite_autoincrement': True},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    key = db.Column(db.String(100), nullable=False)
+    #store, update or delete; value is NULL for deletes
+    op = db.Column(db.String(10), nullable=False)
+    value = db.Column(db.Text)
+    created_at = db.Column(db.Float, nullable=False)
+
+#Catalog of the shard each user's data is on (DATA_STORAGE=sharded)
+#Users without a row are on their default shard; moving is set while a move is in progress
+class UserShard(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    shard = db.Column(db.Integer, nullable=False)
+    moving = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+
+#Compression dictionaries trained on a user's values; rows name the dictionary they were written with,
+#so older dictionaries are kept
+class CompressionDictionary(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+#Large values uploaded as a stream, kept apart from Data whatever DATA_STORAGE is
+#A blob only becomes visible once complete is set, after all of its chunks are stored
+#updated_at is when the last chunk of an incomplete blob was stored
+class DataBlob(db.Model):
+    __table_args__ = (
+        db.Index('ix_data_blob_user_id_key', 'user_id', 'key'),
+        db.Index('ix_data_blob_complete_updated_at', 'complete', 'updated_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    key = db.Column(db.String(100), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False, default=0, server_default="0")
+    chunk_size = db.Column(db.Integer, nullable=False)
+    etag = db.Column(db.String(24))
+    complete = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    updated_at = db.Column(db.Float)
+
+class DataBlobChunk(db.Model):
+    blob_id = db.Column(db.Integer, db.ForeignKey('data_blob.id'), primary_key=True)
+    sequence = db.Column(db.Integer, primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+#Read-through cache helpers for Data values, keyed by (user_id, key)
+#Entries are (value, version). Take _cache_generation() before reading or writing a value and pass it
+#to _cache_value, so a value a concurrent write has invalidated since is not cached.
+def _get_cached_value(user_id, key):
+    if not app.config['DATA_CACHE_ENABLED']:
+        return None
+    return data_cache.get((str(user_id), key))
+
+def _cache_generation():
+    return data_cache.generation()
+
+#A value that expires is only cached until it does
+def _cache_value(user_id, key, value, version, expires_at=None, since=None):
+    if not app.config['DATA_CACHE_ENABLED']:
+        return
+    ttl = None
+    if expires_at is not None:
+        ttl = min(expires_at - time.time(), app.config['DATA_CACHE_TTL'] or float('inf'))
+        if ttl <= 0:
+            return
+    data_cache.set((str(user_id), key), (value, version), size=len(key.encode('utf-8')) + len(value.encode('utf-8')),
+                   ttl=ttl, since=since)
+
+def _invalidate_value(user_id, key):
+    data_cache.invalidate((str(user_id), key))
+
+wal_database = None
+_wal_database_lock = threading.Lock()
+
+#Opens the WAL writer/reader pair on first use
+def _wal_database():
+    global wal_database
+    with _wal_database_lock:
+        if wal_database is None:
+            set_sqlite_pragmas(
+                db.engine,
+                busy_timeout_ms=app.config['SQLITE_BUSY_TIMEOUT_MS'],
+                synchronous=app.config['SQLITE_SYNCHRONOUS']
+            )
+            wal_database = WALDatabase(
+                db.engine.url.database,
+                read_pool_size=app.config['SQLITE_READ_POOL_SIZE'],
+                queue_size=app.config['SQLITE_WRITE_QUEUE_SIZE'],
+                busy_timeout_ms=app.config['SQLITE_BUSY_TIMEOUT_MS'],
+                synchronous=app.config['SQLITE_SYNCHRONOUS'],
+                group_commit_window_ms=app.config['SQLITE_GROUP_COMMIT_WINDOW_MS'],
+                group_commit_max_ops=app.config['SQLITE_GROUP_COMMIT_MAX_OPS'],
+                on_group_commit=observe_group_commit
+            )
+        return wal_database
+
+#Runs fn(session, *args) as a write, on the WAL writer thread when WAL mode is on
+#Raises StorageBusy when the writer's queue stays full for the busy timeout
+def _run_write(fn, *args):
+    if app.config['SQLITE_WAL_MODE']:
+        try:
+            return _wal_database().write(fn, *args)
+        except queue.Full:
+            raise StorageBusy()
+    return fn(db.session, *args)
+
+#Session for reads, from the read only pool when WAL mode is on
+@contextmanager
+def _read_session():
+    if app.config['SQLITE_WAL_MODE']:
+        with _wal_database().read_session() as read_session:
+            yield read_session
+    else:
+        yield db.session
+
+#Shard routing for DATA_STORAGE=sharded: the user's catalog entry (shard, moving), or None
+#The catalog is read on every call rather than cached, so every worker sees a move at once
+def _user_shard(user_id):
+    with _read_session() as read_session:
+        row = read_session.execute(
+            db.select(UserShard.shard, UserShard.moving).filter_by(user_id=int(user_id))
+        ).first()
+    return None if row is None else (row.shard, row.moving)
+
+def _set_user_shard(user_id, shard, moving):
+    _run_write(_write_user_shard, int(user_id), shard, moving)
+
+#Creates the key-value storage selected by DATA_STORAGE
+def _create_storage():
+    if app.config['DATA_STORAGE'] == 'memory':
+        return MemoryStorage(
+            shards=app.config['MEMORY_STORAGE_SHARDS'],
+            snapshot_path=app.config['MEMORY_STORAGE_SNAPSHOT_PATH'],
+            snapshot_interval=app.config['MEMORY_STORAGE_SNAPSHOT_INTERVAL']
+        )
+    if app.config['DATA_STORAGE'] == 'log':
+        return LogStorage(
+            app.config['LOG_STORAGE_PATH'],
+            segment_bytes=app.config['LOG_STORAGE_SEGMENT_BYTES'],
+            fsync=app.config['LOG_STORAGE_FSYNC'],
+            compact_interval=app.config['LOG_STORAGE_COMPACT_INTERVAL'],
+            compact_min_garbage=app.config['LOG_STORAGE_COMPACT_MIN_GARBAGE']
+        )
+    if app.config['DATA_STORAGE'] == 'sharded':
+        os.makedirs(app.config['DATA_SHARD_DIRECTORY'], exist_ok=True)
+        return ShardedStorage(
+            Data,
+            [f"sqlite:///{os.path.join(app.config['DATA_SHARD_DIRECTORY'], f'data_shard_{index}.sqlite3')}"
+             for index in range(app.config['DATA_SHARDS'])],
+            _user_shard,
+            busy_timeout_ms=app.config['SQLITE_BUSY_TIMEOUT_MS'],
+            synchronous=app.config['SQLITE_SYNCHRONOUS'],
+            codec=value_codec
+        )
+    if app.config['DATA_STORAGE'] == 'sqlalchemy':
+        return SqlAlchemyStorage(Data, _run_write, _read_session, value_codec, change_log=change_feed)
+    raise ValueError(f"Unknown DATA_STORAGE: {app.config['DATA_STORAGE']}")
+
+#Sweeper callbacks; the storage may need the app context for its sessions
+def _sweep_expired(now, limit):
+    with app.app_context():
+        return data_storage.sweep(now, limit)
+
+def _expiry_backlog(now):
+    with app.app_context():
+        return data_storage.expiry_backlog(now)
+
+#Change feed sessions: each read gets its own app context, so the connection is returned as soon as
+#the read is done rather than held for the rest of a watching request
+@contextmanager
+def _change_feed_session():
+    with app.app_context(), _read_session() as read_session:
+        yield read_session
+
+def _compact_changes(now, limit):
+    with app.app_context():
+        return change_feed.compact(now, limit)
+
+def _sweep_incomplete_blobs(now, limit):
+    with app.app_context():
+        return blob_store.sweep_incomplete(now, limit)
+
+value_codec = ValueCodec(
+    CompressionDictionary, _run_write, _read_session,
+    mode=app.config['DATA_COMPRESSION'],
+    min_bytes=app.config['DATA_COMPRESSION_MIN_BYTES'],
+    level=app.config['DATA_COMPRESSION_LEVEL'],
+    observe=observe_decompression
+)
+#The data writes log their changes themselves, so the feed exists before the storage; None without a feed
+change_feed = ChangeFeed(
+    DataChange, _run_write, _change_feed_session,
+    retention=app.config['CHANGE_FEED_RETENTION_SECONDS'],
+    poll_interval=app.config['CHANGE_FEED_POLL_INTERVAL'],
+    max_watchers=app.config['CHANGE_FEED_MAX_WATCHERS']
+) if app.config['CHANGE_FEED_ENABLED'] and app.config['DATA_STORAGE'] == 'sqlalchemy' else None
+#Started by every server process: gunicorn's post_worker_init, or the __main__ block below
+watch_notifier = WatchNotifier(
+    app, change_feed,
+    host=app.config['CHANGE_FEED_NOTIFIER_HOST'],
+    port=app.config['CHANGE_FEED_NOTIFIER_PORT'],
+    threads=app.config['CHANGE_FEED_NOTIFIER_THREADS']
+) if change_feed is not None else None
+data_storage = _create_storage()
+blob_store = BlobStore(DataBlob, DataBlobChunk, _run_write, _read_session, chunk_size=app.config['BLOB_CHUNK_BYTES'],
+                       incomplete_timeout=app.config['BLOB_INCOMPLETE_TIMEOUT'])
+expiry_sweeper = ExpirySweeper(
+    _sweep_expired, _expiry_backlog,
+    interval=app.config['EXPIRY_SWEEP_INTERVAL'],
+    batch_size=app.config['EXPIRY_SWEEP_BATCH_SIZE'],
+    pause=app.config['EXPIRY_SWEEP_PAUSE'],
+    observe_sweep=observe_expiry_sweep,
+    observe_backlog=observe_expiry_backlog
+)
+#Change feed compaction runs on a sweeper of its own, with the same batching as key expiry
+change_feed_compactor = ExpirySweeper(
+    _compact_changes, None,
+    interval=app.config['CHANGE_FEED_COMPACT_INTERVAL'],
+    batch_size=app.config['CHANGE_FEED_COMPACT_BATCH_SIZE'],
+    pause=app.config['EXPIRY_SWEEP_PAUSE'],
+    name="change-feed-compactor"
+)
+#So does the cleanup of abandoned uploads
+blob_cleaner = ExpirySweeper(
+    _sweep_incomplete_blobs, None,
+    interval=app.config['BLOB_CLEANUP_INTERVAL'],
+    batch_size=app.config['BLOB_CLEANUP_BATCH_SIZE'],
+    pause=app.config['EXPIRY_SWEEP_PAUSE'],
+    name="blob-cleaner"
+)
+_expiry_sweeper_lock = threading.Lock()
+_expiry_sweeper_started = False
+
+#The sweepers start with the first request, so CLI commands never run them
+@app.before_request
+def _start_expiry_sweeper():
+    global _expiry_sweeper_started
+    if _expiry_sweeper_started or not app.config['EXPIRY_SWEEP_ENABLED']:
+        return
+    with _expiry_sweeper_lock:
+        if not _expiry_sweeper_started:
+            expiry_sweeper.start()
+            if change_feed is not None:
+                change_feed_compactor.start()
+            blob_cleaner.start()
+            _expiry_sweeper_started = True
+
+#Write operations, each runs in its own transaction
+def _write_user(session, fields):
+    new_user = User(**fields)
+    session.add(new_user)
+    session.commit()
+    return new_user
+
+def _write_user_shard(session, user_id, shard, moving):
+    session.merge(UserShard(user_id=user_id, shard=shard, moving=moving))
+    session.commit()
+
+def _write_password(session, user_id, password):
+    session.get(User, user_id).password = password
+    session.commit()
+
+#Opaque keyset cursors for the key listing; a cursor is the last key of the previous page
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+def _decode_cursor(cursor):
+    #Raises ValueError for anything _encode_cursor could not have produced
+    key = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    if _encode_cursor(key) != cursor:
+        raise ValueError("invalid cursor")
+    return key
+
+#Checks a password against the user's stored hash
+#A matching hash with a different cost than BCRYPT_ROUNDS is replaced with one at the configured cost
+def _verify_password(user, password):
+    if not password_hasher.check(password, user.password):
+        return False
+    if hash_rounds(user.password) != app.config['BCRYPT_ROUNDS']:
+        try:
+            new_hash = password_hasher.hash(password, app.config['BCRYPT_ROUNDS'])
+            _run_write(_write_password, user.id, new_hash)
+        except (HasherBusy, StorageBusy):
+            # The rehash is retried on a later login
+            pass
+    return True
+
+# Renders a route's message with its template, or returns it as compact JSON
+#when the client asks for JSON (Accept: application/json), skipping Jinja entirely
+def _render_message(template, message):
+    if wants_json():
+        record_error_code(message)
+        return json_message(message)
+    return render_template(template, message=message)
+
+#Parses the optional ttl form field into an expiry time
+#Returns (expires_at or None, error response or None)
+def _parse_ttl(ttl):
+    if ttl is None or not ttl.strip():
+        return None, None
+    ttl = ttl.strip()
+    if not ttl.isdigit() or not 0 < int(ttl) <= app.config['EXPIRY_MAX_TTL']:
+        return None, (jsonify({
+            "status": "error",
+            "code": "INVALID_TTL",
+            "message": f"The ttl must be a whole number of seconds between 1 and {app.config['EXPIRY_MAX_TTL']}."
+        }), 400)
+    return time.time() + int(ttl), None
+
+#Response for uploads past BLOB_MAX_BYTES
+def _blob_too_large_response():
+    return jsonify({
+        "status": "error",
+        "code": "VALUE_TOO_LARGE",
+        "message": f"Values can be at most {app.config['BLOB_MAX_BYTES']} bytes."
+    }), 413
+
+#Response for conditional updates whose If-Match no longer matches the stored value
+def _precondition_failed_response():
+    return jsonify({
+        "status": "error",
+        "code": "PRECONDITION_FAILED",
+        "message": "The stored value has changed since it was read. Retrieve it again before updating."
+    }), 412
+
+#Response for requests turned away because the bcrypt pool or the write queue is full, or the user's
+#data is being moved
+def _service_busy_response():
+    return jsonify({
+        "status": "error",
+        "code": "SERVICE_BUSY",
+        "message": "The server is busy. Please try again shortly."
+    }), 503, {"Retry-After": "1"}
+
+#Decodes and verifies an access token, reusing verified claims until the token expires
+def _decode_access_token(access_token):
+    if not app.config['TOKEN_CACHE_ENABLED']:
+        return decode_token(access_token)
+
+    digest = hashlib.sha256(access_token.encode('utf-8')).digest()
+    claims = token_cache.get(digest)
+    if claims is not None and ('exp' not in claims or claims['exp'] > time.time()):
+        return claims
+
+    claims = decode_token(access_token)
+    ttl = claims['exp'] - time.time() if 'exp' in claims else None
+    if ttl is None or ttl > 0:
+        token_cache.set(digest, claims, size=len(access_token), ttl=ttl)
+    return claims
+
+# Resolve the logged in user once per request from the session token
+#Routes read g.current_user_id, or g.token_error when the token failed verification
+@app.before_request
+def resolve_current_user():
+    g.current_user_id = None
+    g.token_error = None
+    if 'access_token' not in session:
+        return
+    try:
+        with profile_phase("auth"):
+            g.current_user_id = _decode_access_token(session['access_token'])['sub']
+    except Exception as e:
+        g.token_error = e
+
 # inject user status[Is user logged in or not] 
 @app.context_processor
 def inject_user_status():
@@ -104,21 +706,17 @@ def register():
                     "message": "Gender field is required. Please specify the gender."
                 }), 400
 
-            #password is hased theough bcrypt and then encoded to base64
-            hashed_password = bcrypt.hashpw(data['password'].encode('utf-8'), bcrypt.gensalt())
-            hashed_password_str = base64.b64encode(hashed_password).decode('utf-8')
+            #password is hased theough bcrypt (on the hashing pool) and then encoded to base64
+            hashed_password_str = password_hasher.hash(data['password'], app.config['BCRYPT_ROUNDS'])
 
-            new_user = User(
+            new_user = _run_write(_write_user, dict(
                 username=data['username'],
                 email=data['email'],
                 password=hashed_password_str,
                 full_name=data['full_name'],
                 age=int(data['age']),
                 gender=data['gender']
-            )
-
-            db.session.add(new_user)
-            db.session.commit()
+            ))
 
             message = {
                 "status": "success",
@@ -132,14 +730,16 @@ def register():
                     "gender": new_user.gender
                 }
             }
-            return render_template('register.html', message=message)
+            return _render_message('register.html', message)
+        except (HasherBusy, StorageBusy):
+            return _service_busy_response()
         except:
             message = {
                 "status": "error",
                 "code": "INTERNAL_SERVER_ERROR",
                 "message": "An internal server error occurred. Please try again later."
             }
-            return render_template('register.html', message=message)
+            return _render_message('register.html', message)
         
     return render_template("register.html")
     
@@ -162,7 +762,7 @@ def generate_token():
             user = User.query.filter_by(username=data['username']).first()
 
             # Validate credentials
-            if not user or not bcrypt.checkpw(data['password'].encode('utf-8'), base64.b64decode(user.password)):
+            if not user or not _verify_password(user, data['password']):
                 return jsonify({
                     "status": "error",
                     "code": "INVALID_CREDENTIALS",
@@ -182,7 +782,9 @@ def generate_token():
                     "expires_in": 3600
                 }
             }
-            return render_template("generate_token.html", message=message)
+            return _render_message("generate_token.html", message)
+        except HasherBusy:
+            return _service_busy_response()
         except Exception as e:
             # Log the error for debugging
             app.logger.error(f"Error occurred while generating token: {str(e)}")
@@ -192,7 +794,7 @@ def generate_token():
                 "code": "INTERNAL_ERROR",
                 "message": "Internal server error occurred. Please try again later."
             }
-            return render_template("generate_token.html", message=message)
+            return _render_message("generate_token.html", message)
         
     return render_template("generate_token.html")
         
@@ -214,7 +816,7 @@ def login():
 
             # Validate user credentials
             user = User.query.filter_by(username=data['username']).first()
-            if not user or not bcrypt.checkpw(data['password'].encode('utf-8'), base64.b64decode(user.password)):
+            if not user or not _verify_password(user, data['password']):
                 return jsonify({
                     "status": "error",
                     "code": "INVALID_CREDENTIALS",
@@ -223,7 +825,7 @@ def login():
 
             # Validate the access token
             try:
-                decoded_token = decode_token(data['access_token'])  # Verify JWT format
+                decoded_token = _decode_access_token(data['access_token'])  # Verify JWT format
             except Exception as e:
                 return jsonify({
                     "status": "error",
@@ -240,6 +842,8 @@ def login():
             # Redirect to the dashboard after successful login
             return redirect(url_for('dashboard'))
 
+        except HasherBusy:
+            return _service_busy_response()
         except Exception as e:
             app.logger.error(f"Error occurred while logging in: {str(e)}")
             return jsonify({
@@ -260,13 +864,19 @@ def dashboard():
         if 'access_token' not in session:
             return redirect(url_for('login'))
 
-        # Use token for Authorization header
-        access_token = session['access_token']
-        decoded_token = decode_token(access_token)  # Decode and validate token
+        # The token was decoded and validated by resolve_current_user
+        if g.token_error is not None:
+            app.logger.error(f"Token decoding error: {str(g.token_error)}")
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_TOKEN",
+                "message": "Invalid access token provided."
+            }), 401
 
         # Fetch user details
-        current_user_id = decoded_token['sub']
-        user = User.query.get(current_user_id)
+        current_user_id = g.current_user_id
+        with _read_session() as read_session:
+            user = read_session.get(User, current_user_id)
 
         if not user:
             return jsonify({
@@ -293,22 +903,15 @@ def store_data():
         if 'access_token' not in session:
             return redirect(url_for('login'))
 
-        #The access token is optained form the session
-        # Decode and validate the access token
-        access_token = session['access_token']
-        try:
-            decoded_token = decode_token(access_token)
-            current_user_id = decoded_token['sub']
-        except Exception as e:
-            print(f"Token decoding error: {str(e)}")
+        #The access token from the session is validated by resolve_current_user
+        if g.token_error is not None:
+            print(f"Token decoding error: {str(g.token_error)}")
             return jsonify({
                 "status": "error",
                 "code": "INVALID_TOKEN",
                 "message": "Invalid access token provided."
             }), 401
-
-        # Fetch the user details
-        user = User.query.get(current_user_id)
+        current_user_id = g.current_user_id
 
         if request.method == "POST":
             # Retrieve form data
@@ -329,33 +932,35 @@ def store_data():
                     "message": "The provided value is not valid or missing."
                 }), 400
 
+            expires_at, ttl_error = _parse_ttl(data.get('ttl'))
+            if ttl_error is not None:
+                return ttl_error
+
             key = data['key'].strip()
             value = data['value'].strip()
 
-            # Check if the key already exists
-            existing_data = Data.query.filter_by(user_id=current_user_id, key=key).first()
-            if existing_data:
+            # Store new data unless the key already exists
+            generation = _cache_generation()
+            if not data_storage.put(current_user_id, key, value, expires_at):
                 return jsonify({
                     "status": "error",
                     "code": "KEY_EXISTS",
                     "message": "The provided key already exists in the database. To update an existing key, use the update API."
                 }), 409
-
-            # Store new data
-            new_data = Data(user_id=current_user_id, key=key, value=value)
-            db.session.add(new_data)
-            db.session.commit()
+            _cache_value(current_user_id, key, value, 1, expires_at, since=generation)
 
             # Success response
             message = {
                 "status": "success",
                 "message": "Data stored successfully."
             }
-            return render_template("store_data.html", message=message)
+            return _render_message("store_data.html", message)
 
         # Render the form for GET requests
         return render_template("store_data.html", message=None)
 
+    except StorageBusy:
+        return _service_busy_response()
     except Exception as e:
         print(f"Unexpected error occurred: {str(e)}")
         return jsonify({
@@ -379,41 +984,62 @@ def retrieve_data():
                 "status": "error",
                 "message": "Key is required to retrieve data."
             }
-            return render_template("retrieve_data.html", message=message)
-        # The access token is optained form the session
-        # Decode the access token to get the user ID
-        access_token = session['access_token']
-        try:
-            decoded_token = decode_token(access_token)
-            current_user_id = decoded_token['sub']
-        except Exception as e:
+            return _render_message("retrieve_data.html", message)
+        # The access token from the session is validated by resolve_current_user
+        if g.token_error is not None:
             message = {
                 "status": "error",
                 "code" : "INVALID_TOKEN",
                 "message": "Invalid access token. Please log in again."
             }
-            return render_template("retrieve_data.html", message=message)
-
-        # Query the database for the key
-        existing_data = Data.query.filter_by(user_id=current_user_id, key=key).first()
-        if not existing_data:
+            return _render_message("retrieve_data.html", message)
+        current_user_id = g.current_user_id
+
+        # Serve from the cache when possible, otherwise query the database for the key
+        cached = _get_cached_value(current_user_id, key)
+        if cached is None and request.if_none_match:
+            # A client that may already hold the value is checked against the stored ETag first,
+            # so a 304 never reads the value itself
+            etag = data_storage.etag(current_user_id, key)
+            if etag is not None and request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                response.vary.add("Accept")
+                return response
+        if cached is not None:
+            value, version = cached
+        else:
+            generation = _cache_generation()
+            stored = data_storage.get(current_user_id, key, with_meta=True)
+            if stored is None:
+                message = {
+                    "status": "error",
+                    "code" : "KEY_NOT_FOUND",
+                    "message" : "The provided key does not exist in the database."
+                }
+                return _render_message("retrieve_data.html", message)
+            value, expires_at, version = stored
+            _cache_value(current_user_id, key, value, version, expires_at, since=generation)
+
+        # Clients that already hold this value get a 304 without a body
+        etag = value_etag(value)
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            # Return success with the retrieved data
             message = {
-                "status": "error",
-                "code" : "KEY_NOT_FOUND",
-                "message" : "The provided key does not exist in the database."
-            }
-            return render_template("retrieve_data.html", message=message)
-
-        # Return success with the retrieved data
-        message = {
-            "status": "success",
-            "message": "Data retrieved successfully!",
-            "data": {
-                "key": existing_data.key,
-                "value": existing_data.value
+                "status": "success",
+                "message": "Data retrieved successfully!",
+                "data": {
+                    "key": key,
+                    "value": value,
+                    "version": version
+                }
             }
-        }
-        return render_template("retrieve_data.html", message=message)
+            response = make_response(_render_message("retrieve_data.html", message))
+        response.set_etag(etag)
+        response.vary.add("Accept")
+        return response
 
     except Exception as e:
         # Catch any other unexpected exceptions
@@ -421,7 +1047,7 @@ def retrieve_data():
             "status": "error",
             "message": f"An unexpected error occurred: {str(e)}"
         }
-        return render_template("retrieve_data.html", message=message)
+        return _render_message("retrieve_data.html", message)
 
 
 #Route for updating data
@@ -435,53 +1061,67 @@ def update_data():
             # Extract key and value from the form data
             key = request.form.get('key')
             value = request.form.get('value')
-            access_token = session['access_token']
 
-            try:
-                # Decode the access token to get the user ID
-                decoded_token = decode_token(access_token)
-                current_user_id = decoded_token['sub']
-            except Exception as e:
-                # Handle invalid access token
-                print(f"Token decoding error: {str(e)}")
+            # Handle invalid access token
+            if g.token_error is not None:
+                print(f"Token decoding error: {str(g.token_error)}")
                 message = {
                     "status": "error",
                     "message": "Invalid access token provided.",
                     "code": "INVALID_TOKEN"
                 }
-                return render_template("update_data.html", message=message)
+                return _render_message("update_data.html", message)
+            current_user_id = g.current_user_id
 
-            # Check if the provided key exists for the current user
-            existing_data = Data.query.filter_by(user_id=current_user_id, key=key).first()
-            if not existing_data:
-                message = {
-                    "status": "error",
-                    "message": "The provided key does not exist in the database.",
-                    "code": "KEY_NOT_FOUND"
-                }
-                return render_template("update_data.html", message=message)
+            key_not_found = {
+                "status": "error",
+                "message": "The provided key does not exist in the database.",
+                "code": "KEY_NOT_FOUND"
+            }
 
-            # Update the value
+            # A missing key is reported ahead of a missing value
             if not value:
+                if data_storage.get(current_user_id, key) is None:
+                    return _render_message("update_data.html", key_not_found)
                 message = {
                     "status": "error",
                     "message": "New value is required to update the data."
                 }
-                return render_template("update_data.html", message=message)
-
-            existing_data.value = value
-            db.session.commit()
+                return _render_message("update_data.html", message)
+
+            #A ttl restarts the key's expiry; without one the key keeps the expiry it had
+            expires_at, ttl_error = _parse_ttl(request.form.get('ttl'))
+            if ttl_error is not None:
+                return ttl_error
+
+            # Update the value if the provided key exists for the current user
+            #With If-Match only a value whose ETag is listed is replaced
+            #The header is read here, as the check may run on the WAL writer thread
+            check = None
+            if_match = request.if_match
+            if if_match:
+                check = lambda current_value: if_match.contains(value_etag(current_value))
+            try:
+                if not data_storage.update(current_user_id, key, value, check, expires_at):
+                    return _render_message("update_data.html", key_not_found)
+            except PreconditionFailed:
+                return _precondition_failed_response()
+            _invalidate_value(current_user_id, key)
 
             # Success message
             message = {
                 "status": "success",
                 "message": "Data updated successfully."
             }
-            return render_template("update_data.html", message=message)
+            response = make_response(_render_message("update_data.html", message))
+            response.set_etag(value_etag(value))
+            return response
 
         # Render the form for GET requests
         return render_template("update_data.html", message=None)
 
+    except StorageBusy:
+        return _service_busy_response()
     except Exception as e:
         # Log the error for debugging
         print(f"Unexpected error occurred: {str(e)}")
@@ -489,7 +1129,7 @@ def update_data():
             "status": "error",
             "message": "An unexpected error occurred."
         }
-        return render_template("update_data.html", message=message)
+        return _render_message("update_data.html", message)
 
 
 #Route for deleting data
@@ -502,54 +1142,822 @@ def delete_data():
 
         if request.method == "POST":
             key = request.form.get('key')  # Get the key from the form
-            access_token = session['access_token']
 
-            # Decode the access token
-            try:
-                decoded_token = decode_token(access_token)
-                current_user_id = decoded_token['sub']
-            except Exception as e:
-                print(f"Token decoding error: {str(e)}")
+            # Check the access token decoded by resolve_current_user
+            if g.token_error is not None:
+                print(f"Token decoding error: {str(g.token_error)}")
                 message = {
                     "status": "error",
                     "code": "INVALID_TOKEN",
                     "message": "Invalid access token provided."
                 }
-                return render_template("delete_data.html", message=message)
+                return _render_message("delete_data.html", message)
+            current_user_id = g.current_user_id
 
-            # Check if the key exists in the database
-            data = Data.query.filter_by(user_id=current_user_id, key=key).first()
-            if not data:
+            # Delete the data entry if the key exists in the database
+            if not data_storage.delete(current_user_id, key):
                 message = {
                     "status": "error",
                     "code": "KEY_NOT_FOUND",
                     "message": "The provided key does not exist in the database."
                 }
-                return render_template("delete_data.html", message=message)
-
-            # Delete the data entry
-            db.session.delete(data)
-            db.session.commit()
+                return _render_message("delete_data.html", message)
+            _invalidate_value(current_user_id, key)
 
             # Return a success message
             message = {
                 "status": "success",
                 "message": "Data deleted successfully."
             }
-            return render_template("delete_data.html", message=message)
+            return _render_message("delete_data.html", message)
 
         # Render the form for GET requests
         return render_template("delete_data.html", message=None)
 
+    except StorageBusy:
+        return _service_busy_response()
     except Exception as e:
         print(f"Unexpected error occurred: {str(e)}")
         message = {
             "status": "error",
             "message": "An unexpected error occurred."
         }
-        return render_template("delete_data.html", message=message)
+        return _render_message("delete_data.html", message)
+
+
+#Route for batch key-value operations
+#Accepts a JSON body {"operations": [{"op": "store|retrieve|update|delete", "key": ..., "value": ...}, ...]}
+#All keys are resolved up front and every change is committed in a single transaction
+@app.route("/api/data/batch", methods=["POST"])
+def batch_data():
+    try:
+        if 'access_token' not in session:
+            return redirect(url_for('login'))
+
+        if g.token_error is not None:
+            print(f"Token decoding error: {str(g.token_error)}")
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_TOKEN",
+                "message": "Invalid access token provided."
+            }), 401
+        current_user_id = g.current_user_id
+
+        payload = request.get_json(silent=True)
+        operations = payload.get('operations') if isinstance(payload, dict) else None
+        if not isinstance(operations, list) or not operations:
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_REQUEST",
+                "message": "Invalid request. Please provide a non-empty list of operations."
+            }), 400
+
+        if len(operations) > app.config['DATA_BATCH_MAX_OPERATIONS']:
+            return jsonify({
+                "status": "error",
+                "code": "BATCH_TOO_LARGE",
+                "message": f"A batch may contain at most {app.config['DATA_BATCH_MAX_OPERATIONS']} operations."
+            }), 400
+
+        # Resolve every key touched by the batch up front
+        keys = {op['key'].strip() for op in operations
+                if isinstance(op, dict) and isinstance(op.get('key'), str) and op['key'].strip()}
+        results, values = data_storage.apply(current_user_id, keys,
+                                             lambda values: _apply_batch(operations, values))
+
+        # Keep the cache in step with what was committed
+        for result in results:
+            if result['status'] != "success" or result['op'] == "retrieve":
+                continue
+            _invalidate_value(current_user_id, result['key'])
+
+        return jsonify({
+            "status": "success",
+            "message": "Batch processed successfully.",
+            "data": {
+                "results": results
+            }
+        }), 200
+
+    except StorageBusy:
+        return _service_busy_response()
+    except Exception as e:
+        print(f"Unexpected error occurred: {str(e)}")
+        return jsonify({
+            "status": "error",
+            "message": "An unexpected error occurred."
+        }), 500
+
+
+def _apply_batch(operations, values):
+    #Applies the operations in order to values, the {key: value} dict of the batch's existing keys
+    results = []
+    for index, op in enumerate(operations):
+        result = _apply_batch_operation(op, values)
+        result['index'] = index
+        results.append(result)
+    return results
+
+
+def _apply_batch_operation(op, values):
+    #Applies one batch operation; values is updated in place so later operations see earlier ones
+    if not isinstance(op, dict) or op.get('op') not in BATCH_OPERATIONS:
+        return {
+            "status": "error",
+            "code": "INVALID_OPERATION",
+            "message": "Operation must be one of: store, retrieve, update, delete."
+        }
+
+    action = op['op']
+    key = op.get('key')
+    if not isinstance(key, str) or not key.strip():
+        return {
+            "op": action,
+            "status": "error",
+            "code": "INVALID_KEY",
+            "message": "The provided key is not valid or missing."
+        }
+    key = key.strip()
+
+    value = op.get('value')
+    if action in ("store", "update") and (not isinstance(value, str) or not value.strip()):
+        return {
+            "op": action,
+            "key": key,
+            "status": "error",
+            "code": "INVALID_VALUE",
+            "message": "The provided value is not valid or missing."
+        }
+
+    if action == "store":
+        if key in values:
+            return {
+                "op": action,
+                "key": key,
+                "status": "error",
+                "code": "KEY_EXISTS",
+                "message": "The provided key already exists in the database. To update an existing key, use the update API."
+            }
+        values[key] = value.strip()
+        return {"op": action, "key": key, "status": "success", "message": "Data stored successfully."}
+
+    if key not in values:
+        return {
+            "op": action,
+            "key": key,
+            "status": "error",
+            "code": "KEY_NOT_FOUND",
+            "message": "The provided key does not exist in the database."
+        }
+
+    if action == "retrieve":
+        return {
+            "op": action,
+            "key": key,
+            "status": "success",
+            "message": "Data retrieved successfully!",
+            "data": {
+                "key": key,
+                "value": values[key]
+            }
+        }
+
+    if action == "update":
+        values[key] = value.strip()
+        return {"op": action, "key": key, "status": "success", "message": "Data updated successfully."}
+
+    del values[key]
+    return {"op": action, "key": key, "status": "success", "message": "Data deleted successfully."}
+
+
+#Route for listing a user's keys in key order
+#Query parameters: prefix, limit, cursor (from next_cursor of the previous page) and values=1 to include values
+#Pages are found by key (keyset pagination), so every page costs the same however deep it is
+@app.route("/api/data/keys", methods=["GET"])
+def list_keys():
+    try:
+        if 'access_token' not in session:
+            return redirect(url_for('login'))
+
+        if g.token_error is not None:
+            print(f"Token decoding error: {str(g.token_error)}")
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_TOKEN",
+                "message": "Invalid access token provided."
+            }), 401
+        current_user_id = g.current_user_id
+
+        prefix = request.args.get('prefix', '')
+        with_values = request.args.get('values') in ('1', 'true')
+
+        try:
+            limit = int(request.args.get('limit', app.config['DATA_LIST_DEFAULT_LIMIT']))
+        except ValueError:
+            limit = 0
+        if limit <= 0 or limit > app.config['DATA_LIST_MAX_LIMIT']:
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_LIMIT",
+                "message": f"Limit must be an integer between 1 and {app.config['DATA_LIST_MAX_LIMIT']}."
+            }), 400
+
+        after = None
+        if request.args.get('cursor'):
+            try:
+                after = _decode_cursor(request.args['cursor'])
+            except ValueError:
+                return jsonify({
+                    "status": "error",
+                    "code": "INVALID_CURSOR",
+                    "message": "The provided cursor is not valid."
+                }), 400
+
+        # One extra row tells whether there is another page
+        rows = data_storage.scan(current_user_id, prefix, after, limit + 1, with_values)
+        page = rows[:limit]
+        next_cursor = _encode_cursor(page[-1][0]) if len(rows) > limit else None
+
+        if with_values:
+            keys = [{"key": key, "value": value} for key, value in page]
+        else:
+            keys = [key for key, _ in page]
+
+        return jsonify({
+            "status": "success",
+            "message": "Keys listed successfully.",
+            "data": {
+                "keys": keys,
+                "next_cursor": next_cursor
+            }
+        }), 200
+
+    except Exception as e:
+        print(f"Unexpected error occurred: {str(e)}")
+        return jsonify({
+            "status": "error",
+            "message": "An unexpected error occurred."
+        }), 500
+
+
+#Route for exporting all of a user's data as NDJSON, one {"key": ..., "value": ...} object per line
+#Rows are streamed page by page in key order, so memory use does not grow with the data
+@app.route("/api/data/export", methods=["GET"])
+def export_data():
+    try:
+        if 'access_token' not in session:
+            return redirect(url_for('login'))
+
+        if g.token_error is not None:
+            print(f"Token decoding error: {str(g.token_error)}")
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_TOKEN",
+                "message": "Invalid access token provided."
+            }), 401
+        current_user_id = g.current_user_id
+
+        chunk_size = app.config['DATA_EXPORT_CHUNK_SIZE']
+
+        def generate():
+            # Pages are read by key as the stream is consumed, so no read is held open in between
+            #The stream outlives the request, so each page is read in an app context of its own, whose
+            #teardown gives the connection back
+            after = None
+            while True:
+                with app.app_context():
+                    rows = data_storage.scan(current_user_id, after=after, limit=chunk_size, with_values=True)
+                for key, value in rows:
+                    yield json.dumps({"key": key, "value": value}, separators=(',', ':')) + "\n"
+                if len(rows) < chunk_size:
+                    break
+                after = rows[-1][0]
+
+        return Response(generate(), mimetype="application/x-ndjson",
+                        headers={"Content-Disposition": "attachment; filename=data.ndjson"})
+
+    except Exception as e:
+        print(f"Unexpected error occurred: {str(e)}")
+        return jsonify({
+            "status": "error",
+            "message": "An unexpected error occurred."
+        }), 500
+
+
+#Route for importing NDJSON produced by the export route
+#The body is read line by line and committed in batches; existing keys are reported as KEY_EXISTS
+@app.route("/api/data/import", methods=["POST"])
+def import_data():
+    try:
+        if 'access_token' not in session:
+            return redirect(url_for('login'))
+
+        if g.token_error is not None:
+            print(f"Token decoding error: {str(g.token_error)}")
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_TOKEN",
+                "message": "Invalid access token provided."
+            }), 401
+        current_user_id = g.current_user_id
+
+        batch_size = app.config['DATA_IMPORT_BATCH_SIZE']
+        max_errors = app.config['DATA_IMPORT_MAX_REPORTED_ERRORS']
+        imported = 0
+        conflicts = 0
+        invalid = 0
+        errors = []
+
+        def report(line, code, message, key=None):
+            if len(errors) < max_errors:
+                error = {"line": line, "code": code, "message": message}
+                if key is not None:
+                    error["key"] = key
+                errors.append(error)
+
+        def flush(items):
+            nonlocal imported, conflicts
+            skipped = data_storage.put_many(current_user_id, [(key, value) for _, key, value in items])
+            imported += len(items) - len(skipped)
+            conflicts += len(skipped)
+            for position in skipped:
+                line, key, _ = items[position]
+                report(line, "KEY_EXISTS", "The provided key already exists in the database.", key)
+
+        items = []
+        for line_number, line in enumerate(request.stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if not isinstance(record, dict):
+                invalid += 1
+                report(line_number, "INVALID_REQUEST", "Each line must be a JSON object with key and value.")
+                continue
+
+            key = record.get('key')
+            value = record.get('value')
+            if not isinstance(key, str) or not key.strip():
+                invalid += 1
+                report(line_number, "INVALID_KEY", "The provided key is not valid or missing.")
+                continue
+            if not isinstance(value, str) or not value.strip():
+                invalid += 1
+                report(line_number, "INVALID_VALUE", "The provided value is not valid or missing.", key.strip())
+                continue
+
+            items.append((line_number, key.strip(), value.strip()))
+            if len(items) >= batch_size:
+                flush(items)
+                items = []
+        if items:
+            flush(items)
+
+        return jsonify({
+            "status": "success",
+            "message": "Data imported successfully.",
+            "data": {
+                "imported": imported,
+                "conflicts": conflicts,
+                "invalid": invalid,
+                "errors": errors,
+                "errors_truncated": conflicts + invalid > len(errors)
+            }
+        }), 200
+
+    except StorageBusy:
+        return _service_busy_response()
+    except Exception as e:
+        print(f"Unexpected error occurred: {str(e)}")
+        return jsonify({
+            "status": "error",
+            "message": "An unexpected error occurred."
+        }), 500
+
+
+#Routes for large values: PUT streams the request body into chunks, GET streams it back and honours
+#Range (a single byte range) and If-Range, DELETE removes it. The key is a query parameter.
+@app.route("/api/data/blob", methods=["PUT"])
+def upload_blob():
+    try:
+        if 'access_token' not in session:
+            return redirect(url_for('login'))
+
+        if g.token_error is not None:
+            print(f"Token decoding error: {str(g.token_error)}")
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_TOKEN",
+                "message": "Invalid access token provided."
+            }), 401
+        current_user_id = g.current_user_id
+
+        key = (request.args.get('key') or '').strip()
+        if not key:
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_KEY",
+                "message": "The provided key is not valid or missing."
+            }), 400
+
+        max_bytes = app.config['BLOB_MAX_BYTES']
+        if request.content_length is not None and request.content_length > max_bytes:
+            return _blob_too_large_response()
+
+        size, etag = blob_store.write(current_user_id, key, request.stream, max_bytes)
+        response = jsonify({
+            "status": "success",
+            "message": "Data stored successfully.",
+            "data": {"key": key, "size": size}
+        })
+        response.set_etag(etag)
+        return response, 201
+
+    except StorageBusy:
+        return _service_busy_response()
+    except BlobTooLarge:
+        return _blob_too_large_response()
+    except BlobAbandoned:
+        return jsonify({
+            "status": "error",
+            "code": "UPLOAD_TIMEOUT",
+            "message": "The upload stalled for too long and was discarded. Please upload the value again."
+        }), 408
+    except Exception as e:
+        print(f"Unexpected error occurred: {str(e)}")
+        return jsonify({
+            "status": "error",
+            "message": "An unexpected error occurred."
+        }), 500
+
+
+@app.route("/api/data/blob", methods=["GET"])
+def download_blob():
+    try:
+        if 'access_token' not in session:
+            return redirect(url_for('login'))
+
+        if g.token_error is not None:
+            print(f"Token decoding error: {str(g.token_error)}")
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_TOKEN",
+                "message": "Invalid access token provided."
+            }), 401
+        current_user_id = g.current_user_id
+
+        blob = blob_store.stat(current_user_id, request.args.get('key', ''))
+        if blob is None:
+            return jsonify({
+                "status": "error",
+                "code": "KEY_NOT_FOUND",
+                "message": "The provided key does not exist in the database."
+            }), 404
+        size, etag = blob[1], blob[3]
+
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        # A Range is ignored, and the whole value sent, unless If-Range is absent or names this version
+        # Blobs have no modification time, so an If-Range date never matches
+        byte_range = request.range
+        if byte_range is not None and 'If-Range' in request.headers and request.if_range.etag != etag:
+            byte_range = None
+        start, stop, status = 0, size, 200
+        if byte_range is not None and len(byte_range.ranges) == 1:
+            bounds = byte_range.range_for_length(size)
+            if bounds is None:
+                return jsonify({
+                    "status": "error",
+                    "code": "INVALID_RANGE",
+                    "message": "The requested range is outside the stored value."
+                }), 416, {"Content-Range": f"bytes */{size}"}
+            start, stop = bounds
+            status = 206
+
+        # The chunks are read as the body is sent, inside the request's context
+        # If the blob is replaced meanwhile, BlobChanged drops the connection rather than end the body short
+        response = Response(stream_with_context(blob_store.read(blob, start, stop)), status=status,
+                            mimetype="application/octet-stream")
+        response.content_length = stop - start
+        response.accept_ranges = "bytes"
+        if status == 206:
+            response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        response.set_etag(etag)
+        return response
+
+    except Exception as e:
+        print(f"Unexpected error occurred: {str(e)}")
+        return jsonify({
+            "status": "error",
+            "message": "An unexpected error occurred."
+        }), 500
+
+
+@app.route("/api/data/blob", methods=["DELETE"])
+def delete_blob():
+    try:
+        if 'access_token' not in session:
+            return redirect(url_for('login'))
+
+        if g.token_error is not None:
+            print(f"Token decoding error: {str(g.token_error)}")
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_TOKEN",
+                "message": "Invalid access token provided."
+            }), 401
+
+        if not blob_store.delete(g.current_user_id, request.args.get('key', '')):
+            return jsonify({
+                "status": "error",
+                "code": "KEY_NOT_FOUND",
+                "message": "The provided key does not exist in the database."
+            }), 404
+        return jsonify({
+            "status": "success",
+            "message": "Data deleted successfully."
+        }), 200
+
+    except StorageBusy:
+        return _service_busy_response()
+    except Exception as e:
+        print(f"Unexpected error occurred: {str(e)}")
+        return jsonify({
+            "status": "error",
+            "message": "An unexpected error occurred."
+        }), 500
+
+
+#Route for atomically adding to an integer value
+#Send a negative delta to decrement
+@app.route("/api/data/increment", methods=["POST"])
+def increment_data():
+    try:
+        if 'access_token' not in session:
+            return redirect(url_for('login'))
+
+        if g.token_error is not None:
+            print(f"Token decoding error: {str(g.token_error)}")
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_TOKEN",
+                "message": "Invalid access token provided."
+            }), 401
+        current_user_id = g.current_user_id
+
+        key = request.form.get('key', '').strip()
+        if not key:
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_KEY",
+                "message": "The provided key is not valid or missing."
+            }), 400
+        try:
+            delta = int(request.form.get('delta', '1'))
+        except ValueError:
+            delta = None
+        if delta is None or not INTEGER_MIN <= delta <= INTEGER_MAX:
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_DELTA",
+                "message": "The delta must be a whole number."
+            }), 400
+
+        try:
+            result = data_storage.increment(current_user_id, key, delta)
+        except NotAnInteger:
+            return jsonify({
+                "status": "error",
+                "code": "VALUE_NOT_INTEGER",
+                "message": "The stored value is not an integer, or the result would not fit in 64 bits."
+            }), 409
+        if result is None:
+            return jsonify({
+                "status": "error",
+                "code": "KEY_NOT_FOUND",
+                "message": "The provided key does not exist in the database."
+            }), 404
+        _invalidate_value(current_user_id, key)
+        value, version = result
+
+        return jsonify({
+            "status": "success",
+            "message": "Data updated successfully.",
+            "data": {
+                "key": key,
+                "value": value,
+                "version": version
+            }
+        }), 200
+
+    except StorageBusy:
+        return _service_busy_response()
+    except Exception as e:
+        print(f"Unexpected error occurred: {str(e)}")
+        return jsonify({
+            "status": "error",
+            "message": "An unexpected error occurred."
+        }), 500
+
+
+#Route for compare-and-swap: replaces the value only if the key is still at the given version,
+#as returned by retrieve, increment or an earlier swap
+@app.route("/api/data/cas", methods=["POST"])
+def compare_and_swap_data():
+    try:
+        if 'access_token' not in session:
+            return redirect(url_for('login'))
+
+        if g.token_error is not None:
+            print(f"Token decoding error: {str(g.token_error)}")
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_TOKEN",
+                "message": "Invalid access token provided."
+            }), 401
+        current_user_id = g.current_user_id
+
+        key = request.form.get('key', '').strip()
+        value = request.form.get('value', '').strip()
+        if not key:
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_KEY",
+                "message": "The provided key is not valid or missing."
+            }), 400
+        if not value:
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_VALUE",
+                "message": "The provided value is not valid or missing."
+            }), 400
+        version = request.form.get('version', '').strip()
+        if not version.isdigit():
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_VERSION",
+                "message": "The expected version must be a positive whole number."
+            }), 400
+
+        try:
+            new_version = data_storage.compare_and_swap(current_user_id, key, value, int(version))
+        except VersionConflict as conflict:
+            return jsonify({
+                "status": "error",
+                "code": "VERSION_CONFLICT",
+                "message": "The key has been changed since that version. Retrieve it again before updating.",
+                "data": {
+                    "key": key,
+                    "version": conflict.version
+                }
+            }), 409
+        if new_version is None:
+            return jsonify({
+                "status": "error",
+                "code": "KEY_NOT_FOUND",
+                "message": "The provided key does not exist in the database."
+            }), 404
+        _invalidate_value(current_user_id, key)
+
+        response = jsonify({
+            "status": "success",
+            "message": "Data updated successfully.",
+            "data": {
+                "key": key,
+                "version": new_version
+            }
+        })
+        response.set_etag(value_etag(value))
+        return response
+
+    except StorageBusy:
+        return _service_busy_response()
+    except Exception as e:
+        print(f"Unexpected error occurred: {str(e)}")
+        return jsonify({
+            "status": "error",
+            "message": "An unexpected error occurred."
+        }), 500
 
 
+#Route for watching keys: answers with the changes to a key (key=), the keys under a prefix (prefix=) or all
+#of the user's keys made after the sequence number since=, oldest first
+#Without since it starts from now. A long poll waits up to timeout seconds for a change and returns
+#{"changes": [...], "next": ...}; pass next as since to go on. With Accept: text/event-stream the changes
+#are sent as events whose id is their sequence number, and a reconnecting client resumes from Last-Event-ID.
+#Changes older than CHANGE_FEED_RETENTION_SECONDS are compacted away; resuming from before them is a 410.
+#A long poll with nothing to answer yet, and every event stream, is redirected (307) to the notifier, which
+#serves this same route and waits there.
+@app.route("/api/data/watch", methods=["GET"])
+def watch_data():
+    try:
+        if 'access_token' not in session:
+            return redirect(url_for('login'))
+
+        if g.token_error is not None:
+            print(f"Token decoding error: {str(g.token_error)}")
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_TOKEN",
+                "message": "Invalid access token provided."
+            }), 401
+        current_user_id = g.current_user_id
+
+        if change_feed is None:
+            return jsonify({
+                "status": "error",
+                "code": "CHANGE_FEED_DISABLED",
+                "message": "Watching keys is not enabled on this server."
+            }), 404
+
+        key = request.args.get('key', '').strip() or None
+        prefix = request.args.get('prefix', '')
+        stream = request.accept_mimetypes.best_match(["application/json", "text/event-stream"]) == "text/event-stream"
+        since = request.headers.get('Last-Event-ID') if stream else None
+        since = since or request.args.get('since')
+        if since is not None and not since.isdigit():
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_SEQUENCE",
+                "message": "The sequence number to watch from must be a whole number."
+            }), 400
+
+        max_wait = app.config['CHANGE_FEED_LONG_POLL_SECONDS']
+        try:
+            timeout = float(request.args.get('timeout', max_wait))
+        except ValueError:
+            timeout = -1
+        if not 0 <= timeout <= max_wait:
+            return jsonify({
+                "status": "error",
+                "code": "INVALID_TIMEOUT",
+                "message": f"The timeout must be between 0 and {max_wait} seconds."
+            }), 400
+
+        since = int(since) if since is not None else change_feed.head()
+        page_size = app.config['CHANGE_FEED_PAGE_SIZE']
+        try:
+            # The first page is read here, so a bad since is answered before any response is started
+            changes, cursor = change_feed.read(current_user_id, since, key, prefix, page_size)
+        except ChangesExpired as expired:
+            return jsonify({
+                "status": "error",
+                "code": "CHANGES_EXPIRED",
+                "message": "Changes after that sequence number are no longer kept. Retrieve the keys again and "
+                           "watch without since.",
+                "data": {
+                    "oldest": expired.oldest
+                }
+            }), 410
+
+        if not stream and (changes or timeout == 0):
+            return jsonify({
+                "status": "success",
+                "message": "Changes retrieved successfully.",
+                "data": {
+                    "changes": changes,
+                    "next": cursor
+                }
+            }), 200
+
+        # Waiting is left to the notifier, which does not hold a thread for it
+        watch = request.environ.get('dpd.watch')
+        if watch is None:
+            return redirect(_notifier_url(), code=307)
+        try:
+            change_feed.acquire()
+        except TooManyWatchers:
+            return _service_busy_response()
+        # The notifier writes the body from here on and gives the slot back when it is done
+        watch.update(user_id=current_user_id, changes=changes, cursor=cursor, timeout=timeout, stream=stream,
+                     read=lambda after: change_feed.read(current_user_id, after, key, prefix, page_size))
+        if stream:
+            return Response(mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+        return Response(mimetype="application/json")
+
+    except Exception as e:
+        print(f"Unexpected error occurred: {str(e)}")
+        return jsonify({
+            "status": "error",
+            "message": "An unexpected error occurred."
+        }), 500
+
+
+def _notifier_url():
+    #Where watch_data sends the watches that wait: CHANGE_FEED_NOTIFIER_URL, or this host's notifier port
+    base = app.config['CHANGE_FEED_NOTIFIER_URL']
+    if not base:
+        host = urlsplit(f"//{request.host}").hostname
+        if ':' in host:
+            host = f"[{host}]"
+        base = f"{request.scheme}://{host}:{app.config['CHANGE_FEED_NOTIFIER_PORT']}"
+    return base.rstrip('/') + request.full_path
+
 
 #Route for logging out
 @app.route("/api/logout")
@@ -571,7 +1979,98 @@ def logout():
 
 
 
+#Command to rebuild the data table of an existing database to the current schema
+#With DATA_STORAGE=sharded the data table of every shard file is rebuilt too
+#Usage: flask --app app migrate-data [--batch-size N] [--pause SECONDS]
+@app.cli.command("migrate-data")
+@click.option("--batch-size", default=10000, help="Rows copied per transaction.")
+@click.option("--pause", default=0.05, help="Seconds to sleep between batches so other writers get the lock.")
+def migrate_data(batch_size, pause):
+    db.create_all()
+    rebuild_table(db.engine, Data.__table__, batch_size=batch_size, pause=pause, log=click.echo)
+    if isinstance(data_storage, ShardedStorage):
+        for index, engine in enumerate(data_storage.engines):
+            click.echo(f"Shard {index}")
+            rebuild_table(engine, Data.__table__, batch_size=batch_size, pause=pause, log=click.echo)
+
+
+#Command to move a user's data to another shard while the app keeps serving (DATA_STORAGE=sharded)
+#Writes for that user are answered with SERVICE_BUSY for the duration of the move
+#Usage: flask --app app move-user-shard USER_ID SHARD [--grace 1.0] [--batch-size 1000]
+@app.cli.command("move-user-shard")
+@click.argument("user_id", type=int)
+@click.argument("shard", type=int)
+@click.option("--grace", default=1.0, help="Seconds to wait for in-flight writes before copying.")
+@click.option("--batch-size", default=1000, help="Rows copied per transaction.")
+def move_user_shard(user_id, shard, grace, batch_size):
+    if not isinstance(data_storage, ShardedStorage):
+        raise click.UsageError("move-user-shard requires DATA_STORAGE=sharded")
+    if not 0 <= shard < len(data_storage.shards):
+        raise click.BadParameter(f"shard must be between 0 and {len(data_storage.shards) - 1}")
+    db.create_all()
+    copied = data_storage.move_user(user_id, shard, _set_user_shard, grace=grace, batch_size=batch_size,
+                                    log=click.echo)
+    click.echo(f"User {user_id} is on shard {shard} ({copied} rows copied)")
+
+
+#Command to record every user's current shard in the catalog, so DATA_SHARDS can be raised
+#Usage: flask --app app pin-user-shards
+@app.cli.command("pin-user-shards")
+def pin_user_shards():
+    db.create_all()
+    user_ids = db.session.execute(
+        db.select(User.id).where(~User.id.in_(db.select(UserShard.user_id)))
+    ).scalars().all()
+    for user_id in user_ids:
+        _set_user_shard(user_id, default_shard(user_id, app.config['DATA_SHARDS']), False)
+    click.echo(f"Pinned {len(user_ids)} users")
+
+
+#Command to rewrite stored values with the current DATA_COMPRESSION setting and report the space saved
+#In dictionary mode each user's dictionary is trained again on a sample of their values first
+#Usage: flask --app app recompress-data [--batch-size 1000] [--user-id ID]
+@app.cli.command("recompress-data")
+@click.option("--batch-size", default=1000, help="Rows rewritten per transaction.")
+@click.option("--user-id", type=int, default=None, help="Only recompress this user's values.")
+def recompress_data(batch_size, user_id):
+    if not isinstance(data_storage, (SqlAlchemyStorage, ShardedStorage)):
+        raise click.UsageError("recompress-data requires DATA_STORAGE=sqlalchemy or sharded")
+    db.create_all()
+    total_rows = total_before = total_after = 0
+    for current_user_id in [user_id] if user_id is not None else data_storage.user_ids():
+        if value_codec.mode == "dictionary":
+            samples = data_storage.scan(current_user_id, limit=app.config['DATA_COMPRESSION_DICTIONARY_SAMPLES'],
+                                        with_values=True)
+            value_codec.train(current_user_id, [value for _, value in samples])
+        try:
+            rows, before, after = data_storage.recompress(current_user_id, batch_size)
+        except StorageBusy:
+            click.echo(f"User {current_user_id} is being moved to another shard, skipped")
+            continue
+        click.echo(f"User {current_user_id}: {rows} rows, {before} -> {after} bytes")
+        total_rows += rows
+        total_before += before
+        total_after += after
+    saved = total_before - total_after
+    percent = 100 * saved / total_before if total_before else 0
+    click.echo(f"Recompressed {total_rows} rows: {total_before} -> {total_after} bytes "
+               f"({saved} bytes saved, {percent:.1f}%)")
+
+
+#Command to pick a bcrypt cost for this host
+#Usage: flask --app app calibrate-bcrypt [--target-ms 250]
+@app.cli.command("calibrate-bcrypt")
+@click.option("--target-ms", default=250.0, help="Longest acceptable time for one hash, in milliseconds.")
+def calibrate_bcrypt(target_ms):
+    rounds, elapsed_ms = calibrate_rounds(target_ms)
+    click.echo(f"BCRYPT_ROUNDS={rounds} ({elapsed_ms:.0f} ms per hash on this host)")
+
+
+#Development server with the reloader and debugger; production runs under gunicorn (gunicorn.conf.py)
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+    # Under the reloader, only the child process that serves requests runs the notifier
+    if watch_notifier is not None and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        watch_notifier.start()
     app.run(debug=True)
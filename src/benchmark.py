@@ -0,0 +1,398 @@
+#Load and latency benchmark for every route
+#
+#Seeds a fresh database (N users x M keys), starts the app on a local port with the production
+#settings in gunicorn.conf.py, drives each route at a fixed concurrency and writes throughput and
+#p50/p95/p99 latency per route as JSON. Admission control is off unless ADMISSION_ENABLED=1 is set;
+#either way 429 and 503 answers are counted as shed, apart from errors.
+#
+#    # From the src directory
+#    python benchmark.py run --users 10 --keys 1000 --concurrency 8 --requests 400 --output results.json
+#
+#    # Exit with code 1 when a route is more than 20% worse than a stored baseline
+#    python benchmark.py run --baseline baseline.json --threshold 0.2
+#    python benchmark.py compare baseline.json results.json --threshold 0.2
+import argparse
+import json
+import math
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+BENCH_PASSWORD = "Bench@123"
+BLOB_VALUE = os.urandom(64 * 1024)
+TOKEN_PATTERN = re.compile(r"Access Token: <p>([^<]+)</p>")
+
+
+#Seeds the database; run as a subprocess by run_benchmark before it starts the server
+def seed_database(users, keys):
+    from app import app, db, User, data_storage, password_hasher
+
+    with app.app_context():
+        db.create_all()
+        password = password_hasher.hash(BENCH_PASSWORD, app.config['BCRYPT_ROUNDS'])
+        db.session.execute(db.insert(User), [{
+            "username": f"bench{user}",
+            "email": f"bench{user}@example.com",
+            "password": password,
+            "full_name": "Bench User",
+            "age": 30,
+            "gender": "Other"
+        } for user in range(users)])
+        db.session.commit()
+        # Keys go through the storage so every DATA_STORAGE backend is seeded
+        user_ids = [user.id for user in User.query.order_by(User.id)]
+        for user_id in user_ids:
+            for start in range(0, keys, 10000):
+                data_storage.put_many(user_id, [
+                    (f"key{index}", f"value{index}") for index in range(start, min(start + 10000, keys))
+                ])
+    # Writes the memory storage's snapshot and closes the log storage's segments for the server
+    data_storage.close()
+
+
+#Each scenario sends one request for a worker: (session, worker, iteration, context) -> response
+def _index(http, worker, iteration, context):
+    return http.get(context["url"] + "/")
+
+def _register(http, worker, iteration, context):
+    name = f"new{worker}x{iteration}"
+    return http.post(context["url"] + "/api/register", data={
+        "username": name, "email": f"{name}@example.com", "password": BENCH_PASSWORD,
+        "full_name": "Bench User", "age": "30", "gender": "Other"
+    })
+
+def _generate_token(http, worker, iteration, context):
+    return http.post(context["url"] + "/api/token", data={
+        "username": context["username"][worker], "password": BENCH_PASSWORD
+    })
+
+def _login(http, worker, iteration, context):
+    return http.post(context["url"] + "/api/login", allow_redirects=False, data={
+        "username": context["username"][worker], "password": BENCH_PASSWORD,
+        "access_token": context["token"][worker]
+    })
+
+def _dashboard(http, worker, iteration, context):
+    return http.get(context["url"] + "/dashboard")
+
+def _store_data(http, worker, iteration, context):
+    return http.post(context["url"] + "/api/data", data={"key": f"new{worker}x{iteration}", "value": "value"})
+
+def _retrieve_data(http, worker, iteration, context):
+    key = f"key{context['random'][worker].randrange(context['keys'])}"
+    return http.get(context["url"] + "/api/data/retrieve", params={"key": key})
+
+def _update_data(http, worker, iteration, context):
+    key = f"key{context['random'][worker].randrange(context['keys'])}"
+    return http.post(context["url"] + "/api/data/update", data={"key": key, "value": f"updated{iteration}"})
+
+def _delete_data(http, worker, iteration, context):
+    # Deletes the keys written by the store_data phase
+    return http.post(context["url"] + "/api/data/delete", data={"key": f"new{worker}x{iteration}"})
+
+def _batch_data(http, worker, iteration, context):
+    rng = context["random"][worker]
+    return http.post(context["url"] + "/api/data/batch", json={"operations": [
+        {"op": "retrieve", "key": f"key{rng.randrange(context['keys'])}"} for _ in range(50)
+    ]})
+
+def _list_keys(http, worker, iteration, context):
+    return http.get(context["url"] + "/api/data/keys", params={"limit": 100})
+
+def _export_data(http, worker, iteration, context):
+    return http.get(context["url"] + "/api/data/export")
+
+def _import_data(http, worker, iteration, context):
+    body = "".join(json.dumps({"key": f"imp{worker}x{iteration}x{index}", "value": "value"}) + "\n"
+                   for index in range(100))
+    return http.post(context["url"] + "/api/data/import", data=body,
+                     headers={"Content-Type": "application/x-ndjson"})
+
+def _upload_blob(http, worker, iteration, context):
+    return http.put(context["url"] + "/api/data/blob", params={"key": f"blob{worker}x{iteration}"},
+                    data=BLOB_VALUE)
+
+def _download_blob(http, worker, iteration, context):
+    # Downloads the blobs written by the upload_blob phase
+    return http.get(context["url"] + "/api/data/blob", params={"key": f"blob{worker}x{iteration}"})
+
+def _increment_data(http, worker, iteration, context):
+    return http.post(context["url"] + "/api/data/increment", data={"key": f"counter{worker}"})
+
+def _compare_and_swap_data(http, worker, iteration, context):
+    # Each worker swaps its own key, so it always knows the current version
+    response = http.post(context["url"] + "/api/data/cas", data={
+        "key": f"cas{worker}", "value": f"swapped{iteration}", "version": str(context["version"][worker])
+    })
+    if response.status_code == 200:
+        context["version"][worker] = response.json()["data"]["version"]
+    return response
+
+def _watch_data(http, worker, iteration, context):
+    # A long poll that does not wait: the cost of reading the change feed
+    return http.get(context["url"] + "/api/data/watch", params={"timeout": 0})
+
+def _list_keys_page(http, worker, iteration, context):
+    # Walks every key with its value page by page, starting over after the last page
+    params = {"limit": 100, "values": 1}
+    if context["cursor"][worker]:
+        params["cursor"] = context["cursor"][worker]
+    response = http.get(context["url"] + "/api/data/keys", params=params)
+    if response.status_code == 200:
+        context["cursor"][worker] = response.json()["data"]["next_cursor"]
+    return response
+
+def _logout(http, worker, iteration, context):
+    return http.get(context["url"] + "/api/logout", allow_redirects=False)
+
+#Scenarios run in this order; the ones that write keys are ordered so later ones can rely on them
+SCENARIOS = [
+    ("index", _index),
+    ("register", _register),
+    ("generate_token", _generate_token),
+    ("login", _login),
+    ("dashboard", _dashboard),
+    ("store_data", _store_data),
+    ("retrieve_data", _retrieve_data),
+    ("update_data", _update_data),
+    ("delete_data", _delete_data),
+    ("batch_data", _batch_data),
+    ("list_keys", _list_keys),
+    ("export_data", _export_data),
+    ("import_data", _import_data),
+    ("upload_blob", _upload_blob),
+    ("download_blob", _download_blob),
+    ("increment_data", _increment_data),
+    ("compare_and_swap_data", _compare_and_swap_data),
+    ("watch_data", _watch_data),
+    ("list_keys_page", _list_keys_page),
+    ("logout", _logout),
+]
+
+
+#Nearest-rank percentile of an already sorted list
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+#Answers that admission control turned away (429 RATE_LIMITED, 503 SERVICE_BUSY) are counted as shed
+SHED_STATUSES = frozenset((429, 503))
+
+
+def summarise(latencies, errors, shed, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "shed": shed,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+    }
+
+
+#Returns a list of human readable regressions of current against baseline
+#A route regresses when its p95 latency grows, or its throughput drops, by more than threshold
+def compare_results(baseline, current, threshold):
+    regressions = []
+    for route, base in baseline["routes"].items():
+        result = current["routes"].get(route)
+        if result is None:
+            continue
+        if base.get("p95_ms") and result.get("p95_ms") and result["p95_ms"] > base["p95_ms"] * (1 + threshold):
+            regressions.append(f"{route}: p95 {result['p95_ms']} ms vs baseline {base['p95_ms']} ms")
+        if base.get("throughput_rps") and result.get("throughput_rps") is not None and \
+                result["throughput_rps"] < base["throughput_rps"] * (1 - threshold):
+            regressions.append(f"{route}: {result['throughput_rps']} req/s vs baseline {base['throughput_rps']} req/s")
+        if result.get("errors", 0) > base.get("errors", 0):
+            regressions.append(f"{route}: {result['errors']} errors vs baseline {base.get('errors', 0)}")
+    return regressions
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_server(url, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("benchmark server exited during startup")
+        try:
+            requests.get(url + "/", timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError("benchmark server did not start")
+
+
+def _run_scenario(fn, sessions, context, total_requests):
+    concurrency = len(sessions)
+    per_worker = [total_requests // concurrency + (1 if worker < total_requests % concurrency else 0)
+                  for worker in range(concurrency)]
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    shed = [0] * concurrency
+    barrier = threading.Barrier(concurrency + 1)
+
+    def work(worker):
+        barrier.wait()
+        for iteration in range(per_worker[worker]):
+            start = time.perf_counter()
+            status = None
+            try:
+                status = fn(sessions[worker], worker, iteration, context).status_code
+            except requests.RequestException:
+                pass
+            latencies[worker].append(time.perf_counter() - start)
+            if status in SHED_STATUSES:
+                shed[worker] += 1
+            elif status is None or status >= 400:
+                errors[worker] += 1
+
+    threads = [threading.Thread(target=work, args=(worker,)) for worker in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return summarise([value for worker in latencies for value in worker], sum(errors), sum(shed), elapsed)
+
+
+def run_benchmark(users, keys, concurrency, total_requests, seed=0, routes=None, log=print):
+    workdir = tempfile.mkdtemp(prefix="dpd-bench-")
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}"
+    src = os.path.dirname(os.path.abspath(__file__))
+    # Every storage backend keeps its files in the work directory
+    env = dict(os.environ,
+               DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.sqlite3')}",
+               DATA_SHARD_DIRECTORY=workdir,
+               LOG_STORAGE_PATH=os.path.join(workdir, "data_log"),
+               MEMORY_STORAGE_SNAPSHOT_PATH=os.path.join(workdir, "memory.json"))
+    env.setdefault("ADMISSION_ENABLED", "0")
+    subprocess.run([sys.executable, os.path.abspath(__file__), "seed", "--users", str(users), "--keys", str(keys)],
+                   cwd=src, env=env, check=True, stdout=subprocess.DEVNULL)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}"],
+        cwd=src, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        _wait_for_server(url, process)
+
+        # Every worker logs in once as one of the seeded users before the timed phases
+        sessions = [requests.Session() for _ in range(concurrency)]
+        context = {
+            "url": url,
+            "keys": keys,
+            "username": [f"bench{worker % users}" for worker in range(concurrency)],
+            "token": [],
+            "random": [random.Random(seed + worker) for worker in range(concurrency)],
+            "version": [1] * concurrency,
+            "cursor": [None] * concurrency,
+        }
+        for worker, http in enumerate(sessions):
+            response = http.post(url + "/api/token", data={
+                "username": context["username"][worker], "password": BENCH_PASSWORD
+            })
+            context["token"].append(TOKEN_PATTERN.search(response.text).group(1))
+            _login(http, worker, 0, context)
+            # The keys the increment and compare-and-swap phases change
+            http.post(url + "/api/data", data={"key": f"counter{worker}", "value": "0"})
+            http.post(url + "/api/data", data={"key": f"cas{worker}", "value": "value"})
+
+        results = {}
+        for name, fn in SCENARIOS:
+            if routes and name not in routes:
+                continue
+            results[name] = _run_scenario(fn, sessions, context, total_requests)
+            log(f"{name}: {json.dumps(results[name])}")
+
+        return {
+            "config": {
+                "users": users,
+                "keys": keys,
+                "concurrency": concurrency,
+                "requests": total_requests,
+                "seed": seed,
+                "admission": env["ADMISSION_ENABLED"] == "1",
+            },
+            "routes": results,
+        }
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for every route.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Seed a database, start the app and benchmark every route.")
+    run.add_argument("--users", type=int, default=10, help="Seeded users.")
+    run.add_argument("--keys", type=int, default=1000, help="Seeded keys per user.")
+    run.add_argument("--concurrency", type=int, default=8, help="Concurrent client threads.")
+    run.add_argument("--requests", type=int, default=400, help="Requests per route.")
+    run.add_argument("--seed", type=int, default=0, help="Random seed for key selection.")
+    run.add_argument("--route", action="append", dest="routes", help="Only benchmark this route (repeatable).")
+    run.add_argument("--output", help="Write the results JSON here instead of stdout.")
+    run.add_argument("--baseline", help="Baseline results JSON to check for regressions.")
+    run.add_argument("--threshold", type=float, default=0.2, help="Allowed regression as a fraction.")
+
+    compare = commands.add_parser("compare", help="Check results against a baseline.")
+    compare.add_argument("baseline")
+    compare.add_argument("results")
+    compare.add_argument("--threshold", type=float, default=0.2, help="Allowed regression as a fraction.")
+
+    seed_parser = commands.add_parser("seed", help=argparse.SUPPRESS)
+    seed_parser.add_argument("--users", type=int, required=True)
+    seed_parser.add_argument("--keys", type=int, required=True)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "seed":
+        seed_database(args.users, args.keys)
+        return 0
+
+    if args.command == "compare":
+        with open(args.baseline) as baseline_file, open(args.results) as results_file:
+            baseline = json.load(baseline_file)
+            results = json.load(results_file)
+    else:
+        results = run_benchmark(args.users, args.keys, args.concurrency, args.requests,
+                                seed=args.seed, routes=args.routes,
+                                log=lambda line: print(line, file=sys.stderr))
+        if args.output:
+            with open(args.output, "w") as output:
+                json.dump(results, output, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
+        if not args.baseline:
+            return 0
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    regressions = compare_results(baseline, results, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
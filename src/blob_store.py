@@ -0,0 +1,169 @@
+import hashlib
+import time
+from sqlalchemy import func
+
+
+#Raised when an upload grows past the configured maximum size
+class BlobTooLarge(Exception):
+    pass
+
+
+#Raised by read when the blob is replaced or deleted part way through, so the server drops the
+#connection instead of ending the body short of the Content-Length it already sent
+class BlobChanged(Exception):
+    pass
+
+
+#Raised by write when its incomplete blob was cleaned up because the upload stalled for too long
+class BlobAbandoned(Exception):
+    pass
+
+
+#Large values stored as fixed-size chunks, one row per chunk
+#An upload is read from the request stream one chunk at a time and every chunk is committed on its own,
+#so neither the process nor the writer holds more than one chunk at a time. The blob row is only marked
+#complete once every chunk is stored; completing it replaces the previous blob for the key in one
+#transaction, so readers see either the old value or the new one.
+#Reads fetch only the bytes of the requested range, chunk by chunk, with substr on the chunk data.
+#An upload that stops without cleaning up after itself (the process was killed) leaves an incomplete
+#blob behind; sweep_incomplete(now, limit) deletes the ones that have not had a chunk for
+#incomplete_timeout seconds, and has the sweep() signature of an ExpirySweeper.
+#run_write(fn, *args) and read_session() are the same hooks SqlAlchemyStorage takes.
+class BlobStore:
+    def __init__(self, blob_model, chunk_model, run_write, read_session, chunk_size=1024 * 1024,
+                 incomplete_timeout=3600):
+        self.blob_model = blob_model
+        self.chunk_model = chunk_model
+        self.run_write = run_write
+        self.read_session = read_session
+        self.chunk_size = chunk_size
+        self.incomplete_timeout = incomplete_timeout
+
+    def write(self, user_id, key, stream, max_bytes=None):
+        #Stores everything read from stream as the key's value; returns (size, etag)
+        blob_id = self.run_write(self._create, user_id, key)
+        try:
+            digest = hashlib.blake2b(digest_size=12)
+            size = 0
+            sequence = 0
+            while True:
+                chunk = _read_chunk(stream, self.chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise BlobTooLarge()
+                digest.update(chunk)
+                self.run_write(self._write_chunk, blob_id, sequence, chunk)
+                sequence += 1
+            etag = digest.hexdigest()
+            self.run_write(self._complete, blob_id, user_id, key, size, etag)
+            return size, etag
+        except BaseException:
+            # The client went away or the upload was refused: drop what was stored so far
+            self.run_write(self._delete_blobs, [blob_id])
+            raise
+
+    def stat(self, user_id, key):
+        #Returns (blob id, size, chunk size, etag) of the key's complete blob, or None
+        Blob = self.blob_model
+        with self.read_session() as session:
+            row = session.query(Blob.id, Blob.size, Blob.chunk_size, Blob.etag) \
+                .filter_by(user_id=user_id, key=key, complete=True).first()
+        return None if row is None else tuple(row)
+
+    def read(self, blob, start=0, stop=None):
+        #Yields the bytes [start, stop) of a blob returned by stat, at most one chunk at a time
+        blob_id, size, chunk_size, _ = blob
+        stop = size if stop is None else min(stop, size)
+        Chunk = self.chunk_model
+        position = start
+        while position < stop:
+            sequence, offset = divmod(position, chunk_size)
+            length = min(chunk_size - offset, stop - position)
+            with self.read_session() as session:
+                data = session.query(func.substr(Chunk.data, offset + 1, length)) \
+                    .filter_by(blob_id=blob_id, sequence=sequence).scalar()
+            if data is None:
+                raise BlobChanged()
+            yield bytes(data)
+            position += length
+
+    def delete(self, user_id, key):
+        #Returns False if the key has no blob
+        return self.run_write(self._delete, user_id, key)
+
+    def sweep_incomplete(self, now, limit):
+        #Deletes up to limit incomplete blobs without a chunk for incomplete_timeout seconds
+        return self.run_write(self._sweep_incomplete, now - self.incomplete_timeout, limit)
+
+    #Write operations, each runs in its own transaction
+    def _create(self, session, user_id, key):
+        blob = self.blob_model(user_id=user_id, key=key, size=0, chunk_size=self.chunk_size, complete=False,
+                               updated_at=time.time())
+        session.add(blob)
+        session.commit()
+        return blob.id
+
+    def _write_chunk(self, session, blob_id, sequence, data):
+        if not session.query(self.blob_model).filter_by(id=blob_id, complete=False) \
+                .update({"updated_at": time.time()}, synchronize_session=False):
+            session.rollback()
+            raise BlobAbandoned()
+        session.add(self.chunk_model(blob_id=blob_id, sequence=sequence, data=data))
+        session.commit()
+
+    def _complete(self, session, blob_id, user_id, key, size, etag):
+        Blob = self.blob_model
+        # The previous blob is only replaced if this one was not cleaned up in the meantime
+        if not session.query(Blob).filter_by(id=blob_id, complete=False) \
+                .update({"size": size, "etag": etag, "complete": True}, synchronize_session=False):
+            session.rollback()
+            raise BlobAbandoned()
+        replaced = [row.id for row in session.query(Blob.id)
+                    .filter(Blob.user_id == user_id, Blob.key == key, Blob.complete, Blob.id != blob_id)]
+        self._remove(session, replaced)
+        session.commit()
+
+    def _delete(self, session, user_id, key):
+        Blob = self.blob_model
+        blob_ids = [row.id for row in session.query(Blob.id).filter_by(user_id=user_id, key=key, complete=True)]
+        if not blob_ids:
+            return False
+        self._remove(session, blob_ids)
+        session.commit()
+        return True
+
+    def _sweep_incomplete(self, session, cutoff, limit):
+        Blob = self.blob_model
+        blob_ids = [row.id for row in session.query(Blob.id).filter(~Blob.complete, Blob.updated_at < cutoff)
+                    .order_by(Blob.updated_at).limit(limit)]
+        self._remove(session, blob_ids)
+        session.commit()
+        return len(blob_ids)
+
+    def _delete_blobs(self, session, blob_ids):
+        self._remove(session, blob_ids)
+        session.commit()
+
+    def _remove(self, session, blob_ids):
+        if not blob_ids:
+            return
+        session.query(self.chunk_model).filter(self.chunk_model.blob_id.in_(blob_ids)) \
+            .delete(synchronize_session=False)
+        session.query(self.blob_model).filter(self.blob_model.id.in_(blob_ids)) \
+            .delete(synchronize_session=False)
+
+
+#Reads up to size bytes, as request streams may return less than asked for before the end
+def _read_chunk(stream, size):
+    chunk = stream.read(size)
+    if not chunk or len(chunk) == size:
+        return chunk
+    buffer = bytearray(chunk)
+    while len(buffer) < size:
+        more = stream.read(size - len(buffer))
+        if not more:
+            break
+        buffer += more
+    return bytes(buffer)
@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+#Bounded LRU cache with an optional TTL and byte budget
+#All operations take one lock, so it is safe to share between request threads
+#on_event, if given, is called with "hit", "miss" or "eviction" as they happen
+#A reader that fills the cache from a slower store takes generation() before it reads and passes it to
+#set(since=...); the value is then dropped if its key was invalidated after the read began, so a reader
+#that lost a race with a writer never puts back the value the writer replaced. The last max_entries
+#invalidated keys are remembered for this; a set older than all of them is dropped too.
+class LRUCache:
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024, ttl=None, on_event=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.on_event = on_event or (lambda event: None)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # key -> generation of its latest invalidation, oldest first
+        self._invalidated = OrderedDict()
+        self._generation = 0
+        # The generation up to which invalidations are no longer remembered one by one
+        self._forgotten = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        #Returns the cached value or None on a miss
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                self.on_event("miss")
+                return None
+            value, size, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                self.on_event("miss")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.on_event("hit")
+            return value
+
+    def set(self, key, value, size=1, ttl=None, since=None):
+        #ttl overrides the cache wide TTL for this entry only
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            if since is not None and (self._forgotten > since or self._invalidated.get(key, 0) > since):
+                return
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size, expires_at)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+                self.on_event("eviction")
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._generation += 1
+            self._invalidated[key] = self._generation
+            self._invalidated.move_to_end(key)
+            if len(self._invalidated) > self.max_entries:
+                _, self._forgotten = self._invalidated.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._generation += 1
+            self._invalidated.clear()
+            self._forgotten = self._generation
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
@@ -0,0 +1,180 @@
+import threading
+import time
+from sqlalchemy import func
+
+
+#Raised by ChangeFeed.read when changes after the requested sequence have been compacted away
+class ChangesExpired(Exception):
+    def __init__(self, oldest):
+        super().__init__(oldest)
+        self.oldest = oldest
+
+
+#Raised by ChangeFeed.acquire when max_watchers connections are already watching
+class TooManyWatchers(Exception):
+    pass
+
+
+#A log of every write to a key, for clients that watch keys instead of polling them
+#Changes are rows of change_model (id, user_id, key, op, value, created_at). The id is the change's
+#sequence number: it is shared by all users, so a user's sequence numbers always increase but skip the
+#numbers of other users' changes. Clients resume from the last sequence number they saw.
+#Changes are added by the writes themselves: add(session, user_id, changes) inserts them in the write's
+#own transaction (see SqlAlchemyStorage's change_log) and committed(user_id, sequence) is called once
+#that transaction has been committed.
+#Watchers never hold a database connection or a thread while they wait: the notifier (notifier.py)
+#registers a listener with add_listener(fn) and compares latest(user_id) with the sequence it has seen.
+#Listeners are called by committed() in this process, and by one poller thread per process that picks up
+#the changes other processes made, every poll_interval seconds.
+#compact(now, limit) deletes changes older than retention seconds, oldest first; it has the sweep()
+#signature of an ExpirySweeper. read() answers ChangesExpired for sequence numbers it compacted past.
+#run_write(fn, *args) (for compaction) and read_session() are the hooks SqlAlchemyStorage takes; read_session()
+#must give the connection back when it exits, as the poller and watchers use it outside of requests.
+class ChangeFeed:
+    def __init__(self, change_model, run_write, read_session, retention=24 * 3600, poll_interval=1.0,
+                 max_watchers=1000):
+        self.change_model = change_model
+        self.run_write = run_write
+        self.read_session = read_session
+        self.retention = retention
+        self.poll_interval = poll_interval
+        self.max_watchers = max_watchers
+        self._lock = threading.Lock()
+        # user id -> the highest sequence number this process has seen recorded for the user
+        self._latest = {}
+        self._listeners = []
+        self._watchers = 0
+        self._polled = None
+        self._poller = None
+        self._stop = threading.Event()
+
+    def add(self, session, user_id, changes):
+        #Adds (key, op, value or None) changes for the user to the write running in session, without
+        #committing it; returns the sequence number of the last one
+        now = time.time()
+        rows = [self.change_model(user_id=int(user_id), key=key, op=op, value=value, created_at=now)
+                for key, op, value in changes]
+        session.add_all(rows)
+        session.flush()
+        return rows[-1].id
+
+    def committed(self, user_id, sequence):
+        #Wakes the user's watchers once the write that added changes up to sequence has been committed
+        self._advance({str(user_id): sequence})
+
+    def latest(self, user_id):
+        #The highest sequence number this process has seen recorded for the user, or 0
+        with self._lock:
+            return self._latest.get(str(user_id), 0)
+
+    def add_listener(self, fn):
+        #fn(user_ids) is called, on the thread that saw them, with the users that have new changes
+        self._listeners.append(fn)
+
+    def head(self):
+        #The highest sequence number recorded so far, or 0
+        with self.read_session() as session:
+            return session.query(func.max(self.change_model.id)).scalar() or 0
+
+    def read(self, user_id, since, key=None, prefix=None, limit=100):
+        #Returns (changes after since, in order, for the key or prefix if given; cursor to read on from)
+        #Each change is a dict with sequence, key, op, value and time
+        Change = self.change_model
+        with self.read_session() as session:
+            oldest = session.query(func.min(Change.id)).scalar()
+            # Compaction deletes in sequence order, so everything below the oldest row is gone
+            if oldest is not None and since < oldest - 1:
+                raise ChangesExpired(oldest - 1)
+            if self._poller is None:
+                self._note_head(session.query(func.max(Change.id)).scalar() or 0)
+            head = session.query(func.max(Change.id)).filter(Change.user_id == int(user_id), Change.id > since) \
+                .scalar()
+            rows = []
+            if head is not None:
+                query = session.query(Change.id, Change.key, Change.op, Change.value, Change.created_at) \
+                    .filter(Change.user_id == int(user_id), Change.id > since, Change.id <= head)
+                if key is not None:
+                    query = query.filter(Change.key == key)
+                elif prefix:
+                    query = query.filter(Change.key >= prefix, Change.key < prefix + '\U0010ffff',
+                                         func.substr(Change.key, 1, len(prefix)) == prefix)
+                rows = query.order_by(Change.id).limit(limit).all()
+        changes = [{"sequence": row.id, "key": row.key, "op": row.op, "value": row.value, "time": row.created_at}
+                   for row in rows]
+        # A full page resumes after its last change; otherwise every change up to head has been seen
+        if len(rows) == limit:
+            return changes, rows[-1].id
+        return changes, head if head is not None else since
+
+    def acquire(self):
+        #Takes one of the max_watchers slots for a client that is about to wait; release() gives it back
+        with self._lock:
+            if self._watchers >= self.max_watchers:
+                raise TooManyWatchers()
+            self._watchers += 1
+            self._start_poller()
+
+    def release(self):
+        with self._lock:
+            self._watchers -= 1
+
+    def compact(self, now, limit):
+        return self.run_write(self._compact, now - self.retention, limit)
+
+    def _compact(self, session, cutoff, limit):
+        Change = self.change_model
+        # The newest change is always kept, so the oldest row still marks how far compaction has gone
+        newest = session.query(func.max(Change.id)).scalar()
+        ids = [row[0] for row in session.query(Change.id).filter(Change.created_at < cutoff, Change.id < newest)
+               .order_by(Change.id).limit(limit)] if newest is not None else []
+        if ids:
+            session.query(Change).filter(Change.id.in_(ids)).delete(synchronize_session=False)
+        session.commit()
+        return len(ids)
+
+    def _advance(self, sequences):
+        #Records the latest sequence of each user in sequences and tells the listeners
+        with self._lock:
+            for user_id, sequence in sequences.items():
+                if sequence > self._latest.get(user_id, 0):
+                    self._latest[user_id] = sequence
+        for listener in self._listeners:
+            listener(list(sequences))
+
+    def stop(self):
+        #Stops the poller; listeners are only called by committed() from then on
+        self._stop.set()
+        if self._poller is not None:
+            self._poller.join()
+
+    def _note_head(self, head):
+        #Until the poller starts it is told the oldest head any read saw, so its first poll covers every
+        #change made since a watcher's read, including other processes' changes
+        with self._lock:
+            if self._poller is None and (self._polled is None or head < self._polled):
+                self._polled = head
+
+    def _start_poller(self):
+        #Called with the lock held; the poller runs from the first watch on
+        if self._poller is None:
+            self._poller = threading.Thread(target=self._poll_loop, name="change-feed-poller", daemon=True)
+            self._poller.start()
+
+    def _poll_loop(self):
+        while not self._stop.is_set():
+            try:
+                self._poll()
+            except Exception as e:
+                print(f"Change feed poll failed: {str(e)}")
+            self._stop.wait(self.poll_interval)
+
+    def _poll(self):
+        Change = self.change_model
+        with self.read_session() as session:
+            if self._polled is None:
+                self._polled = session.query(func.max(Change.id)).scalar() or 0
+            rows = session.query(Change.user_id, func.max(Change.id)).filter(Change.id > self._polled) \
+                .group_by(Change.user_id).all()
+        if rows:
+            self._polled = max(sequence for _, sequence in rows)
+            self._advance({str(user_id): sequence for user_id, sequence in rows})
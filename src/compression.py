@@ -0,0 +1,156 @@
+import re
+import struct
+import time
+import zlib
+from collections import Counter
+from cache import LRUCache
+
+
+#Transparent compression of stored values
+#Each row records the codec its value was written with, so rows written under any setting stay readable:
+#  PLAIN      the value column holds the text
+#  ZLIB       packed holds the UTF-8 text as a raw deflate stream
+#  DICTIONARY packed holds the id of one of the user's dictionaries (4 bytes) and a raw deflate stream
+#             primed with that dictionary
+#Values shorter than min_bytes, and values that would not get smaller, are always stored plain.
+#Small values barely compress on their own; a dictionary trained on the user's own values gives deflate
+#the repeated JSON fragments up front, which is what makes mode 'dictionary' worth it for them.
+#zstd would be the natural choice for trained dictionaries, but zlib's preset dictionaries (zdict) do the
+#same job with the standard library.
+
+PLAIN = 0
+ZLIB = 1
+DICTIONARY = 2
+CODEC_NAMES = {PLAIN: "plain", ZLIB: "zlib", DICTIONARY: "dictionary"}
+MODES = ("none", "zlib", "dictionary")
+
+DICTIONARY_ID = struct.Struct("<I")
+#Deflate only looks back 32 KiB, so a larger dictionary would never be used
+MAX_DICTIONARY_BYTES = 32 * 1024
+#JSON fragments: strings with the punctuation around them, and runs of anything else
+FRAGMENT = re.compile(r'[{\[,:\s]*"(?:[^"\\]|\\.)*"[}\],:\s]*|[^"]+')
+
+
+#Builds a preset dictionary from sample values
+#Fragments are ranked by the bytes they would save (occurrences times length) and the best ones are
+#placed last, where deflate reaches them with the shortest distances.
+def train_dictionary(samples, max_bytes=MAX_DICTIONARY_BYTES):
+    counts = Counter()
+    for sample in samples:
+        counts.update(set(FRAGMENT.findall(sample)))
+    fragments = [(count * len(fragment.encode('utf-8')), fragment.encode('utf-8'))
+                 for fragment, count in counts.items() if count > 1]
+    fragments.sort(reverse=True)
+
+    selected = []
+    size = 0
+    for _, fragment in fragments:
+        if size + len(fragment) > max_bytes:
+            continue
+        selected.append(fragment)
+        size += len(fragment)
+    return b"".join(reversed(selected))
+
+
+#Encodes and decodes values for the SQL storages
+#Dictionaries are rows of dictionary_model (id, user_id, data), read through read_session and written
+#through run_write like any other write. Dictionaries are immutable and cached once loaded; which one
+#is a user's newest is cached for latest_ttl seconds, so other processes pick up a retrained one.
+#observe(codec name, seconds), if given, is called for every value that had to be decompressed.
+class ValueCodec:
+    def __init__(self, dictionary_model, run_write, read_session, mode="none", min_bytes=16, level=6,
+                 observe=None, max_cached=10000, latest_ttl=300):
+        if mode not in MODES:
+            raise ValueError(f"Unknown compression mode: {mode}")
+        self.dictionary_model = dictionary_model
+        self.run_write = run_write
+        self.read_session = read_session
+        self.mode = mode
+        self.min_bytes = min_bytes
+        self.level = level
+        self.observe = observe
+        # dictionary id -> bytes, and user id -> (latest dictionary id, bytes) or None
+        self._dictionaries = LRUCache(max_entries=max_cached, max_bytes=max_cached * MAX_DICTIONARY_BYTES)
+        self._latest = LRUCache(max_entries=max_cached, max_bytes=max_cached * MAX_DICTIONARY_BYTES, ttl=latest_ttl)
+
+    def encode(self, user_id, value):
+        #Returns (codec, value column, packed column) for a value to be stored
+        raw = value.encode('utf-8')
+        if self.mode == "none" or len(raw) < self.min_bytes:
+            return PLAIN, value, None
+        codec = ZLIB
+        prefix = b""
+        dictionary = None
+        if self.mode == "dictionary":
+            latest = self.latest_dictionary(user_id)
+            if latest is not None:
+                codec = DICTIONARY
+                prefix = DICTIONARY_ID.pack(latest[0])
+                dictionary = latest[1]
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=dictionary) if dictionary \
+            else zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        packed = prefix + compressor.compress(raw) + compressor.flush()
+        if len(packed) >= len(raw):
+            return PLAIN, value, None
+        return codec, "", packed
+
+    def decode(self, codec, value, packed):
+        #The text of a stored row, given its codec, value and packed columns
+        if codec == PLAIN or codec is None:
+            return value
+        start = time.perf_counter()
+        if codec == ZLIB:
+            text = zlib.decompress(packed, -15).decode('utf-8')
+        elif codec == DICTIONARY:
+            dictionary_id = DICTIONARY_ID.unpack_from(packed)[0]
+            decompressor = zlib.decompressobj(-15, zdict=self.dictionary(dictionary_id))
+            text = (decompressor.decompress(packed[DICTIONARY_ID.size:]) + decompressor.flush()).decode('utf-8')
+        else:
+            raise ValueError(f"Unknown value codec: {codec}")
+        if self.observe is not None:
+            self.observe(CODEC_NAMES[codec], time.perf_counter() - start)
+        return text
+
+    def stored_size(self, codec, value, packed):
+        #Bytes a row's value takes in the table
+        return len(packed) if codec not in (PLAIN, None) else len(value.encode('utf-8'))
+
+    def dictionary(self, dictionary_id):
+        data = self._dictionaries.get(dictionary_id)
+        if data is None:
+            with self.read_session() as session:
+                data = session.query(self.dictionary_model.data).filter_by(id=dictionary_id).scalar()
+            if data is None:
+                raise ValueError(f"Missing compression dictionary: {dictionary_id}")
+            self._dictionaries.set(dictionary_id, data, size=len(data))
+        return data
+
+    def latest_dictionary(self, user_id):
+        #Returns (id, bytes) of the user's newest dictionary, or None
+        user_id = str(user_id)
+        latest = self._latest.get(user_id)
+        if latest is None:
+            Dictionary = self.dictionary_model
+            with self.read_session() as session:
+                row = session.query(Dictionary.id, Dictionary.data).filter_by(user_id=int(user_id)) \
+                    .order_by(Dictionary.id.desc()).first()
+            # Users without a dictionary are cached as an empty entry, so they are not looked up every write
+            latest = (row.id, row.data) if row is not None else ()
+            self._latest.set(user_id, latest, size=len(latest[1]) if latest else 1)
+        return latest or None
+
+    def train(self, user_id, samples):
+        #Stores a new dictionary trained on samples for the user's later writes; returns its id or None
+        data = train_dictionary(samples)
+        if not data:
+            return None
+        dictionary_id = self.run_write(self._write_dictionary, int(user_id), data)
+        self._dictionaries.set(dictionary_id, data, size=len(data))
+        self._latest.set(str(user_id), (dictionary_id, data), size=len(data))
+        return dictionary_id
+
+    def _write_dictionary(self, session, user_id, data):
+        dictionary = self.dictionary_model(user_id=user_id, data=data)
+        session.add(dictionary)
+        session.commit()
+        return dictionary.id
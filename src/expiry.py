@@ -0,0 +1,61 @@
+import threading
+import time
+
+
+#Deletes expired keys in the background
+#Expired keys are already invisible to reads; the sweeper only reclaims their rows. Every interval
+#seconds it deletes expired keys in batches of batch_size, oldest expiry first, one short write per
+#batch with pause seconds between batches so request writes get the writer in between. A round ends
+#with the first batch that comes back short.
+#sweep(now, limit) deletes up to limit keys expired at now and returns how many it deleted;
+#backlog(now) returns (expired keys left, oldest expiry or None). Either can be a Storage's methods.
+#observe_sweep(deleted) and observe_backlog(count, lag seconds), if given, are called after each batch
+#and each round. name is the name of the sweeper's thread.
+class ExpirySweeper:
+    def __init__(self, sweep, backlog, interval=1.0, batch_size=500, pause=0.01,
+                 observe_sweep=None, observe_backlog=None, name="expiry-sweeper"):
+        self.sweep = sweep
+        self.backlog = backlog
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.observe_sweep = observe_sweep
+        self.observe_backlog = observe_backlog
+        self.name = name
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self):
+        #Sweeps until no expired keys are left; returns the number deleted
+        swept = 0
+        while not self._stop.is_set():
+            now = time.time()
+            deleted = self.sweep(now, self.batch_size)
+            swept += deleted
+            if self.observe_sweep is not None and deleted:
+                self.observe_sweep(deleted)
+            if deleted < self.batch_size:
+                break
+            self._stop.wait(self.pause)
+        if self.observe_backlog is not None:
+            now = time.time()
+            count, oldest = self.backlog(now)
+            self.observe_backlog(count, now - oldest if oldest is not None else 0.0)
+        return swept
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Expiry sweep failed: {str(e)}")
@@ -0,0 +1,73 @@
+import os
+import tempfile
+
+
+#Production server settings; from the src directory run: gunicorn
+#The master process binds the socket, imports the app once (preload) and forks WEB_WORKERS workers
+#that share the socket, each serving WEB_THREADS requests at a time. Idle keep-alive connections are
+#held for WEB_KEEPALIVE seconds.
+#  kill -HUP <master>   starts new workers and stops the old ones once their requests finish
+#  kill -TERM <master>  stops accepting connections and exits after at most WEB_GRACEFUL_TIMEOUT seconds
+#The app is imported before the fork, so a HUP does not pick up new code; restart the master for that.
+#DATA_STORAGE=memory and log keep the data inside the serving process, so they run one worker that
+#imports the app itself.
+#For the development server with the reloader and debugger, run python app.py instead.
+
+wsgi_app = "app:app"
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', '5000')}"
+
+single_process = os.environ.get('DATA_STORAGE', 'sqlalchemy') in ('memory', 'log')
+workers = 1 if single_process else int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))
+worker_class = "gthread"
+threads = int(os.environ.get('WEB_THREADS', 8))
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+#Recycles a worker after this many requests (0 never does), spread by up to max_requests_jitter
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+preload_app = not single_process
+accesslog = "-"
+
+#With several workers /metrics must add up every worker's values, which prometheus_client only does
+#when PROMETHEUS_MULTIPROC_DIR is set before it is imported. A given directory must be empty at start.
+if workers > 1 and 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix="dpd-metrics-")
+
+
+def on_starting(server):
+    #Creates the tables once, in the master, before any worker serves a request
+    if preload_app:
+        from app import app, db
+        with app.app_context():
+            db.create_all()
+
+
+def post_worker_init(worker):
+    if not preload_app:
+        from app import app, db
+        with app.app_context():
+            db.create_all()
+    #Every worker serves the watches that wait on CHANGE_FEED_NOTIFIER_PORT, sharing it with the others
+    from app import watch_notifier
+    if watch_notifier is not None:
+        watch_notifier.start()
+
+
+def post_fork(server, worker):
+    #Connections opened by the master must not be shared with the workers; each opens its own
+    if preload_app:
+        from app import app, db, data_storage
+        from sharding import ShardedStorage
+        with app.app_context():
+            db.engine.dispose(close=False)
+        if isinstance(data_storage, ShardedStorage):
+            for engine in data_storage.engines:
+                engine.dispose(close=False)
+
+
+def child_exit(server, worker):
+    #Drops the exited worker's live gauges (requests in progress, expiry backlog) from /metrics
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,77 @@
+import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+
+
+#Raised when too many hashes are already queued; routes answer it with 503
+class HasherBusy(Exception):
+    pass
+
+
+#Runs bcrypt on a fixed size worker pool instead of on the request threads
+#bcrypt releases the GIL while hashing, so the worker threads hash in parallel.
+#At most max_pending hashes are queued or running; further calls raise HasherBusy straight away.
+#Hashes are stored base64 encoded, as they have always been in the user table.
+#observe, if given, is called with ("hash" or "check", seconds) after every bcrypt call.
+class PasswordHasher:
+    def __init__(self, workers=4, max_pending=32, observe=None):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self.seconds = 0.0
+        self.rejected = 0
+        self.observe = observe or (lambda operation, seconds: None)
+
+    def hash(self, password, rounds):
+        hashed = self._run("hash", bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(rounds))
+        return base64.b64encode(hashed).decode('utf-8')
+
+    def check(self, password, stored):
+        return self._run("check", bcrypt.checkpw, password.encode('utf-8'), base64.b64decode(stored))
+
+    def _run(self, operation, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HasherBusy()
+        try:
+            future = self._executor.submit(self._timed, operation, fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+    def _timed(self, operation, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.seconds += elapsed
+            self.observe(operation, elapsed)
+
+
+#Cost factor of a stored base64 bcrypt hash ($2b$12$... -> 12)
+def hash_rounds(stored):
+    return int(base64.b64decode(stored).split(b'$')[2])
+
+
+#Picks the highest cost whose hash takes no longer than target_ms on this host
+#Returns (rounds, measured milliseconds)
+def calibrate_rounds(target_ms, min_rounds=4, max_rounds=16):
+    best = (min_rounds, None)
+    for rounds in range(min_rounds, max_rounds + 1):
+        salt = bcrypt.gensalt(rounds)
+        start = time.perf_counter()
+        bcrypt.hashpw(b"calibration-password", salt)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if elapsed_ms > target_ms and best[1] is not None:
+            break
+        best = (rounds, elapsed_ms)
+        if elapsed_ms > target_ms:
+            break
+    return best
@@ -0,0 +1,25 @@
+import orjson
+from flask import request, current_app
+from flask.json.provider import DefaultJSONProvider
+
+
+#JSON provider backed by orjson, so jsonify responses are encoded by it too
+#Values orjson cannot encode natively fall back to Flask's default conversions
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_SORT_KEYS if kwargs.get('sort_keys', self.sort_keys) else 0
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+#True when the client prefers JSON to HTML, e.g. it sent Accept: application/json
+#Browsers, and clients that send no Accept header or */*, still get HTML
+def wants_json():
+    return request.accept_mimetypes.best_match(["text/html", "application/json"]) == "application/json"
+
+
+#The route's message dict as a compact JSON response, without rendering a template
+def json_message(message):
+    return current_app.response_class(orjson.dumps(message), mimetype="application/json")
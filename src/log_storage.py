@@ -0,0 +1,471 @@
+import bisect
+import heapq
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from storage import Storage, BatchValues, PreconditionFailed, VersionConflict, add_to_integer, select_keys, \
+    select_live_keys, due_entries
+
+
+#Append-only log-structured storage
+#Every change is appended to the active segment file as a record; a hash index maps each
+#(user_id, key) to where its latest value sits, so a write never rewrites existing data.
+#Segments are read through mmap and values are decoded straight from the mapped pages.
+#
+#Record: crc32, flags, user id length, key length, value length, the expiry time (a double, only with
+#the EXPIRES flag), the key's version (only with the VERSIONED flag, otherwise 1), then the three
+#strings in UTF-8.
+#The crc covers everything after itself. A tombstone (deleted key) has no value.
+#Records written by one call form a transaction: all but the last carry the CONTINUED flag, and
+#recovery drops a transaction whose last record never made it to disk.
+#
+#On start the index is rebuilt by replaying the segments in order; a torn or corrupt record ends its
+#segment, which is truncated there. compact() rewrites the live records of all sealed segments into
+#one new segment and deletes the old ones; with compact_interval set it runs in the background
+#whenever at least compact_min_garbage of the sealed bytes are dead.
+#The files belong to one process: run a single worker when using this storage.
+
+HEADER = struct.Struct("<IBHHI")
+EXPIRY = struct.Struct("<d")
+VERSION = struct.Struct("<Q")
+TOMBSTONE = 1
+CONTINUED = 2
+EXPIRES = 4
+VERSIONED = 8
+
+
+class _Segment:
+    def __init__(self, segment_id, path):
+        self.id = segment_id
+        self.path = path
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.live = 0
+        self.mmap = None
+        self._file = None
+
+    def view(self, end):
+        #A mapping of the segment covering at least the first end bytes
+        if self.mmap is None or len(self.mmap) < end:
+            if self._file is None:
+                self._file = open(self.path, "rb")
+            if self.mmap is not None:
+                self.mmap.close()
+            self.mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mmap
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class LogStorage(Storage):
+    def __init__(self, path, segment_bytes=64 * 1024 * 1024, fsync=True, compact_interval=60,
+                 compact_min_garbage=0.5):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.compact_min_garbage = compact_min_garbage
+        # user_id -> ({key: (segment id, value offset, value length, record length, expires_at, version)},
+        #             sorted keys)
+        self._users = {}
+        # (expires_at, user_id, key) for every key written with an expiry, earliest first
+        self._expiry_heap = []
+        self._segments = {}
+        self._active = None
+        self._active_file = None
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._compact_thread = None
+
+        os.makedirs(path, exist_ok=True)
+        self._recover()
+        if compact_interval:
+            self._compact_thread = threading.Thread(target=self._compact_loop, args=(compact_interval,),
+                                                    name="log-storage-compaction", daemon=True)
+            self._compact_thread.start()
+
+    #Storage interface
+    def get(self, user_id, key, with_meta=False):
+        with self._lock:
+            location = self._location(str(user_id), key)
+            if not location:
+                return None
+            return (self._read(location), location[4], location[5]) if with_meta else self._read(location)
+
+    def put(self, user_id, key, value, expires_at=None):
+        with self._lock:
+            if self._location(str(user_id), key):
+                return False
+            self._append([(str(user_id), key, value, expires_at, 1)])
+            return True
+
+    def update(self, user_id, key, value, check=None, expires_at=None):
+        with self._lock:
+            location = self._location(str(user_id), key)
+            if not location:
+                return False
+            if check is not None and not check(self._read(location)):
+                raise PreconditionFailed()
+            self._append([(str(user_id), key, value, expires_at if expires_at is not None else location[4],
+                           location[5] + 1)])
+            return True
+
+    def delete(self, user_id, key):
+        user_id = str(user_id)
+        with self._lock:
+            user = self._users.get(user_id)
+            if not user or key not in user[0]:
+                return False
+            live = self._location(user_id, key) is not None
+            self._append([(user_id, key, None, None, None)])
+            return live
+
+    def scan(self, user_id, prefix="", after=None, limit=None, with_values=False):
+        with self._lock:
+            user = self._users.get(str(user_id))
+            if not user:
+                return []
+            locations, keys = user
+            now = time.time()
+            selected = select_live_keys(keys, lambda key: not _expired(locations[key], now), prefix, after, limit) \
+                if self._expiry_heap else select_keys(keys, prefix, after, limit)
+            return [(key, self._read(locations[key]) if with_values else None) for key in selected]
+
+    def put_many(self, user_id, items):
+        user_id = str(user_id)
+        with self._lock:
+            seen = set()
+            records = []
+            skipped = []
+            for position, (key, value) in enumerate(items):
+                if key in seen or self._location(user_id, key):
+                    skipped.append(position)
+                    continue
+                seen.add(key)
+                records.append((user_id, key, value, None, 1))
+            self._append(records)
+            return skipped
+
+    def apply(self, user_id, keys, fn):
+        user_id = str(user_id)
+        with self._lock:
+            original = {}
+            locations = {}
+            for key in keys:
+                location = self._location(user_id, key)
+                if location:
+                    original[key] = self._read(location)
+                    locations[key] = location
+            values = BatchValues(original)
+            result = fn(values)
+
+            records = [(user_id, key, None, None, None) for key in original if key not in values]
+            for key, value in values.items():
+                if key not in original or key in values.removed:
+                    records.append((user_id, key, value, None, 1))
+                elif original[key] != value:
+                    records.append((user_id, key, value, locations[key][4], locations[key][5] + 1))
+            self._append(records)
+            return result, values
+
+    def increment(self, user_id, key, delta):
+        with self._lock:
+            location = self._location(str(user_id), key)
+            if not location:
+                return None
+            value = add_to_integer(self._read(location), delta)
+            self._append([(str(user_id), key, value, location[4], location[5] + 1)])
+            return int(value), location[5] + 1
+
+    def compare_and_swap(self, user_id, key, value, version):
+        with self._lock:
+            location = self._location(str(user_id), key)
+            if not location:
+                return None
+            if location[5] != version:
+                raise VersionConflict(location[5])
+            self._append([(str(user_id), key, value, location[4], version + 1)])
+            return version + 1
+
+    def sweep(self, now, limit):
+        #Appends tombstones for up to limit expired keys, as one transaction
+        with self._lock:
+            records = []
+            while self._expiry_heap and self._expiry_heap[0][0] <= now and len(records) < limit:
+                expires_at, user_id, key = heapq.heappop(self._expiry_heap)
+                user = self._users.get(user_id)
+                location = user[0].get(key) if user else None
+                # Entries for keys that were deleted or given a new expiry since are stale
+                if location is not None and location[4] == expires_at:
+                    records.append((user_id, key, None, None, None))
+            self._append(records)
+            return len(records)
+
+    def expiry_backlog(self, now):
+        #Looks only at the due entries of the expiry heap; stale ones are not counted, and a key that
+        #was given the same expiry again is counted once
+        with self._lock:
+            due = {}
+            for expires_at, user_id, key in due_entries(self._expiry_heap, now):
+                user = self._users.get(user_id)
+                location = user[0].get(key) if user else None
+                if location is not None and location[4] == expires_at:
+                    due[user_id, key] = expires_at
+        return len(due), min(due.values()) if due else None
+
+    def close(self):
+        self._stop.set()
+        if self._compact_thread is not None:
+            self._compact_thread.join()
+        with self._lock:
+            if self._active_file is not None:
+                self._active_file.close()
+                self._active_file = None
+            for segment in self._segments.values():
+                segment.close()
+
+    #Compaction
+    def garbage_ratio(self):
+        #The fraction of sealed segment bytes that no longer hold a live value
+        with self._lock:
+            sealed = [segment for segment in self._segments.values() if segment is not self._active]
+            total = sum(segment.size for segment in sealed)
+            return 1 - sum(segment.live for segment in sealed) / total if total else 0.0
+
+    def compact(self):
+        #Rewrites the live records of every sealed segment into one segment and deletes the old ones
+        #Returns the number of bytes reclaimed
+        with self._compact_lock:
+            with self._lock:
+                # The compacted segment takes the id after the current active segment, and writes
+                # move on to the id after that, so replaying in id order stays correct
+                self._seal()
+                output_id = self._active.id + 1
+                self._open_active(output_id + 1)
+                old_segments = sorted((segment for segment in self._segments.values()
+                                       if segment.id < output_id), key=lambda segment: segment.id)
+                old_ids = {segment.id for segment in old_segments}
+                live = [(user_id, key, location)
+                        for user_id, (locations, _) in self._users.items()
+                        for key, location in locations.items() if location[0] in old_ids]
+
+            output = _Segment(output_id, self._segment_path(output_id))
+            moved = []
+            with open(output.path, "wb") as output_file:
+                for user_id, key, location in live:
+                    with self._lock:
+                        value = self._read(location)
+                    record = self._encode(user_id, key, value, 0, location[4], location[5])
+                    value_length = location[2]
+                    moved.append((user_id, key, location,
+                                  (output_id, output.size + len(record) - value_length, value_length, len(record),
+                                   location[4], location[5])))
+                    output_file.write(record)
+                    output.size += len(record)
+                output_file.flush()
+                os.fsync(output_file.fileno())
+
+            with self._lock:
+                # Keys changed while copying keep their newer location; their copies are dead
+                for user_id, key, old_location, new_location in moved:
+                    locations = self._users[user_id][0]
+                    if locations.get(key) == old_location:
+                        locations[key] = new_location
+                        output.live += new_location[3]
+                self._segments[output_id] = output
+                reclaimed = 0
+                # Oldest first, so a tombstone is never deleted before the value it hides
+                for segment in old_segments:
+                    reclaimed += segment.size
+                    segment.close()
+                    os.remove(segment.path)
+                    del self._segments[segment.id]
+                return reclaimed - output.size
+
+    def _compact_loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                if self.garbage_ratio() >= self.compact_min_garbage:
+                    self.compact()
+            except OSError as e:
+                print(f"Log storage compaction failed: {str(e)}")
+
+    #Index and segment files
+    def _location(self, user_id, key):
+        #The location of the key's value, or None if it has none or has expired
+        user = self._users.get(user_id)
+        location = user[0].get(key) if user else None
+        return None if location is None or _expired(location, time.time()) else location
+
+    def _read(self, location):
+        segment_id, offset, length = location[:3]
+        view = self._segments[segment_id].view(offset + length)
+        return str(memoryview(view)[offset:offset + length], 'utf-8')
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.path, f"{segment_id:08d}.log")
+
+    def _encode(self, user_id, key, value, flags, expires_at=None, version=1):
+        user_bytes = user_id.encode('utf-8')
+        key_bytes = key.encode('utf-8')
+        value_bytes = b"" if value is None else value.encode('utf-8')
+        meta_bytes = b""
+        if value is None:
+            flags |= TOMBSTONE
+        else:
+            if expires_at is not None:
+                flags |= EXPIRES
+                meta_bytes += EXPIRY.pack(expires_at)
+            if version != 1:
+                flags |= VERSIONED
+                meta_bytes += VERSION.pack(version)
+        body = HEADER.pack(0, flags, len(user_bytes), len(key_bytes), len(value_bytes))[4:] \
+            + meta_bytes + user_bytes + key_bytes + value_bytes
+        return struct.pack("<I", zlib.crc32(body)) + body
+
+    def _append(self, records):
+        #Writes (user_id, key, value or None, expires_at, version) records as one transaction and points the
+        #index at them
+        if not records:
+            return
+        if self._active.size >= self.segment_bytes:
+            self._seal()
+            self._open_active(self._active.id + 1)
+
+        chunks = []
+        placed = []
+        offset = self._active.size
+        for position, (user_id, key, value, expires_at, version) in enumerate(records):
+            flags = CONTINUED if position < len(records) - 1 else 0
+            record = self._encode(user_id, key, value, flags, expires_at, version)
+            value_length = 0 if value is None else len(value.encode('utf-8'))
+            chunks.append(record)
+            placed.append((user_id, key, value, (self._active.id, offset + len(record) - value_length,
+                                                 value_length, len(record), expires_at, version)))
+            offset += len(record)
+
+        try:
+            self._active_file.write(b"".join(chunks))
+            self._active_file.flush()
+            if self.fsync:
+                os.fsync(self._active_file.fileno())
+        except BaseException:
+            self._discard_tail()
+            raise
+        self._active.size = offset
+
+        for user_id, key, value, location in placed:
+            self._index(user_id, key, None if value is None else location)
+
+    def _index(self, user_id, key, location):
+        #Points (user_id, key) at location, or removes it for a tombstone, keeping live byte counts
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = ({}, [])
+        locations, keys = user
+        previous = locations.get(key)
+        if previous is not None:
+            self._segments[previous[0]].live -= previous[3]
+        if location is None:
+            if previous is not None:
+                del locations[key]
+                del keys[bisect.bisect_left(keys, key)]
+            return
+        if previous is None:
+            bisect.insort(keys, key)
+        locations[key] = location
+        self._segments[location[0]].live += location[3]
+        if location[4] is not None and (previous is None or previous[4] != location[4]):
+            heapq.heappush(self._expiry_heap, (location[4], user_id, key))
+
+    def _seal(self):
+        if self._active_file is not None:
+            self._active_file.close()
+            self._active_file = None
+
+    def _discard_tail(self):
+        #After a failed append, cuts whatever part of it reached the file (or the file's buffer) off the
+        #active segment, so the next append starts at the size the index was built for
+        try:
+            self._active_file.close()
+        except OSError:
+            pass
+        try:
+            os.truncate(self._active.path, self._active.size)
+        except OSError:
+            # Recovery drops the torn tail of every segment, so carrying on in a new one is just as safe
+            self._active_file = None
+            self._open_active(self._active.id + 1)
+            return
+        self._active_file = open(self._active.path, "ab")
+
+    def _open_active(self, segment_id):
+        segment = self._segments.get(segment_id)
+        if segment is None:
+            segment = self._segments[segment_id] = _Segment(segment_id, self._segment_path(segment_id))
+        self._active = segment
+        self._active_file = open(segment.path, "ab")
+
+    #Crash recovery
+    def _recover(self):
+        segment_ids = sorted(int(name[:-4]) for name in os.listdir(self.path)
+                             if name.endswith(".log") and name[:-4].isdigit())
+        for segment_id in segment_ids:
+            segment = self._segments[segment_id] = _Segment(segment_id, self._segment_path(segment_id))
+            self._replay(segment)
+        self._open_active(segment_ids[-1] if segment_ids else 1)
+
+    def _replay(self, segment):
+        with open(segment.path, "rb") as segment_file:
+            data = segment_file.read()
+        offset = 0
+        committed = 0
+        pending = []
+        while offset + HEADER.size <= len(data):
+            crc, flags, user_length, key_length, value_length = HEADER.unpack_from(data, offset)
+            start = offset + HEADER.size
+            expires_at = None
+            version = 1
+            if flags & EXPIRES:
+                if start + EXPIRY.size > len(data):
+                    break
+                expires_at = EXPIRY.unpack_from(data, start)[0]
+                start += EXPIRY.size
+            if flags & VERSIONED:
+                if start + VERSION.size > len(data):
+                    break
+                version = VERSION.unpack_from(data, start)[0]
+                start += VERSION.size
+            end = start + user_length + key_length + value_length
+            if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc:
+                break
+            user_id = data[start:start + user_length].decode('utf-8')
+            key = data[start + user_length:start + user_length + key_length].decode('utf-8')
+            location = None
+            if not flags & TOMBSTONE:
+                location = (segment.id, end - value_length, value_length, end - offset, expires_at, version)
+            pending.append((user_id, key, location))
+            offset = end
+            if not flags & CONTINUED:
+                for user_id, key, location in pending:
+                    self._index(user_id, key, location)
+                pending = []
+                committed = offset
+
+        # Anything after the last complete transaction was never acknowledged
+        if committed < len(data):
+            with open(segment.path, "r+b") as segment_file:
+                segment_file.truncate(committed)
+        segment.size = committed
+
+
+def _expired(location, now):
+    return location[4] is not None and location[4] <= now
@@ -0,0 +1,152 @@
+import os
+import time
+from flask import request, g, Response, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from prometheus_client import (Counter, Histogram, Gauge, CollectorRegistry, REGISTRY,
+                               generate_latest, CONTENT_TYPE_LATEST, multiprocess)
+
+
+#Prometheus metrics for the app, served at /metrics
+#Every worker process records into its own metric values; when PROMETHEUS_MULTIPROC_DIR is set
+#(it must be set before the app starts) each process writes them to files in that directory and
+#/metrics adds up the files of all workers, so any worker can answer a scrape.
+
+REQUESTS = Counter('dpd_http_requests_total', 'HTTP requests by endpoint, method and status code.',
+                   ['endpoint', 'method', 'status'])
+REQUEST_SECONDS = Histogram('dpd_http_request_duration_seconds', 'Time to produce a response, by endpoint.',
+                            ['endpoint'])
+IN_PROGRESS = Gauge('dpd_http_requests_in_progress', 'Requests being handled, by endpoint.',
+                    ['endpoint'], multiprocess_mode='livesum')
+ERROR_CODES = Counter('dpd_http_error_codes_total', 'Error codes returned, such as KEY_EXISTS or INVALID_TOKEN.',
+                      ['endpoint', 'code'])
+BCRYPT_SECONDS = Histogram('dpd_bcrypt_seconds', 'Time spent in bcrypt, by operation.', ['operation'],
+                           buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0, 5.0))
+DB_QUERY_SECONDS = Histogram('dpd_db_query_duration_seconds', 'Time spent executing SQL statements.',
+                             buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0))
+GROUP_COMMIT_SIZE = Histogram('dpd_group_commit_size', 'Writes committed together by the SQLite group commit.',
+                              buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+GROUP_COMMIT_SECONDS = Histogram('dpd_group_commit_seconds', 'Time from a group commit\'s first write to its commit.',
+                                 buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+DECOMPRESS_SECONDS = Histogram('dpd_value_decompress_seconds', 'Time spent decompressing stored values, by codec.',
+                               ['codec'], buckets=(0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025,
+                                                   0.0005, 0.001, 0.005))
+EXPIRY_SWEPT = Counter('dpd_expiry_swept_total', 'Expired keys deleted by the expiry sweeper.')
+EXPIRY_BACKLOG = Gauge('dpd_expiry_backlog', 'Expired keys waiting for the expiry sweeper.',
+                       multiprocess_mode='livemax')
+EXPIRY_LAG_SECONDS = Gauge('dpd_expiry_lag_seconds', 'How long ago the oldest key waiting for the sweeper expired.',
+                           multiprocess_mode='livemax')
+CACHE_EVENTS = Counter('dpd_cache_events_total', 'Cache hits, misses and evictions, by cache.', ['cache', 'event'])
+
+
+#Returns an on_event callback for an LRUCache that counts its events under the given cache name
+def cache_observer(name):
+    counters = {event_name: CACHE_EVENTS.labels(name, event_name) for event_name in ("hit", "miss", "eviction")}
+
+    def observe(event_name):
+        counters[event_name].inc()
+    return observe
+
+
+#Records the error code of a route's message dict for the current request
+#Rendered templates are recorded automatically; call this for messages returned some other way
+def record_error_code(message):
+    if isinstance(message, dict) and message.get('status') == "error" and 'metrics_start' in g:
+        g.error_code = message.get('code', "UNSPECIFIED")
+
+
+#on_group_commit callback for a WALDatabase
+def observe_group_commit(size, seconds):
+    GROUP_COMMIT_SIZE.observe(size)
+    GROUP_COMMIT_SECONDS.observe(seconds)
+
+
+#observe callback for a ValueCodec
+def observe_decompression(codec, seconds):
+    DECOMPRESS_SECONDS.labels(codec).observe(seconds)
+
+
+#observe_sweep and observe_backlog callbacks for an ExpirySweeper
+def observe_expiry_sweep(swept):
+    EXPIRY_SWEPT.inc(swept)
+
+
+def observe_expiry_backlog(count, lag):
+    EXPIRY_BACKLOG.set(count)
+    EXPIRY_LAG_SECONDS.set(lag)
+
+
+#observe callback for a PasswordHasher
+def observe_bcrypt(operation, seconds):
+    BCRYPT_SECONDS.labels(operation).observe(seconds)
+
+
+def render_metrics():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+#Registers the request hooks, SQL timing and the /metrics route
+#Call before other before_request hooks are registered so their time is included in request durations
+def init_metrics(app):
+    app.config.setdefault('METRICS_ENABLED', True)
+
+    @app.before_request
+    def _start_request_metrics():
+        if not app.config['METRICS_ENABLED']:
+            return
+        endpoint = request.endpoint or "none"
+        g.metrics_endpoint = endpoint
+        g.metrics_start = time.perf_counter()
+        g.error_code = None
+        IN_PROGRESS.labels(endpoint).inc()
+
+    @app.after_request
+    def _record_request_metrics(response):
+        if 'metrics_start' not in g:
+            return response
+        endpoint = g.metrics_endpoint
+        REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - g.metrics_start)
+        REQUESTS.labels(endpoint, request.method, str(response.status_code)).inc()
+
+        # Error codes come from the rendered message, or from the body of a JSON error response
+        code = g.error_code
+        if code is None and response.status_code >= 400 and response.is_json:
+            body = response.get_json(silent=True)
+            code = body.get('code') if isinstance(body, dict) else None
+        if code:
+            ERROR_CODES.labels(endpoint, code).inc()
+        return response
+
+    @app.teardown_request
+    def _finish_request_metrics(exc):
+        if 'metrics_start' in g:
+            IN_PROGRESS.labels(g.metrics_endpoint).dec()
+
+    def _record_template_error_code(sender, template, context, **extra):
+        record_error_code(context.get('message'))
+
+    template_rendered.connect(_record_template_error_code, app, weak=False)
+
+    # Times every statement on every engine, including the WAL and shard engines
+    @event.listens_for(Engine, "before_cursor_execute")
+    def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def _record_query_time(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERY_SECONDS.observe(time.perf_counter() - conn.info['metrics_query_start'].pop())
+
+    @event.listens_for(Engine, "handle_error")
+    def _discard_query_timer(exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get('metrics_query_start'):
+            connection.info['metrics_query_start'].pop()
+
+    #Prometheus scrape endpoint
+    @app.route("/metrics")
+    def metrics():
+        return Response(render_metrics(), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,125 @@
+import time
+from sqlalchemy import MetaData
+from sqlalchemy.schema import CreateTable
+
+
+#Online rebuild of a SQLite table to match its current model definition
+#
+#The table is never locked for longer than one batch:
+#  1. a shadow table <name>_new is created from the model, with its indexes
+#  2. triggers mirror every insert/update/delete on the live table into the shadow table
+#  3. existing rows are copied across in primary key order, one short transaction per batch
+#  4. in one short transaction the triggers are dropped and the tables are swapped by renaming
+#  5. the old table is emptied in batches and then dropped
+#Columns that exist in both tables are copied; new columns must have a server default.
+def rebuild_table(engine, table, batch_size=10000, pause=0.05, log=print):
+    name = table.name
+    shadow = f"{name}_new"
+    retired = f"{name}_old"
+
+    raw = engine.raw_connection()
+    conn = raw.driver_connection
+    isolation_level = conn.isolation_level
+    # Transactions are managed explicitly so every batch takes the write lock exactly once
+    conn.isolation_level = None
+    try:
+        # Finish any earlier run that stopped part way
+        _drop_triggers(conn, name)
+        conn.execute(f'DROP TABLE IF EXISTS "{shadow}"')
+        _drain_table(conn, retired, batch_size, pause, log)
+
+        existing_indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        conn.execute(_create_shadow_sql(engine, table, shadow))
+        for index in table.indexes:
+            # SQLite index names are global, so avoid names still held by the live table
+            index_name = index.name if index.name not in existing_indexes else f"{index.name}_rebuild"
+            columns = ", ".join(f'"{column.name}"' for column in index.columns)
+            unique = "UNIQUE " if index.unique else ""
+            conn.execute(f'CREATE {unique}INDEX "{index_name}" ON "{shadow}" ({columns})')
+
+        live_columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{name}")')]
+        columns = [column.name for column in table.columns if column.name in live_columns]
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        new_values = ", ".join(f'NEW."{column}"' for column in columns)
+
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(f'CREATE TRIGGER "{name}_rebuild_insert" AFTER INSERT ON "{name}" BEGIN '
+                     f'INSERT OR REPLACE INTO "{shadow}" ({column_list}) VALUES ({new_values}); END')
+        conn.execute(f'CREATE TRIGGER "{name}_rebuild_update" AFTER UPDATE ON "{name}" BEGIN '
+                     f'DELETE FROM "{shadow}" WHERE id = OLD.id; '
+                     f'INSERT OR REPLACE INTO "{shadow}" ({column_list}) VALUES ({new_values}); END')
+        conn.execute(f'CREATE TRIGGER "{name}_rebuild_delete" AFTER DELETE ON "{name}" BEGIN '
+                     f'DELETE FROM "{shadow}" WHERE id = OLD.id; END')
+        conn.execute("COMMIT")
+
+        # Copy existing rows; rows already written by the triggers are newer and are kept
+        copied = 0
+        last_id = 0
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            upper = conn.execute(f'SELECT id FROM "{name}" WHERE id > ? ORDER BY id LIMIT 1 OFFSET ?',
+                                 (last_id, batch_size - 1)).fetchone()
+            if upper is None:
+                upper = conn.execute(f'SELECT max(id) FROM "{name}"').fetchone()
+            upper_id = upper[0]
+            if upper_id is None or upper_id <= last_id:
+                conn.execute("COMMIT")
+                break
+            cursor = conn.execute(f'INSERT OR IGNORE INTO "{shadow}" ({column_list}) '
+                                  f'SELECT {column_list} FROM "{name}" WHERE id > ? AND id <= ?',
+                                  (last_id, upper_id))
+            conn.execute("COMMIT")
+            copied += max(cursor.rowcount, 0)
+            last_id = upper_id
+            log(f"Copied rows up to id {last_id} ({copied} copied)")
+            time.sleep(pause)
+
+        # Swap the tables; both statements only touch the schema
+        conn.execute("BEGIN IMMEDIATE")
+        _drop_triggers(conn, name)
+        conn.execute(f'ALTER TABLE "{name}" RENAME TO "{retired}"')
+        conn.execute(f'ALTER TABLE "{shadow}" RENAME TO "{name}"')
+        conn.execute("COMMIT")
+        log(f"Swapped in rebuilt table {name}")
+
+        _drain_table(conn, retired, batch_size, pause, log)
+        log(f"Rebuild of {name} complete ({copied} rows copied)")
+        return copied
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.isolation_level = isolation_level
+        raw.close()
+
+
+def _create_shadow_sql(engine, table, shadow):
+    # Copy the table, and the tables it references so foreign keys compile, into a scratch MetaData
+    metadata = MetaData()
+    for foreign_key in table.foreign_keys:
+        foreign_key.column.table.to_metadata(metadata)
+    shadow_table = table.to_metadata(metadata, name=shadow)
+    return str(CreateTable(shadow_table).compile(dialect=engine.dialect))
+
+
+def _drop_triggers(conn, name):
+    for suffix in ("insert", "update", "delete"):
+        conn.execute(f'DROP TRIGGER IF EXISTS "{name}_rebuild_{suffix}"')
+
+
+#Deletes a retired table in batches so the final DROP TABLE only has empty pages to free
+def _drain_table(conn, name, batch_size, pause, log):
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone()
+    if not exists:
+        return
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        cursor = conn.execute(f'DELETE FROM "{name}" WHERE id IN (SELECT id FROM "{name}" ORDER BY id LIMIT ?)',
+                              (batch_size,))
+        conn.execute("COMMIT")
+        if cursor.rowcount <= 0:
+            break
+        time.sleep(pause)
+    conn.execute(f'DROP TABLE "{name}"')
+    log(f"Dropped retired table {name}")
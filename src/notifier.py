@@ -0,0 +1,270 @@
+import asyncio
+import io
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+from change_feed import ChangesExpired
+
+HEADER_TIMEOUT = 10
+MAX_HEADERS = 100
+
+
+#Serves the watch requests that wait for changes, without a thread per waiting client
+#The main server answers a watch that would have to wait with a 307 to this server (see watch_data in
+#app.py). The notifier runs an asyncio loop on one thread of the server process and passes each request
+#to the Flask app on a small pool of threads, so authentication, validation and the first read stay in
+#watch_data. Instead of waiting, watch_data takes a watcher slot and fills in environ["dpd.watch"] with
+#what to watch: user_id, the changes and cursor of the first read, timeout, stream, and read(cursor).
+#The loop then waits for the user's next change (the change feed's listener wakes it), writes the long
+#poll answer or the event stream itself, and only goes back to the pool to read changes. An idle watcher
+#costs a coroutine and its socket.
+#Only GET is served, and every response closes its connection. Under gunicorn each worker runs its own
+#notifier on the same port (SO_REUSEPORT), and the kernel spreads the connections between them.
+class WatchNotifier:
+    def __init__(self, app, change_feed, host="0.0.0.0", port=5001, threads=4):
+        self.app = app
+        self.change_feed = change_feed
+        self.host = host
+        self.port = port
+        self.threads = threads
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._executor = None
+        # user id -> futures of the watchers waiting for the user's next change
+        self._waiters = {}
+        change_feed.add_listener(self._changed)
+
+    def start(self):
+        #Returns once the server is listening; with port 0, port is then the one it was given
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix="watch-notifier")
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._serve, self.host, self.port, reuse_port=True))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._thread = threading.Thread(target=self._loop.run_forever, name="watch-notifier", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        #Stops listening and drops the connections still open
+        if self._thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+        self._loop.close()
+        self._executor.shutdown(wait=False)
+
+    async def _shutdown(self):
+        self._server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _changed(self, user_ids):
+        #Change feed listener; runs on the thread that committed or polled the changes
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(self._wake, user_ids)
+        except RuntimeError:
+            # The loop closed in the meantime
+            pass
+
+    def _wake(self, user_ids):
+        for user_id in user_ids:
+            for waiter in self._waiters.pop(str(user_id), ()):
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def _wait(self, user_id, since, timeout):
+        #Waits until the user has changes after since, or for timeout seconds; returns False on timeout
+        user_id = str(user_id)
+        deadline = self._loop.time() + timeout
+        while self.change_feed.latest(user_id) <= since:
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                return False
+            waiter = self._loop.create_future()
+            waiters = self._waiters.setdefault(user_id, set())
+            waiters.add(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                waiters.discard(waiter)
+                if not waiters and self._waiters.get(user_id) is waiters:
+                    del self._waiters[user_id]
+        return True
+
+    async def _run(self, fn, *args):
+        return await self._loop.run_in_executor(self._executor, fn, *args)
+
+    async def _serve(self, reader, writer):
+        try:
+            environ = await self._read_request(reader, writer)
+            if environ is None:
+                return
+            status, headers, body = await self._run(self._call_app, environ)
+            watch = environ["dpd.watch"]
+            if not watch:
+                await self._respond(writer, status, headers, body)
+                return
+            try:
+                if watch["stream"]:
+                    await self._stream(writer, status, headers, watch)
+                else:
+                    await self._long_poll(writer, status, headers, watch)
+            finally:
+                self.change_feed.release()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            pass
+        except Exception as e:
+            print(f"Watch request failed: {str(e)}")
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader, writer):
+        #Parses the request line and headers into a WSGI environ; answers and returns None if it cannot
+        request_line = await asyncio.wait_for(reader.readline(), HEADER_TIMEOUT)
+        lines = []
+        while True:
+            line = await asyncio.wait_for(reader.readline(), HEADER_TIMEOUT)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            lines.append(line.decode("latin-1"))
+            if len(lines) > MAX_HEADERS:
+                break
+        parts = request_line.decode("latin-1").split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/") or len(lines) > MAX_HEADERS or \
+                any(":" not in line for line in lines):
+            await self._respond(writer, "400 Bad Request", [("Content-Type", "text/plain")], b"Bad request\n")
+            return None
+        method, target, protocol = parts
+        if method != "GET":
+            await self._respond(writer, "405 Method Not Allowed", [("Content-Type", "text/plain"), ("Allow", "GET")],
+                                b"Method not allowed\n")
+            return None
+
+        path, _, query = target.partition("?")
+        server = writer.get_extra_info("sockname")
+        peer = writer.get_extra_info("peername")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(path, "latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": str(server[0]),
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": protocol,
+            "REMOTE_ADDR": str(peer[0]) if peer else "",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+            "dpd.watch": {},
+        }
+        for line in lines:
+            name, _, value = line.partition(":")
+            name = name.strip().upper()
+            # As gunicorn does, so X_Forwarded_For cannot pass for X-Forwarded-For
+            if "_" in name:
+                continue
+            name = name.replace("-", "_")
+            value = value.strip()
+            if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[name] = value
+            elif f"HTTP_{name}" in environ:
+                environ[f"HTTP_{name}"] += f",{value}"
+            else:
+                environ[f"HTTP_{name}"] = value
+        return environ
+
+    def _call_app(self, environ):
+        #Runs the Flask app on a pool thread; returns (status, headers, body)
+        response = []
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+        result = self.app(environ, start_response)
+        try:
+            body = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return response[0], response[1], body
+
+    async def _respond(self, writer, status, headers, body=None):
+        #Writes the status line and headers, then body if given; without one the caller writes the body
+        lines = [f"HTTP/1.1 {status}"]
+        lines += [f"{name}: {value}" for name, value in headers if name.lower() not in ("content-length", "connection")]
+        if body is not None:
+            lines.append(f"Content-Length: {len(body)}")
+        lines.append("Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if body:
+            writer.write(body)
+        await writer.drain()
+
+    async def _long_poll(self, writer, status, headers, watch):
+        changes, cursor = watch["changes"], watch["cursor"]
+        deadline = self._loop.time() + watch["timeout"]
+        try:
+            while not changes:
+                remaining = deadline - self._loop.time()
+                # A change to another of the user's keys wakes the wait without matching
+                if remaining <= 0 or not await self._wait(watch["user_id"], cursor, remaining):
+                    break
+                changes, cursor = await self._run(watch["read"], cursor)
+        except ChangesExpired:
+            # Compaction overtook the long poll while it waited; the client starts over as for a 410 up front
+            body = {
+                "status": "error",
+                "code": "CHANGES_EXPIRED",
+                "message": "Changes after that sequence number are no longer kept. Retrieve the keys again and "
+                           "watch without since."
+            }
+            await self._respond(writer, "410 GONE", headers, (json.dumps(body) + "\n").encode("utf-8"))
+            return
+        body = {
+            "status": "success",
+            "message": "Changes retrieved successfully.",
+            "data": {
+                "changes": changes,
+                "next": cursor
+            }
+        }
+        await self._respond(writer, status, headers, (json.dumps(body) + "\n").encode("utf-8"))
+
+    async def _stream(self, writer, status, headers, watch):
+        #Server-sent events: the changes read so far, then each new page as it arrives
+        #The stream ends after CHANGE_FEED_STREAM_SECONDS; clients reconnect with Last-Event-ID
+        deadline = self._loop.time() + self.app.config['CHANGE_FEED_STREAM_SECONDS']
+        keepalive = self.app.config['CHANGE_FEED_KEEPALIVE_SECONDS']
+        changes, cursor = watch["changes"], watch["cursor"]
+        await self._respond(writer, status, headers)
+        writer.write(f"retry: {int(keepalive * 1000)}\n\n".encode("utf-8"))
+        while True:
+            for change in changes:
+                writer.write(f"id: {change['sequence']}\nevent: change\n"
+                             f"data: {json.dumps(change, separators=(',', ':'))}\n\n".encode("utf-8"))
+            await writer.drain()
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            if not changes and not await self._wait(watch["user_id"], cursor, min(keepalive, remaining)):
+                writer.write(b": keepalive\n\n")
+            try:
+                changes, cursor = await self._run(watch["read"], cursor)
+            except ChangesExpired as expired:
+                writer.write(f"event: expired\ndata: {json.dumps({'oldest': expired.oldest})}\n\n".encode("utf-8"))
+                break
+        await writer.drain()
@@ -0,0 +1,139 @@
+import logging
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from flask import g, has_request_context, before_render_template, template_rendered
+from flask.sessions import SecureCookieSessionInterface
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+slow_query_log = logging.getLogger("dpd.slow_query")
+
+
+#Opt-in request profiling (PROFILING_ENABLED)
+#Each response gets a Server-Timing header with the time spent in token decoding (auth), SQL (db),
+#template rendering (render) and session cookie signing (session), plus the query count.
+#Statements repeated more than PROFILING_N_PLUS_ONE_THRESHOLD times in one request are logged as
+#a likely N+1 pattern. Independently of request profiling, statements slower than
+#PROFILING_SLOW_QUERY_MS go to the dpd.slow_query log with their parameters and query plan.
+
+
+#Times a block of work as the named phase of the current request's profile
+@contextmanager
+def profile_phase(name):
+    profile = g.get('profile') if has_request_context() else None
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile['phases'][name] += time.perf_counter() - start
+
+
+def _current_profile():
+    return g.get('profile') if has_request_context() else None
+
+
+#Session interface that times cookie signing and then writes the Server-Timing header,
+#since saving the session is the last thing Flask does to a response
+class ProfilingSessionInterface(SecureCookieSessionInterface):
+    def save_session(self, app, session, response):
+        with profile_phase("session"):
+            super().save_session(app, session, response)
+        profile = _current_profile()
+        if profile is not None:
+            response.headers['Server-Timing'] = _server_timing(profile)
+
+
+def _server_timing(profile):
+    total = time.perf_counter() - profile['start']
+    entries = []
+    for name in ("auth", "db", "render", "session"):
+        if name in profile['phases']:
+            duration = profile['phases'][name] * 1000
+            if name == "db":
+                entries.append(f'db;dur={duration:.3f};desc="{profile["queries"]} queries"')
+            else:
+                entries.append(f"{name};dur={duration:.3f}")
+    entries.append(f"total;dur={total * 1000:.3f}")
+    return ", ".join(entries)
+
+
+def init_profiling(app):
+    app.config.setdefault('PROFILING_ENABLED', False)
+    app.config.setdefault('PROFILING_SLOW_QUERY_MS', 100)
+    app.config.setdefault('PROFILING_N_PLUS_ONE_THRESHOLD', 10)
+    app.session_interface = ProfilingSessionInterface()
+
+    @app.before_request
+    def _start_profile():
+        if app.config['PROFILING_ENABLED']:
+            g.profile = {
+                "start": time.perf_counter(),
+                "phases": defaultdict(float),
+                "queries": 0,
+                "statements": Counter(),
+            }
+
+    @app.after_request
+    def _check_query_patterns(response):
+        profile = _current_profile()
+        if profile is None:
+            return response
+        threshold = app.config['PROFILING_N_PLUS_ONE_THRESHOLD']
+        for statement, count in profile['statements'].items():
+            if count > threshold:
+                app.logger.warning(f"Possible N+1 query: executed {count} times in one request: {statement}")
+        return response
+
+    def _start_render(sender, template, context, **extra):
+        profile = _current_profile()
+        if profile is not None:
+            profile['render_start'] = time.perf_counter()
+
+    def _finish_render(sender, template, context, **extra):
+        profile = _current_profile()
+        if profile is not None and 'render_start' in profile:
+            profile['phases']['render'] += time.perf_counter() - profile.pop('render_start')
+
+    before_render_template.connect(_start_render, app, weak=False)
+    template_rendered.connect(_finish_render, app, weak=False)
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def _start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('profiling_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def _finish_statement(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['profiling_query_start'].pop()
+
+        profile = _current_profile()
+        if profile is not None:
+            profile['phases']['db'] += elapsed
+            profile['queries'] += 1
+            profile['statements'][statement] += 1
+
+        if elapsed * 1000 >= app.config['PROFILING_SLOW_QUERY_MS']:
+            slow_query_log.warning(
+                f"Slow query ({elapsed * 1000:.1f} ms): {statement} parameters={parameters!r}"
+                f"{_query_plan(conn, statement, parameters, executemany)}"
+            )
+
+    @event.listens_for(Engine, "handle_error")
+    def _discard_statement(exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get('profiling_query_start'):
+            connection.info['profiling_query_start'].pop()
+
+
+#EXPLAIN QUERY PLAN for a statement, run on the raw sqlite3 connection so it is not itself profiled
+def _query_plan(conn, statement, parameters, executemany):
+    if executemany or conn.dialect.driver != "pysqlite":
+        return ""
+    try:
+        rows = conn.connection.driver_connection.execute("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+    except Exception as e:
+        return f"\n  (no query plan: {e})"
+    return "".join(f"\n  {row[-1]}" for row in rows)
@@ -0,0 +1,152 @@
+import time
+import zlib
+from contextlib import contextmanager
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlite_pool import set_sqlite_pragmas
+from storage import Storage, SqlAlchemyStorage
+
+
+#Raised for a write that cannot be taken right now: the user's data is being moved to another shard,
+#or the WAL writer's queue is full
+class StorageBusy(Exception):
+    pass
+
+
+#The shard a user lives on when the catalog does not say otherwise
+def default_shard(user_id, shards):
+    return zlib.crc32(str(user_id).encode('utf-8')) % shards
+
+
+#Data rows split across several SQLite files by user
+#Each shard is a SqlAlchemyStorage with its own engine, connection pool and write lock, so writes
+#for users on different shards never wait on each other.
+#route(user_id) returns the user's catalog entry (shard index, moving), or None for a user on their
+#default shard. A user who is being moved can still be read from the old shard, but writes raise
+#StorageBusy until the move is finished.
+class ShardedStorage(Storage):
+    def __init__(self, model, shard_urls, route, busy_timeout_ms=5000, synchronous="NORMAL", codec=None):
+        self.route = route
+        self.engines = []
+        self.shards = []
+        for url in shard_urls:
+            engine = create_engine(url)
+            set_sqlite_pragmas(engine, busy_timeout_ms, synchronous, wal=True)
+            model.__table__.create(engine, checkfirst=True)
+            Session = sessionmaker(bind=engine)
+            self.engines.append(engine)
+            self.shards.append(SqlAlchemyStorage(model, _session_writer(Session), _session_reader(Session), codec))
+
+    def locate(self, user_id):
+        #Returns (shard index, moving) for the user
+        entry = self.route(user_id)
+        if entry is None:
+            return default_shard(user_id, len(self.shards)), False
+        return entry
+
+    def _shard(self, user_id, write=False):
+        index, moving = self.locate(user_id)
+        if write and moving:
+            raise StorageBusy()
+        return self.shards[index]
+
+    def get(self, user_id, key, with_meta=False):
+        return self._shard(user_id).get(user_id, key, with_meta)
+
+    def etag(self, user_id, key):
+        return self._shard(user_id).etag(user_id, key)
+
+    def put(self, user_id, key, value, expires_at=None):
+        return self._shard(user_id, write=True).put(user_id, key, value, expires_at)
+
+    def update(self, user_id, key, value, check=None, expires_at=None):
+        return self._shard(user_id, write=True).update(user_id, key, value, check, expires_at)
+
+    def delete(self, user_id, key):
+        return self._shard(user_id, write=True).delete(user_id, key)
+
+    def scan(self, user_id, prefix="", after=None, limit=None, with_values=False):
+        return self._shard(user_id).scan(user_id, prefix, after, limit, with_values)
+
+    def put_many(self, user_id, items):
+        return self._shard(user_id, write=True).put_many(user_id, items)
+
+    def apply(self, user_id, keys, fn):
+        return self._shard(user_id, write=True).apply(user_id, keys, fn)
+
+    def increment(self, user_id, key, delta):
+        return self._shard(user_id, write=True).increment(user_id, key, delta)
+
+    def compare_and_swap(self, user_id, key, value, version):
+        return self._shard(user_id, write=True).compare_and_swap(user_id, key, value, version)
+
+    def sweep(self, now, limit):
+        swept = 0
+        for shard in self.shards:
+            if swept >= limit:
+                break
+            swept += shard.sweep(now, limit - swept)
+        return swept
+
+    def expiry_backlog(self, now):
+        backlogs = [shard.expiry_backlog(now) for shard in self.shards]
+        oldest = [oldest for _, oldest in backlogs if oldest is not None]
+        return sum(count for count, _ in backlogs), min(oldest) if oldest else None
+
+    def user_ids(self):
+        return sorted({user_id for shard in self.shards for user_id in shard.user_ids()})
+
+    def recompress(self, user_id, batch_size=1000):
+        return self._shard(user_id, write=True).recompress(user_id, batch_size)
+
+    def close(self):
+        for engine in self.engines:
+            engine.dispose()
+
+    def move_user(self, user_id, target, set_route, grace=1.0, batch_size=1000, log=print):
+        #Moves a user's data to the target shard while the app keeps serving
+        #set_route(user_id, shard, moving) records the user's shard in the catalog
+        #Returns the number of rows copied
+        source, _ = self.locate(user_id)
+        if source == target:
+            return 0
+
+        # Stop new writes, then give writes that already looked up the old route time to finish
+        set_route(user_id, source, True)
+        time.sleep(grace)
+
+        # Rows left on the target by an earlier, interrupted move are replaced
+        source_shard = self.shards[source]
+        target_shard = self.shards[target]
+        target_shard.delete_user(user_id)
+        copied = 0
+        after = None
+        while True:
+            rows = source_shard.scan(user_id, after=after, limit=batch_size, with_values=True)
+            if rows:
+                target_shard.put_many(user_id, rows, source_shard.metadata(user_id, [key for key, _ in rows]))
+                copied += len(rows)
+                log(f"Copied {copied} rows of user {user_id} to shard {target}")
+            if len(rows) < batch_size:
+                break
+            after = rows[-1][0]
+
+        # Switch the route, then drop the old copy, which nothing reads any more
+        set_route(user_id, target, False)
+        source_shard.delete_user(user_id)
+        return copied
+
+
+def _session_writer(Session):
+    def run_write(fn, *args):
+        with Session() as session:
+            return fn(session, *args)
+    return run_write
+
+
+def _session_reader(Session):
+    @contextmanager
+    def read_session():
+        with Session() as session:
+            yield session
+    return read_session
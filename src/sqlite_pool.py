@@ -0,0 +1,178 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, sessionmaker
+
+
+#Applies the connection pragmas every time the pool opens a new SQLite connection
+def set_sqlite_pragmas(engine, busy_timeout_ms=5000, synchronous="NORMAL", wal=False, query_only=False):
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if wal:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+        cursor.execute(f"PRAGMA synchronous={synchronous}")
+        if query_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+
+#Writer session for group commit
+#While a group is open, commit() only flushes and rollback() only undoes the current write's savepoint,
+#so write functions keep their usual commit/rollback calls and the writer commits the whole group once
+class GroupCommitSession(Session):
+    savepoint = None
+
+    def commit(self):
+        if self.savepoint is None:
+            return super().commit()
+        self.flush()
+
+    def rollback(self):
+        if self.savepoint is None:
+            return super().rollback()
+        if self.savepoint.is_active:
+            self.savepoint.rollback()
+
+
+#A SQLite database in WAL mode with one writer connection and a pool of read only connections
+#Writes are callables taking a session; they are queued and run one at a time on the writer thread,
+#so concurrent requests never contend for the write lock. Reads use mode=ro connections, which
+#WAL lets run alongside the writer.
+#With group_commit_window_ms set, the writer collects the writes queued within that window (up to
+#group_commit_max_ops) and commits them in one transaction, so they share a single fsync. Each write
+#runs in its own savepoint, so a failing write is rolled back alone, and write() returns only once the
+#group's commit is done. on_group_commit(size, seconds) is called after every group commit, with the
+#time from the group's first write being picked up to the end of the commit.
+class WALDatabase:
+    def __init__(self, path, read_pool_size=8, queue_size=1000, busy_timeout_ms=5000, synchronous="NORMAL",
+                 group_commit_window_ms=0, group_commit_max_ops=256, on_group_commit=None):
+        self.queue_timeout = busy_timeout_ms / 1000
+        self.group_commit_window = group_commit_window_ms / 1000
+        self.group_commit_max_ops = group_commit_max_ops
+        self.on_group_commit = on_group_commit or (lambda size, seconds: None)
+        self.write_engine = create_engine(f"sqlite:///{path}", pool_size=1, max_overflow=0)
+        set_sqlite_pragmas(self.write_engine, busy_timeout_ms, synchronous, wal=True)
+        if self.group_commit_window:
+            _use_explicit_transactions(self.write_engine)
+        # Switch the file to WAL before any read only connection opens it
+        with self.write_engine.connect():
+            pass
+
+        self.read_engine = create_engine(f"sqlite:///file:{path}?mode=ro&uri=true",
+                                         pool_size=read_pool_size, max_overflow=0)
+        set_sqlite_pragmas(self.read_engine, busy_timeout_ms, synchronous, query_only=True)
+
+        # Objects returned by a write stay readable once the writer session is closed
+        self.WriteSession = sessionmaker(bind=self.write_engine, expire_on_commit=False,
+                                         class_=GroupCommitSession if self.group_commit_window else Session)
+        self.ReadSession = sessionmaker(bind=self.read_engine)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, fn, *args):
+        #Runs fn(session, *args) on the writer thread and returns its result
+        #Raises queue.Full if the writer has fallen too far behind
+        future = Future()
+        self._queue.put((fn, args, future), timeout=self.queue_timeout)
+        return future.result()
+
+    @contextmanager
+    def read_session(self):
+        with self.ReadSession() as session:
+            yield session
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.write_engine.dispose()
+        self.read_engine.dispose()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self.group_commit_window:
+                start = time.perf_counter()
+                group, stop = self._collect_group(item)
+                self._commit_group(group, start)
+                if stop:
+                    break
+                continue
+            fn, args, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with self.WriteSession() as session:
+                    future.set_result(fn(session, *args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def _collect_group(self, first):
+        #Returns the writes queued within the window after first, and whether close() was called
+        group = [first]
+        deadline = time.monotonic() + self.group_commit_window
+        while len(group) < self.group_commit_max_ops:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                return group, True
+            group.append(item)
+        return group, False
+
+    def _commit_group(self, group, start):
+        outcomes = []
+        try:
+            with self.WriteSession() as session:
+                for fn, args, future in group:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    session.savepoint = session.begin_nested()
+                    try:
+                        result = fn(session, *args)
+                        if session.savepoint.is_active:
+                            session.savepoint.commit()
+                        outcomes.append((future, result, None))
+                    except Exception as e:
+                        if session.savepoint.is_active:
+                            session.savepoint.rollback()
+                        outcomes.append((future, None, e))
+                    finally:
+                        session.savepoint = None
+                session.commit()
+        except BaseException as e:
+            # Nothing in the group was committed
+            for _, _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.on_group_commit(len(outcomes), time.perf_counter() - start)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+#pysqlite opens transactions on its own and does not know about savepoints; this hands transaction
+#control to SQLAlchemy so the nested transactions used by group commit work
+def _use_explicit_transactions(engine):
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def _on_begin(connection):
+        # The writer is the only writer, so it takes the write lock up front
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
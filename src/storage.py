@@ -0,0 +1,808 @@
+import bisect
+import hashlib
+import json
+import heapq
+import os
+import re
+import threading
+import time
+import zlib
+from sqlalchemy import insert, update, func, or_, cast, Integer, String
+
+
+#Raised by a conditional update when the stored value fails the caller's check
+class PreconditionFailed(Exception):
+    pass
+
+
+#Raised by compare_and_swap when the key has moved on from the expected version
+class VersionConflict(Exception):
+    def __init__(self, version):
+        super().__init__(version)
+        self.version = version
+
+
+#Raised by increment when the stored value is not an integer, or the result would not fit in 64 bits
+class NotAnInteger(Exception):
+    pass
+
+
+#Key-value storage used by the data routes
+#Values are stored per user; user ids are compared as strings, as they come out of the access token.
+#Implementations must make each call atomic with respect to other calls for the same user.
+#A key may carry an expiry time (seconds since the epoch); once it has passed, the key reads as missing
+#everywhere, and sweep() removes it for good.
+#Every key has a version: 1 when it is stored, raised by one with every write that changes its value.
+class Storage:
+    def get(self, user_id, key, with_meta=False):
+        #Returns the stored value or None; with_meta, (value, expires_at, version) or None
+        raise NotImplementedError
+
+    def etag(self, user_id, key):
+        #Returns value_etag of the stored value, or None if the key does not exist
+        value = self.get(user_id, key)
+        return None if value is None else value_etag(value)
+
+    def put(self, user_id, key, value, expires_at=None):
+        #Stores a new key; returns False if the key already exists
+        raise NotImplementedError
+
+    def update(self, user_id, key, value, check=None, expires_at=None):
+        #Replaces the value of an existing key; returns False if the key does not exist
+        #check(current_value), if given, must return True or PreconditionFailed is raised
+        #The key keeps its expiry unless a new expires_at is given
+        raise NotImplementedError
+
+    def delete(self, user_id, key):
+        #Returns False if the key does not exist
+        raise NotImplementedError
+
+    def scan(self, user_id, prefix="", after=None, limit=None, with_values=False):
+        #Returns up to limit (key, value) pairs in key order, with keys starting with prefix
+        #and greater than after; value is None unless with_values is set
+        raise NotImplementedError
+
+    def put_many(self, user_id, items):
+        #Stores the (key, value) items whose key is new and returns the positions of the others
+        #Like put, an existing key is never overwritten
+        raise NotImplementedError
+
+    def apply(self, user_id, keys, fn):
+        #Loads {key: value} for the existing keys among keys, calls fn(values), which may change
+        #the dict in place, and stores the changes atomically; returns fn's result and the final dict
+        #values is a BatchValues: a key fn removes and sets again is stored as a new key, at version 1
+        #and without its old expiry, rather than updated
+        raise NotImplementedError
+
+    def increment(self, user_id, key, delta):
+        #Adds delta to the integer value of an existing key in one step
+        #Returns (new value, new version), or None if the key does not exist; raises NotAnInteger
+        raise NotImplementedError
+
+    def compare_and_swap(self, user_id, key, value, version):
+        #Replaces the value of an existing key only if it is still at version
+        #Returns the new version, or None if the key does not exist; raises VersionConflict otherwise
+        raise NotImplementedError
+
+    def sweep(self, now, limit):
+        #Removes up to limit keys that expired at or before now, earliest first; returns how many
+        raise NotImplementedError
+
+    def expiry_backlog(self, now):
+        #Returns (number of expired keys not yet swept, expiry time of the oldest of them or None)
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def _expired(expires_at, now):
+    return expires_at is not None and expires_at <= now
+
+
+#Strong ETag for a value; it is a hash of the value, so a cached value is enough to answer If-None-Match
+def value_etag(value):
+    return hashlib.blake2b(value.encode('utf-8'), digest_size=12).hexdigest()
+
+
+#The dict Storage.apply hands to fn; it remembers the keys removed from it (with del or pop)
+class BatchValues(dict):
+    def __init__(self, values):
+        super().__init__(values)
+        self.removed = set()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.removed.add(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.removed.add(key)
+        return super().pop(key, *default)
+
+
+INTEGER = re.compile(r"-?[1-9][0-9]*|0")
+INTEGER_MIN = -2 ** 63
+INTEGER_MAX = 2 ** 63 - 1
+
+
+#The value plus delta for increment(), as text; raises NotAnInteger
+#Only canonical decimal integers count, so "007" or "1.0" are refused rather than rewritten
+def add_to_integer(value, delta):
+    if not INTEGER.fullmatch(value):
+        raise NotAnInteger()
+    result = int(value) + delta
+    if not INTEGER_MIN <= int(value) <= INTEGER_MAX or not INTEGER_MIN <= result <= INTEGER_MAX:
+        raise NotAnInteger()
+    return str(result)
+
+
+#The keys of a sorted list that a scan returns: up to limit keys starting with prefix and after after
+def select_keys(keys, prefix="", after=None, limit=None):
+    start = bisect.bisect_left(keys, prefix)
+    if after is not None:
+        start = max(start, bisect.bisect_right(keys, after))
+    selected = []
+    for key in keys[start:start + limit] if limit is not None else keys[start:]:
+        if not key.startswith(prefix):
+            break
+        selected.append(key)
+    return selected
+
+
+#select_keys for the keys where live(key) is true
+#Keys that are not live are skipped and the page is filled from the keys after them, so a page costs
+#its own size plus the skipped keys in it rather than the size of keys
+def select_live_keys(keys, live, prefix="", after=None, limit=None):
+    selected = []
+    while True:
+        wanted = limit - len(selected) if limit is not None else None
+        page = select_keys(keys, prefix, after, wanted)
+        selected.extend(key for key in page if live(key))
+        if limit is None or len(selected) >= limit or len(page) < wanted:
+            return selected
+        after = page[-1]
+
+
+#The entries of an expiry heap of (expires_at, ...) tuples that are due at now, in no particular order
+#Only the due entries and their direct children are visited, as every entry below a child that is not
+#due is not due either
+def due_entries(heap, now):
+    pending = [0] if heap else []
+    while pending:
+        index = pending.pop()
+        if heap[index][0] <= now:
+            yield heap[index]
+            pending.extend(child for child in (2 * index + 1, 2 * index + 2) if child < len(heap))
+
+
+#Storage in the SQL database through the Data model
+#run_write(fn, *args) runs fn(session, *args) as a write and read_session() yields a session for
+#reads, so the same code serves the default session and the WAL writer/reader pool.
+#With a codec (compression.ValueCodec) values are written compressed as it decides, in the model's
+#codec and packed columns, and every row is decoded by its own codec when read.
+#With a change_log (change_feed.ChangeFeed) every write adds its (key, op, value) changes to the log in
+#its own transaction, right before it commits, so a change is logged if and only if it was committed.
+#SQLite has one writer at a time, so the log's sequence numbers follow the order of the commits.
+class SqlAlchemyStorage(Storage):
+    #Keys are looked up in chunks so the IN (...) list stays under SQLite's bound parameter limit
+    QUERY_CHUNK = 500
+
+    def __init__(self, model, run_write, read_session, codec=None, change_log=None):
+        self.model = model
+        self.run_write = run_write
+        self.read_session = read_session
+        self.codec = codec
+        self.change_log = change_log
+
+    def _value_columns(self):
+        Data = self.model
+        return (Data.value, Data.codec, Data.packed) if self.codec else (Data.value,)
+
+    def _decode(self, row, offset=0):
+        #The value of a row selected with _value_columns() starting at offset
+        if self.codec is None:
+            return row[offset]
+        return self.codec.decode(row[offset + 1], row[offset], row[offset + 2])
+
+    def _encode(self, user_id, value):
+        #Column values storing value for the user, with its ETag
+        if self.codec is None:
+            return {"value": value, "etag": value_etag(value)}
+        codec, text, packed = self.codec.encode(user_id, value)
+        return {"value": text, "codec": codec, "packed": packed, "etag": value_etag(value)}
+
+    def get(self, user_id, key, with_meta=False):
+        with self.read_session() as session:
+            row = session.query(*self._value_columns(), self.model.expires_at, self.model.version) \
+                .filter_by(user_id=user_id, key=key).first()
+        if row is None or _expired(row[-2], time.time()):
+            return None
+        return (self._decode(row), row[-2], row[-1]) if with_meta else self._decode(row)
+
+    def etag(self, user_id, key):
+        #Read from the etag column, so If-None-Match is answered without reading or decoding the value
+        with self.read_session() as session:
+            row = session.query(self.model.etag, self.model.expires_at).filter_by(user_id=user_id, key=key).first()
+        if row is None or _expired(row.expires_at, time.time()):
+            return None
+        # Rows written before the column existed have no ETag stored
+        return row.etag if row.etag is not None else super().etag(user_id, key)
+
+    def put(self, user_id, key, value, expires_at=None):
+        return self._logged_write(self._put, user_id, key, value, expires_at)
+
+    def update(self, user_id, key, value, check=None, expires_at=None):
+        return self._logged_write(self._update, user_id, key, value, check, expires_at)
+
+    def delete(self, user_id, key):
+        return self._logged_write(self._delete, user_id, key)
+
+    def scan(self, user_id, prefix="", after=None, limit=None, with_values=False):
+        Data = self.model
+        columns = (Data.key, *self._value_columns()) if with_values else (Data.key,)
+        with self.read_session() as session:
+            query = session.query(*columns).filter(Data.user_id == user_id,
+                                                   or_(Data.expires_at.is_(None), Data.expires_at > time.time()))
+            if prefix:
+                # A range on key uses the index; the substr check keeps the match exact
+                query = query.filter(Data.key >= prefix, Data.key < prefix + '\U0010ffff',
+                                     func.substr(Data.key, 1, len(prefix)) == prefix)
+            if after is not None:
+                query = query.filter(Data.key > after)
+            query = query.order_by(Data.key)
+            if limit is not None:
+                query = query.limit(limit)
+            rows = query.all()
+        return [(row[0], self._decode(row, 1) if with_values else None) for row in rows]
+
+    def put_many(self, user_id, items, metadata=None):
+        #metadata optionally maps keys to the (expires_at, version) their new rows get
+        return self._logged_write(self._put_many, user_id, items, metadata or {})
+
+    def apply(self, user_id, keys, fn):
+        return self._logged_write(self._apply, user_id, keys, fn)
+
+    def increment(self, user_id, key, delta):
+        return self._logged_write(self._increment, user_id, key, delta)
+
+    def compare_and_swap(self, user_id, key, value, version):
+        return self._logged_write(self._compare_and_swap, user_id, key, value, version)
+
+    def metadata(self, user_id, keys):
+        #{key: (expires_at, version)} for those of the keys that expire or are past version 1
+        Data = self.model
+        with self.read_session() as session:
+            return {row.key: (row.expires_at, row.version) for start in range(0, len(keys), self.QUERY_CHUNK)
+                    for row in session.query(Data.key, Data.expires_at, Data.version).filter(
+                        Data.user_id == user_id, Data.key.in_(keys[start:start + self.QUERY_CHUNK]),
+                        or_(Data.expires_at.isnot(None), Data.version != 1))}
+
+    def delete_user(self, user_id):
+        #Removes all of a user's data and returns the number of rows deleted
+        return self.run_write(self._delete_user, user_id)
+
+    def sweep(self, now, limit):
+        return self.run_write(self._sweep, now, limit)
+
+    def expiry_backlog(self, now):
+        Data = self.model
+        # Both come from the expires_at index
+        with self.read_session() as session:
+            count, oldest = session.query(func.count(), func.min(Data.expires_at)) \
+                .filter(Data.expires_at <= now).one()
+        return count, oldest
+
+    def user_ids(self):
+        with self.read_session() as session:
+            return [row[0] for row in session.query(self.model.user_id).distinct().order_by(self.model.user_id)]
+
+    def recompress(self, user_id, batch_size=1000):
+        #Rewrites the user's values with the codec's current settings, one transaction per batch of keys
+        #Returns (rows, bytes stored before, bytes stored after)
+        rows = before = after = 0
+        last_key = None
+        while True:
+            count, batch_before, batch_after, last_key = self.run_write(self._recompress_batch, user_id,
+                                                                        last_key, batch_size)
+            rows += count
+            before += batch_before
+            after += batch_after
+            if count < batch_size:
+                return rows, before, after
+
+    def _logged_write(self, fn, user_id, *args):
+        #Runs fn(session, log, user_id, *args) as a write; fn calls log(session, changes) before it commits
+        #The change log's watchers are only told about the changes once the write has been committed
+        if self.change_log is None:
+            return self.run_write(fn, _not_logged, user_id, *args)
+        sequences = []
+        def log(session, changes):
+            if changes:
+                sequences.append(self.change_log.add(session, user_id, changes))
+        result = self.run_write(fn, log, user_id, *args)
+        if sequences:
+            self.change_log.committed(user_id, sequences[-1])
+        return result
+
+    #Write operations, each runs in its own transaction
+    def _put(self, session, log, user_id, key, value, expires_at):
+        columns = dict(self._encode(user_id, value), expires_at=expires_at, version=1)
+        existing_data = session.query(self.model).filter_by(user_id=user_id, key=key).first()
+        if existing_data:
+            if not _expired(existing_data.expires_at, time.time()):
+                return False
+            # An expired key the sweeper has not reached yet is replaced
+            for name, column_value in columns.items():
+                setattr(existing_data, name, column_value)
+        else:
+            session.add(self.model(user_id=user_id, key=key, **columns))
+        log(session, [(key, "store", value)])
+        session.commit()
+        return True
+
+    def _update(self, session, log, user_id, key, value, check, expires_at):
+        existing_data = session.query(self.model).filter_by(user_id=user_id, key=key).first()
+        if not existing_data or _expired(existing_data.expires_at, time.time()):
+            return False
+        columns = dict(self._encode(user_id, value), version=self.model.version + 1)
+        if expires_at is not None:
+            columns["expires_at"] = expires_at
+        if check is None:
+            session.query(self.model).filter_by(id=existing_data.id).update(columns, synchronize_session=False)
+        else:
+            if not check(self._row_value(existing_data)):
+                raise PreconditionFailed()
+            # Only replace the value that was checked, in case another write landed in between
+            updated = session.query(self.model).filter_by(id=existing_data.id, version=existing_data.version) \
+                .update(columns, synchronize_session=False)
+            if updated == 0:
+                raise PreconditionFailed()
+        log(session, [(key, "update", value)])
+        session.commit()
+        return True
+
+    def _increment(self, session, log, user_id, key, delta):
+        Data = self.model
+        now = time.time()
+        # One statement does the arithmetic; it only matches rows holding a plain canonical integer
+        #whose result still fits in 64 bits, so everything else falls through to the checks below
+        current = cast(Data.value, Integer)
+        in_range = current <= INTEGER_MAX - delta if delta > 0 else current >= INTEGER_MIN - delta
+        row = session.execute(
+            update(Data)
+            .where(Data.user_id == user_id, Data.key == key, or_(Data.expires_at.is_(None), Data.expires_at > now),
+                   cast(current, String) == Data.value, in_range)
+            .values(value=cast(current + delta, String), version=Data.version + 1)
+            .returning(Data.id, Data.value, Data.version)
+        ).first()
+        if row is not None:
+            session.query(Data).filter_by(id=row.id).update({"etag": value_etag(row.value)},
+                                                            synchronize_session=False)
+            log(session, [(key, "update", row.value)])
+            session.commit()
+            return int(row.value), row.version
+
+        existing_data = session.query(Data).filter_by(user_id=user_id, key=key).first()
+        if not existing_data or _expired(existing_data.expires_at, now):
+            session.rollback()
+            return None
+        # A compressed integer is decoded and written back through the codec
+        try:
+            value = add_to_integer(self._row_value(existing_data), delta)
+        except NotAnInteger:
+            session.rollback()
+            raise
+        updated = session.query(Data).filter_by(id=existing_data.id, version=existing_data.version).update(
+            dict(self._encode(user_id, value), version=Data.version + 1), synchronize_session=False)
+        if updated == 0:
+            # Another write landed in between; start over from the new value
+            session.rollback()
+            return self._increment(session, log, user_id, key, delta)
+        log(session, [(key, "update", str(value))])
+        session.commit()
+        return int(value), existing_data.version + 1
+
+    def _compare_and_swap(self, session, log, user_id, key, value, version):
+        Data = self.model
+        live = or_(Data.expires_at.is_(None), Data.expires_at > time.time())
+        updated = session.query(Data).filter(Data.user_id == user_id, Data.key == key, Data.version == version, live) \
+            .update(dict(self._encode(user_id, value), version=Data.version + 1), synchronize_session=False)
+        if updated:
+            log(session, [(key, "update", value)])
+            session.commit()
+            return version + 1
+        current = session.query(Data.version).filter(Data.user_id == user_id, Data.key == key, live).scalar()
+        session.rollback()
+        if current is None:
+            return None
+        raise VersionConflict(current)
+
+    def _delete(self, session, log, user_id, key):
+        existing_data = session.query(self.model).filter_by(user_id=user_id, key=key).first()
+        if not existing_data:
+            return False
+        session.delete(existing_data)
+        # Deleting a key that had already expired is not a change anyone could have seen
+        live = not _expired(existing_data.expires_at, time.time())
+        if live:
+            log(session, [(key, "delete", None)])
+        session.commit()
+        return live
+
+    def _sweep(self, session, now, limit):
+        Data = self.model
+        # One short transaction per batch, walking the expires_at index from the oldest expiry
+        expired = session.query(Data.id).filter(Data.expires_at <= now).order_by(Data.expires_at).limit(limit)
+        ids = [row[0] for row in expired]
+        if ids:
+            session.query(Data).filter(Data.id.in_(ids)).delete(synchronize_session=False)
+        session.commit()
+        return len(ids)
+
+    def _recompress_batch(self, session, user_id, after, limit):
+        query = session.query(self.model).filter(self.model.user_id == user_id)
+        if after is not None:
+            query = query.filter(self.model.key > after)
+        rows = query.order_by(self.model.key).limit(limit).all()
+        before = after_bytes = 0
+        for row in rows:
+            before += self.codec.stored_size(row.codec, row.value, row.packed)
+            columns = self._encode(user_id, self._row_value(row))
+            after_bytes += self.codec.stored_size(columns["codec"], columns["value"], columns["packed"])
+            for name, column_value in columns.items():
+                setattr(row, name, column_value)
+        last_key = rows[-1].key if rows else after
+        session.commit()
+        return len(rows), before, after_bytes, last_key
+
+    def _delete_user(self, session, user_id):
+        deleted = session.query(self.model).filter_by(user_id=user_id).delete(synchronize_session=False)
+        session.commit()
+        return deleted
+
+    def _row_value(self, row):
+        if self.codec is None:
+            return row.value
+        return self.codec.decode(row.codec, row.value, row.packed)
+
+    def _load(self, session, user_id, keys):
+        Data = self.model
+        rows = {}
+        key_list = list(keys)
+        for start in range(0, len(key_list), self.QUERY_CHUNK):
+            chunk = key_list[start:start + self.QUERY_CHUNK]
+            for row in session.query(Data).filter(Data.user_id == user_id, Data.key.in_(chunk)):
+                rows[row.key] = row
+        return rows
+
+    def _put_many(self, session, log, user_id, items, metadata):
+        now = time.time()
+        expired = {}
+        existing = set()
+        for key, row in self._load(session, user_id, {key for key, _ in items}).items():
+            if _expired(row.expires_at, now):
+                expired[key] = row
+            else:
+                existing.add(key)
+        rows = []
+        skipped = []
+        changes = []
+        for position, (key, value) in enumerate(items):
+            if key in existing:
+                skipped.append(position)
+                continue
+            existing.add(key)
+            changes.append((key, "store", value))
+            if key in expired:
+                expires_at, version = metadata.get(key, (None, 1))
+                for name, column_value in dict(self._encode(user_id, value), expires_at=expires_at,
+                                               version=version).items():
+                    setattr(expired[key], name, column_value)
+                continue
+            expires_at, version = metadata.get(key, (None, 1))
+            rows.append({"user_id": user_id, "key": key, "expires_at": expires_at, "version": version,
+                         **self._encode(user_id, value)})
+        if rows:
+            session.execute(insert(self.model), rows)
+        log(session, changes)
+        session.commit()
+        return skipped
+
+    def _apply(self, session, log, user_id, keys, fn):
+        try:
+            rows = self._load(session, user_id, keys)
+            now = time.time()
+            original = {key: self._row_value(row) for key, row in rows.items()
+                        if not _expired(row.expires_at, now)}
+            values = BatchValues(original)
+            result = fn(values)
+
+            # Write back only what changed; a key that was expired, or deleted earlier in the batch,
+            # and is stored again starts over as a new key, without its old expiry and at version 1
+            #The change log gets the batch's net change to each key
+            changes = []
+            for key, row in rows.items():
+                if key not in values:
+                    if key in original:
+                        session.delete(row)
+                        changes.append((key, "delete", None))
+                elif key not in original or key in values.removed:
+                    for name, column_value in dict(self._encode(user_id, values[key]), expires_at=None,
+                                                   version=1).items():
+                        setattr(row, name, column_value)
+                    changes.append((key, "store", values[key]))
+                elif values[key] != original[key]:
+                    for name, column_value in dict(self._encode(user_id, values[key]), version=row.version + 1).items():
+                        setattr(row, name, column_value)
+                    changes.append((key, "update", values[key]))
+            session.flush()
+            for key, value in values.items():
+                if key not in rows:
+                    session.add(self.model(user_id=user_id, key=key, **self._encode(user_id, value)))
+                    changes.append((key, "store", value))
+            log(session, changes)
+            session.commit()
+            return result, values
+        except Exception:
+            session.rollback()
+            raise
+
+
+def _not_logged(session, changes):
+    #The log callable of a SqlAlchemyStorage without a change log
+    pass
+
+
+#In-memory storage in lock-striped shards
+#Each user's keys live in one shard, chosen by a hash of the user id, so a call takes exactly one lock
+#and calls for users in different shards never wait on each other. A user's keys are kept both in a
+#dict and in a sorted list, so scans are a binary search and a slice.
+#Keys with an expiry are also pushed on a per-shard heap ordered by expiry, which sweep() pops from;
+#entries left behind by a changed or deleted key are skipped there. Versions are only kept for keys
+#past version 1.
+#With snapshot_path set the data is loaded from that file at start, written to it every
+#snapshot_interval seconds (to a temporary file that then replaces it) and once more on close().
+class MemoryStorage(Storage):
+    def __init__(self, shards=16, snapshot_path=None, snapshot_interval=60):
+        self._shards = [{} for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._expiry_heaps = [[] for _ in range(shards)]
+        self.snapshot_path = snapshot_path
+        self._stop = threading.Event()
+        self._snapshot_thread = None
+        if snapshot_path:
+            self._load_snapshot()
+            if snapshot_interval:
+                self._snapshot_thread = threading.Thread(target=self._snapshot_loop, args=(snapshot_interval,),
+                                                         name="memory-storage-snapshot", daemon=True)
+                self._snapshot_thread.start()
+
+    def _shard_index(self, user_id):
+        return zlib.crc32(user_id.encode('utf-8')) % len(self._shards)
+
+    def _shard(self, user_id):
+        user_id = str(user_id)
+        index = self._shard_index(user_id)
+        return self._shards[index], self._locks[index], user_id
+
+    def _user(self, shard, user_id):
+        #Returns the user's (values, sorted keys, expiries, versions), creating them if needed
+        user = shard.get(user_id)
+        if user is None:
+            user = shard[user_id] = ({}, [], {}, {})
+        return user
+
+    def _live(self, user, key, now):
+        #True if the user has the key and it has not expired
+        return key in user[0] and not _expired(user[2].get(key), now)
+
+    def _set(self, user_id, user, key, value, expires_at, version=1):
+        #Called with the user's shard lock held
+        values, keys, expiries, versions = user
+        if key not in values:
+            bisect.insort(keys, key)
+        values[key] = value
+        if expires_at is None:
+            expiries.pop(key, None)
+        elif expiries.get(key) != expires_at:
+            expiries[key] = expires_at
+            heapq.heappush(self._expiry_heaps[self._shard_index(user_id)], (expires_at, user_id, key))
+        if version == 1:
+            versions.pop(key, None)
+        else:
+            versions[key] = version
+
+    def _replace(self, user_id, user, key, value):
+        #Writes a new value for a live key, keeping its expiry; returns the new version
+        version = user[3].get(key, 1) + 1
+        self._set(user_id, user, key, value, user[2].get(key), version)
+        return version
+
+    def _remove(self, user, key):
+        values, keys, expiries, versions = user
+        del values[key]
+        del keys[bisect.bisect_left(keys, key)]
+        expiries.pop(key, None)
+        versions.pop(key, None)
+
+    def get(self, user_id, key, with_meta=False):
+        shard, lock, user_id = self._shard(user_id)
+        with lock:
+            user = shard.get(user_id)
+            if not user or not self._live(user, key, time.time()):
+                return None
+            return (user[0][key], user[2].get(key), user[3].get(key, 1)) if with_meta else user[0][key]
+
+    def put(self, user_id, key, value, expires_at=None):
+        shard, lock, user_id = self._shard(user_id)
+        with lock:
+            user = self._user(shard, user_id)
+            if self._live(user, key, time.time()):
+                return False
+            self._set(user_id, user, key, value, expires_at)
+            return True
+
+    def update(self, user_id, key, value, check=None, expires_at=None):
+        shard, lock, user_id = self._shard(user_id)
+        with lock:
+            user = self._user(shard, user_id)
+            if not self._live(user, key, time.time()):
+                return False
+            if check is not None and not check(user[0][key]):
+                raise PreconditionFailed()
+            self._set(user_id, user, key, value, expires_at if expires_at is not None else user[2].get(key),
+                      user[3].get(key, 1) + 1)
+            return True
+
+    def delete(self, user_id, key):
+        shard, lock, user_id = self._shard(user_id)
+        with lock:
+            user = self._user(shard, user_id)
+            if key not in user[0]:
+                return False
+            live = self._live(user, key, time.time())
+            self._remove(user, key)
+            return live
+
+    def scan(self, user_id, prefix="", after=None, limit=None, with_values=False):
+        shard, lock, user_id = self._shard(user_id)
+        with lock:
+            user = shard.get(user_id)
+            if not user:
+                return []
+            values, keys, expiries, _ = user
+            now = time.time()
+            selected = select_live_keys(keys, lambda key: not _expired(expiries.get(key), now),
+                                        prefix, after, limit) if expiries else select_keys(keys, prefix, after, limit)
+            return [(key, values[key] if with_values else None) for key in selected]
+
+    def put_many(self, user_id, items):
+        shard, lock, user_id = self._shard(user_id)
+        with lock:
+            user = self._user(shard, user_id)
+            now = time.time()
+            skipped = []
+            for position, (key, value) in enumerate(items):
+                if self._live(user, key, now):
+                    skipped.append(position)
+                    continue
+                self._set(user_id, user, key, value, None)
+            return skipped
+
+    def apply(self, user_id, keys, fn):
+        shard, lock, user_id = self._shard(user_id)
+        with lock:
+            user = self._user(shard, user_id)
+            now = time.time()
+            original = {key: user[0][key] for key in keys if self._live(user, key, now)}
+            values = BatchValues(original)
+            # fn works on a copy, so an exception leaves the stored data untouched
+            result = fn(values)
+            for key in original:
+                if key not in values:
+                    self._remove(user, key)
+            for key, value in values.items():
+                if key not in original or key in values.removed:
+                    self._set(user_id, user, key, value, None)
+                elif value != original[key]:
+                    self._replace(user_id, user, key, value)
+            return result, values
+
+    def increment(self, user_id, key, delta):
+        shard, lock, user_id = self._shard(user_id)
+        with lock:
+            user = self._user(shard, user_id)
+            if not self._live(user, key, time.time()):
+                return None
+            value = add_to_integer(user[0][key], delta)
+            return int(value), self._replace(user_id, user, key, value)
+
+    def compare_and_swap(self, user_id, key, value, version):
+        shard, lock, user_id = self._shard(user_id)
+        with lock:
+            user = self._user(shard, user_id)
+            if not self._live(user, key, time.time()):
+                return None
+            if user[3].get(key, 1) != version:
+                raise VersionConflict(user[3].get(key, 1))
+            return self._replace(user_id, user, key, value)
+
+    def sweep(self, now, limit):
+        removed = 0
+        for shard, lock, heap in zip(self._shards, self._locks, self._expiry_heaps):
+            with lock:
+                while heap and heap[0][0] <= now and removed < limit:
+                    expires_at, user_id, key = heapq.heappop(heap)
+                    user = shard.get(user_id)
+                    # Entries for keys that were deleted or given a new expiry since are stale
+                    if user is not None and user[2].get(key) == expires_at:
+                        self._remove(user, key)
+                        removed += 1
+            if removed >= limit:
+                break
+        return removed
+
+    def expiry_backlog(self, now):
+        #Looks only at the due entries of the expiry heaps; stale ones are not counted, and a key that
+        #was given the same expiry again is counted once
+        due = {}
+        for shard, lock, heap in zip(self._shards, self._locks, self._expiry_heaps):
+            with lock:
+                for expires_at, user_id, key in due_entries(heap, now):
+                    user = shard.get(user_id)
+                    if user is not None and user[2].get(key) == expires_at:
+                        due[user_id, key] = expires_at
+        return len(due), min(due.values()) if due else None
+
+    def clear(self):
+        for shard, lock, heap in zip(self._shards, self._locks, self._expiry_heaps):
+            with lock:
+                shard.clear()
+                heap.clear()
+
+    def close(self):
+        self._stop.set()
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+        if self.snapshot_path:
+            self.snapshot()
+
+    def snapshot(self):
+        #Writes every shard to snapshot_path; each shard is copied under its own lock
+        #A user is saved as {key: value}, or as [{key: value}, {key: expires_at}, {key: version}] if any
+        #key expires or is past version 1
+        data = {}
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                for user_id, (values, _, expiries, versions) in shard.items():
+                    if values:
+                        data[user_id] = [dict(values), dict(expiries), dict(versions)] if expiries or versions \
+                            else dict(values)
+        temporary_path = f"{self.snapshot_path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as snapshot_file:
+            json.dump(data, snapshot_file, separators=(',', ':'))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+
+    def _load_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return
+        with open(self.snapshot_path, encoding="utf-8") as snapshot_file:
+            data = json.load(snapshot_file)
+        for user_id, entry in data.items():
+            # Older snapshots have no versions
+            values, expiries, versions = (entry + [{}])[:3] if isinstance(entry, list) else (entry, {}, {})
+            shard, lock, user_id = self._shard(user_id)
+            with lock:
+                user = self._user(shard, user_id)
+                for key, value in values.items():
+                    self._set(user_id, user, key, value, expiries.get(key), versions.get(key, 1))
+
+    def _snapshot_loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.snapshot()
+            except OSError as e:
+                print(f"Memory storage snapshot failed: {str(e)}")
@@ -2,8 +2,28 @@ import unittest
 import json
 from datetime import timedelta
 import time
-from flask import session
-from app import app, db, User, Data
+import io
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import requests
+from flask import session, template_rendered
+from sqlalchemy import create_engine
+import app as app_module
+from app import app, db, User, Data, data_cache, token_cache
+from cache import LRUCache
+from storage import MemoryStorage, SqlAlchemyStorage
+from sqlite_pool import WALDatabase
+from log_storage import LogStorage
+from sharding import ShardedStorage, default_shard
+from blob_store import BlobTooLarge, BlobChanged, BlobAbandoned
+from migrations import rebuild_table
+from change_feed import ChangeFeed
+from notifier import WatchNotifier
+from hashing import PasswordHasher, hash_rounds
+from benchmark import percentile, summarise, compare_results
 from flask_jwt_extended import create_access_token
 
 #the database if for testing 
@@ -13,6 +33,8 @@ class FlaskAppTests(unittest.TestCase):
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
         app.config['WTF_CSRF_ENABLED'] = False
         app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(seconds=1)
+        # Tests run the expiry sweeper themselves
+        app.config['EXPIRY_SWEEP_ENABLED'] = False
         self.app = app.test_client()
         self.ctx = app.app_context()
         self.ctx.push()
@@ -253,6 +275,1725 @@ class FlaskAppTests(unittest.TestCase):
         self.assertIn(response.status_code, [302, 401, 500])  
         print("test_expired_token_data_operation_passed")
 
+###################################################
+#Tests for the batch data API
+    def test_6_batch_data_scenarios(self):
+        """Test batch data operation scenarios"""
+
+        self.app.post('/api/register', data={
+            'username': 'testuser',
+            'email': 'test@example.com',
+            'password': 'Test@123',
+            'full_name': 'Test User',
+            'age': '25',
+            'gender': 'Male'
+        })
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        # Tests mixed operations in one batch
+        batch = {'operations': [
+            {'op': 'store', 'key': 'k1', 'value': 'v1'},
+            {'op': 'store', 'key': 'k2', 'value': 'v2'},
+            {'op': 'store', 'key': 'k1', 'value': 'again'},
+            {'op': 'update', 'key': 'k2', 'value': 'v2-updated'},
+            {'op': 'retrieve', 'key': 'k2'},
+            {'op': 'delete', 'key': 'k1'},
+            {'op': 'retrieve', 'key': 'missing'},
+            {'op': 'rename', 'key': 'k2'}
+        ]}
+        response = self.app.post('/api/data/batch', json=batch)
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()['data']['results']
+        self.assertEqual([r['status'] for r in results],
+                         ['success', 'success', 'error', 'success', 'success', 'success', 'error', 'error'])
+        self.assertEqual(results[2]['code'], 'KEY_EXISTS')
+        self.assertEqual(results[4]['data']['value'], 'v2-updated')
+        self.assertEqual(results[6]['code'], 'KEY_NOT_FOUND')
+        self.assertEqual(results[7]['code'], 'INVALID_OPERATION')
+        print("test_mixed_batch_passed")
+
+        # Tests the batch was committed
+        self.assertIsNone(Data.query.filter_by(user_id=1, key='k1').first())
+        self.assertEqual(Data.query.filter_by(user_id=1, key='k2').first().value, 'v2-updated')
+        print("test_batch_committed_passed")
+
+        # Tests store after delete of the same key in one batch
+        response = self.app.post('/api/data/batch', json={'operations': [
+            {'op': 'delete', 'key': 'k2'},
+            {'op': 'store', 'key': 'k2', 'value': 'fresh'}
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Data.query.filter_by(user_id=1, key='k2').first().value, 'fresh')
+        print("test_batch_delete_then_store_passed")
+
+        # Tests invalid batch body
+        response = self.app.post('/api/data/batch', json={'operations': []})
+        self.assertEqual(response.status_code, 400)
+        print("test_empty_batch_passed")
+
+###################################################
+#Tests for the data read-through cache
+    def test_7_data_cache_scenarios(self):
+        """Test data cache population and invalidation"""
+
+        self.app.post('/api/register', data={
+            'username': 'testuser',
+            'email': 'test@example.com',
+            'password': 'Test@123',
+            'full_name': 'Test User',
+            'age': '25',
+            'gender': 'Male'
+        })
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        app.config['DATA_CACHE_ENABLED'] = True
+        data_cache.clear()
+        try:
+            # Tests store populates the cache
+            self.app.post('/api/data', data={'key': 'cached_key', 'value': 'cached_value'})
+            self.assertEqual(data_cache.get(('1', 'cached_key')), ('cached_value', 1))
+            print("test_store_populates_cache_passed")
+
+            # Tests retrieve is served from the cache
+            hits = data_cache.hits
+            response = self.app.get('/api/data/retrieve?key=cached_key')
+            self.assertIn(b'cached_value', response.data)
+            self.assertEqual(data_cache.hits, hits + 1)
+            print("test_retrieve_cache_hit_passed")
+
+            # Tests update invalidates the cache
+            self.app.post('/api/data/update', data={'key': 'cached_key', 'value': 'new_value'})
+            self.assertIsNone(data_cache.get(('1', 'cached_key')))
+            response = self.app.get('/api/data/retrieve?key=cached_key')
+            self.assertIn(b'new_value', response.data)
+            print("test_update_invalidates_cache_passed")
+
+            # Tests delete invalidates the cache
+            self.app.post('/api/data/delete', data={'key': 'cached_key'})
+            response = self.app.get('/api/data/retrieve?key=cached_key')
+            self.assertIn(b'does not exist', response.data)
+            print("test_delete_invalidates_cache_passed")
+
+            # Tests a retrieve that read a value before a concurrent update does not cache it afterwards
+            self.app.post('/api/data', data={'key': 'raced_key', 'value': 'old_value'})
+            data_cache.clear()
+            storage = app_module.data_storage
+            get = storage.get
+            def get_then_update(user_id, key, with_meta=False):
+                stored = get(user_id, key, with_meta)
+                storage.update(user_id, key, 'new_value')
+                app_module._invalidate_value(user_id, key)
+                return stored
+            storage.get = get_then_update
+            try:
+                response = self.app.get('/api/data/retrieve?key=raced_key')
+            finally:
+                del storage.get
+            self.assertIn(b'old_value', response.data)
+            self.assertIsNone(data_cache.get(('1', 'raced_key')))
+            response = self.app.get('/api/data/retrieve?key=raced_key')
+            self.assertIn(b'new_value', response.data)
+            print("test_stale_read_not_cached_passed")
+        finally:
+            app.config['DATA_CACHE_ENABLED'] = False
+            data_cache.clear()
+
+        # Tests entry and byte bounds
+        cache = LRUCache(max_entries=2, max_bytes=10)
+        cache.set('a', 'x', size=4)
+        cache.set('b', 'y', size=4)
+        cache.get('a')
+        cache.set('c', 'z', size=4)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'x')
+        self.assertEqual(cache.stats()['evictions'], 1)
+        print("test_cache_bounds_passed")
+
+        # Tests a set is dropped if its key was invalidated since the given generation, or if that
+        # invalidation is too old to be remembered
+        generation = cache.generation()
+        cache.invalidate('a')
+        cache.set('a', 'stale', since=generation)
+        cache.set('b', 'fresh', since=generation)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 'fresh')
+        cache.set('a', 'fresh', since=cache.generation())
+        self.assertEqual(cache.get('a'), 'fresh')
+        generation = cache.generation()
+        for key in ('x', 'y', 'z'):
+            cache.invalidate(key)
+        cache.set('b', 'stale', since=generation)
+        self.assertEqual(cache.get('b'), 'fresh')
+        print("test_cache_invalidation_generation_passed")
+
+###################################################
+#Tests for the verified token cache
+    def test_8_token_cache_scenarios(self):
+        """Test verified token claims are cached until expiry"""
+
+        self.app.post('/api/register', data={
+            'username': 'testuser',
+            'email': 'test@example.com',
+            'password': 'Test@123',
+            'full_name': 'Test User',
+            'age': '25',
+            'gender': 'Male'
+        })
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(seconds=3))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        token_cache.clear()
+
+        # Tests the second request reuses the verified claims
+        response = self.app.get('/dashboard')
+        self.assertEqual(response.status_code, 200)
+        hits = token_cache.hits
+        response = self.app.get('/dashboard')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(token_cache.hits, hits + 1)
+        print("test_token_cache_hit_passed")
+
+        # Tests cached claims are not used past the token's expiry
+        time.sleep(4)
+        response = self.app.get('/dashboard')
+        self.assertEqual(response.status_code, 401)
+        response = self.app.post('/api/data', data={'key': 'k', 'value': 'v'})
+        self.assertEqual(response.status_code, 401)
+        print("test_token_cache_expiry_passed")
+
+###################################################
+#Tests for the online data table rebuild
+    def test_9_data_table_migration_scenarios(self):
+        """Test rebuilding a legacy data table to the composite key schema"""
+
+        # Build a database with the old globally unique key column
+        fd, path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        legacy = sqlite3.connect(path)
+        legacy.executescript("""
+            CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR(100), email VARCHAR(100),
+                               password VARCHAR(200), full_name VARCHAR(100), age INTEGER, gender VARCHAR(20));
+            CREATE TABLE data (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES user(id),
+                               key VARCHAR(100) NOT NULL UNIQUE, value VARCHAR(100) NOT NULL);
+            INSERT INTO user (id, username) VALUES (1, 'a'), (2, 'b');
+        """)
+        legacy.executemany("INSERT INTO data (user_id, key, value) VALUES (1, ?, ?)",
+                           [(f"key{i}", f"value{i}") for i in range(25)])
+        legacy.commit()
+        legacy.close()
+
+        engine = create_engine(f"sqlite:///{path}")
+        try:
+            copied = rebuild_table(engine, Data.__table__, batch_size=4, pause=0, log=lambda message: None)
+            self.assertEqual(copied, 25)
+            print("test_rows_copied_passed")
+
+            conn = sqlite3.connect(path)
+            # Tests the data survived and two users can now share a key
+            self.assertEqual(conn.execute("SELECT count(*) FROM data").fetchone()[0], 25)
+            conn.execute("INSERT INTO data (user_id, key, value) VALUES (2, 'key0', 'other')")
+            with self.assertRaises(sqlite3.IntegrityError):
+                conn.execute("INSERT INTO data (user_id, key, value) VALUES (1, 'key0', 'dup')")
+            indexes = [row[1] for row in conn.execute("PRAGMA index_list('data')")]
+            self.assertIn('ix_data_user_id_key', indexes)
+            tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            self.assertNotIn('data_old', tables)
+            self.assertNotIn('data_new', tables)
+            conn.commit()
+            conn.close()
+            print("test_composite_key_schema_passed")
+
+            # Tests a second rebuild of an up to date table is safe
+            self.assertEqual(rebuild_table(engine, Data.__table__, batch_size=4, pause=0, log=lambda message: None), 26)
+            print("test_repeat_rebuild_passed")
+        finally:
+            engine.dispose()
+            os.remove(path)
+
+###################################################
+#Tests for the WAL single writer / read only pool mode
+    def test_10_wal_mode_scenarios(self):
+        """Test data operations through the WAL writer queue and read pool"""
+
+        app.config['SQLITE_WAL_MODE'] = True
+        try:
+            response = self.app.post('/api/register', data={
+                'username': 'testuser',
+                'email': 'test@example.com',
+                'password': 'Test@123',
+                'full_name': 'Test User',
+                'age': '25',
+                'gender': 'Male'
+            })
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'testuser', response.data)
+            print("test_wal_register_passed")
+
+            with app.app_context():
+                access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+            # Tests concurrent writers do not hit "database is locked"
+            def store(index):
+                client = app.test_client()
+                with client.session_transaction() as sess:
+                    sess['user_id'] = 1
+                    sess['access_token'] = access_token
+                statuses.append(client.post('/api/data', data={'key': f'key{index}', 'value': 'value'}).status_code)
+
+            statuses = []
+            threads = [threading.Thread(target=store, args=(index,)) for index in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(statuses, [200] * 20)
+            print("test_wal_concurrent_writes_passed")
+
+            with self.app.session_transaction() as sess:
+                sess['user_id'] = 1
+                sess['access_token'] = access_token
+
+            # Tests reads come from the read only pool
+            response = self.app.get('/api/data/retrieve?key=key7')
+            self.assertIn(b'Value: value', response.data)
+            response = self.app.get('/dashboard')
+            self.assertEqual(response.status_code, 200)
+            with app_module.wal_database.read_session() as read_session:
+                self.assertEqual(read_session.execute(db.text("PRAGMA journal_mode")).scalar(), 'wal')
+                with self.assertRaises(Exception):
+                    read_session.execute(db.text("DELETE FROM data"))
+            print("test_wal_read_pool_passed")
+
+            # Tests update and delete through the writer
+            self.app.post('/api/data/update', data={'key': 'key7', 'value': 'changed'})
+            response = self.app.get('/api/data/retrieve?key=key7')
+            self.assertIn(b'Value: changed', response.data)
+            self.app.post('/api/data/delete', data={'key': 'key7'})
+            response = self.app.get('/api/data/retrieve?key=key7')
+            self.assertIn(b'does not exist', response.data)
+            print("test_wal_update_delete_passed")
+        finally:
+            app.config['SQLITE_WAL_MODE'] = False
+
+###################################################
+#Tests for the bcrypt worker pool
+    def test_11_password_hashing_scenarios(self):
+        """Test bcrypt pool saturation and rehash on login"""
+
+        rounds = app.config['BCRYPT_ROUNDS']
+        app.config['BCRYPT_ROUNDS'] = 4
+        try:
+            self.app.post('/api/register', data={
+                'username': 'testuser',
+                'email': 'test@example.com',
+                'password': 'Test@123',
+                'full_name': 'Test User',
+                'age': '25',
+                'gender': 'Male'
+            })
+            self.assertEqual(hash_rounds(User.query.filter_by(username='testuser').first().password), 4)
+            print("test_configured_rounds_passed")
+
+            # Tests a changed cost is applied on the next successful login
+            app.config['BCRYPT_ROUNDS'] = 5
+            response = self.app.post('/api/token', data={'username': 'testuser', 'password': 'Test@123'})
+            self.assertEqual(response.status_code, 200)
+            db.session.expire_all()
+            self.assertEqual(hash_rounds(User.query.filter_by(username='testuser').first().password), 5)
+            response = self.app.post('/api/token', data={'username': 'testuser', 'password': 'Test@123'})
+            self.assertEqual(response.status_code, 200)
+            print("test_rehash_on_login_passed")
+
+            # Tests a saturated pool sheds the request with 503
+            hasher = app_module.password_hasher
+            app_module.password_hasher = PasswordHasher(workers=1, max_pending=0)
+            try:
+                response = self.app.post('/api/token', data={'username': 'testuser', 'password': 'Test@123'})
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response.headers['Retry-After'], '1')
+                self.assertEqual(response.get_json()['code'], 'SERVICE_BUSY')
+            finally:
+                app_module.password_hasher = hasher
+            print("test_hasher_busy_passed")
+        finally:
+            app.config['BCRYPT_ROUNDS'] = rounds
+
+###################################################
+#Tests for the key listing API
+    def test_12_key_listing_scenarios(self):
+        """Test cursor paginated key listing and prefix scans"""
+
+        self.app.post('/api/register', data={
+            'username': 'testuser',
+            'email': 'test@example.com',
+            'password': 'Test@123',
+            'full_name': 'Test User',
+            'age': '25',
+            'gender': 'Male'
+        })
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        keys = ['app:1', 'app:2', 'app:3', 'apple', 'b', 'App:4']
+        self.app.post('/api/data/batch', json={'operations': [
+            {'op': 'store', 'key': key, 'value': f'value-{key}'} for key in keys
+        ]})
+
+        # Tests walking every page with the cursor
+        listed = []
+        cursor = None
+        while True:
+            url = '/api/data/keys?limit=2' + (f'&cursor={cursor}' if cursor else '')
+            response = self.app.get(url)
+            self.assertEqual(response.status_code, 200)
+            page = response.get_json()['data']
+            self.assertLessEqual(len(page['keys']), 2)
+            listed.extend(page['keys'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(listed, sorted(keys))
+        print("test_key_pagination_passed")
+
+        # Tests prefix scans are exact and case sensitive
+        response = self.app.get('/api/data/keys?prefix=app:&values=1')
+        self.assertEqual(response.get_json()['data']['keys'], [
+            {'key': 'app:1', 'value': 'value-app:1'},
+            {'key': 'app:2', 'value': 'value-app:2'},
+            {'key': 'app:3', 'value': 'value-app:3'}
+        ])
+        self.assertIsNone(response.get_json()['data']['next_cursor'])
+        print("test_key_prefix_scan_passed")
+
+        # Tests invalid parameters
+        self.assertEqual(self.app.get('/api/data/keys?limit=0').status_code, 400)
+        self.assertEqual(self.app.get('/api/data/keys?limit=abc').status_code, 400)
+        self.assertEqual(self.app.get('/api/data/keys?cursor=%%%').status_code, 400)
+        print("test_key_listing_invalid_parameters_passed")
+
+###################################################
+#Tests for NDJSON export and import
+    def test_13_export_import_scenarios(self):
+        """Test streaming export and batched import"""
+
+        self.app.post('/api/register', data={
+            'username': 'testuser',
+            'email': 'test@example.com',
+            'password': 'Test@123',
+            'full_name': 'Test User',
+            'age': '25',
+            'gender': 'Male'
+        })
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        # Tests import in several batches with conflicts and invalid lines
+        batch_size = app.config['DATA_IMPORT_BATCH_SIZE']
+        app.config['DATA_IMPORT_BATCH_SIZE'] = 3
+        try:
+            self.app.post('/api/data', data={'key': 'key2', 'value': 'existing'})
+            lines = [json.dumps({'key': f'key{i}', 'value': f'value{i}'}) for i in range(10)]
+            lines.insert(4, 'not json')
+            lines.append(json.dumps({'key': 'key0', 'value': 'duplicate'}))
+            lines.append(json.dumps({'key': 'key99'}))
+            response = self.app.post('/api/data/import', data='\n'.join(lines) + '\n',
+                                     content_type='application/x-ndjson')
+            self.assertEqual(response.status_code, 200)
+            result = response.get_json()['data']
+            self.assertEqual(result['imported'], 9)
+            self.assertEqual(result['conflicts'], 2)
+            self.assertEqual(result['invalid'], 2)
+            self.assertEqual(sorted(error['code'] for error in result['errors']),
+                             ['INVALID_REQUEST', 'INVALID_VALUE', 'KEY_EXISTS', 'KEY_EXISTS'])
+            self.assertEqual(Data.query.filter_by(user_id=1, key='key2').first().value, 'existing')
+            print("test_import_passed")
+        finally:
+            app.config['DATA_IMPORT_BATCH_SIZE'] = batch_size
+
+        # Tests export streams every row in key order
+        response = self.app.get('/api/data/export')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        exported = [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+        self.assertEqual([row['key'] for row in exported], sorted(f'key{i}' for i in range(10)))
+        self.assertEqual(exported[2], {'key': 'key2', 'value': 'existing'})
+        print("test_export_passed")
+
+        # Tests the export still streams once the request has returned, as it does under a real server
+        chunk_size = app.config['DATA_EXPORT_CHUNK_SIZE']
+        app.config['DATA_EXPORT_CHUNK_SIZE'] = 3
+        self.ctx.pop()
+        try:
+            response = self.app.get('/api/data/export')
+            exported = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+            response.close()
+        finally:
+            app.config['DATA_EXPORT_CHUNK_SIZE'] = chunk_size
+            self.ctx = app.app_context()
+            self.ctx.push()
+        self.assertEqual([row['key'] for row in exported], sorted(f'key{i}' for i in range(10)))
+        print("test_export_without_app_context_passed")
+
+###################################################
+#Tests for the benchmark result checks
+    def test_14_benchmark_regression_scenarios(self):
+        """Test benchmark summaries and baseline comparison"""
+
+        # Tests nearest-rank percentiles
+        values = [i / 1000 for i in range(1, 101)]
+        self.assertEqual(percentile(values, 0.50), 0.05)
+        self.assertEqual(percentile(values, 0.99), 0.099)
+        summary = summarise(values, errors=0, shed=3, elapsed=2.0)
+        self.assertEqual(summary['throughput_rps'], 50.0)
+        self.assertEqual(summary['shed'], 3)
+        self.assertEqual(summary['p95_ms'], 95.0)
+        print("test_benchmark_summary_passed")
+
+        # Tests a slower route is reported and an unchanged one is not
+        baseline = {'routes': {'retrieve_data': summary, 'store_data': summary}}
+        slower = dict(summary, p95_ms=summary['p95_ms'] * 1.5)
+        current = {'routes': {'retrieve_data': slower, 'store_data': summary}}
+        regressions = compare_results(baseline, current, threshold=0.2)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('retrieve_data'))
+        self.assertEqual(compare_results(baseline, baseline, threshold=0.2), [])
+        print("test_benchmark_regression_passed")
+
+###################################################
+#Tests for the metrics endpoint
+    def test_15_metrics_scenarios(self):
+        """Test request, error code, bcrypt and SQL metrics are exported"""
+
+        self.app.post('/api/register', data={
+            'username': 'testuser',
+            'email': 'test@example.com',
+            'password': 'Test@123',
+            'full_name': 'Test User',
+            'age': '25',
+            'gender': 'Male'
+        })
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        self.app.post('/api/data', data={'key': 'metric_key', 'value': 'value'})
+        self.app.post('/api/data', data={'key': 'metric_key', 'value': 'value'})
+        self.app.get('/api/data/retrieve?key=missing')
+
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.data.decode('utf-8')
+
+        # Tests per endpoint counts and latency histograms
+        self.assertIn('dpd_http_requests_total{endpoint="store_data",method="POST",status="409"}', text)
+        self.assertIn('dpd_http_request_duration_seconds_bucket{endpoint="retrieve_data"', text)
+        self.assertIn('dpd_http_requests_in_progress{endpoint="metrics"} 1.0', text)
+        print("test_request_metrics_passed")
+
+        # Tests error codes from JSON responses and rendered messages
+        self.assertIn('dpd_http_error_codes_total{code="KEY_EXISTS",endpoint="store_data"}', text)
+        self.assertIn('dpd_http_error_codes_total{code="KEY_NOT_FOUND",endpoint="retrieve_data"}', text)
+        print("test_error_code_metrics_passed")
+
+        # Tests bcrypt and SQL timings
+        self.assertIn('dpd_bcrypt_seconds_count{operation="hash"}', text)
+        self.assertIn('dpd_db_query_duration_seconds_count', text)
+        print("test_internal_metrics_passed")
+
+    def test_16_profiling_scenarios(self):
+        """Test Server-Timing phases, N+1 warnings and the slow query log"""
+
+        self.app.post('/api/register', data={
+            'username': 'testuser',
+            'email': 'test@example.com',
+            'password': 'Test@123',
+            'full_name': 'Test User',
+            'age': '25',
+            'gender': 'Male'
+        })
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        self.app.post('/api/data', data={'key': 'profile_key', 'value': 'value'})
+
+        # Tests no header is added unless profiling is enabled
+        response = self.app.get('/api/data/retrieve?key=profile_key')
+        self.assertNotIn('Server-Timing', response.headers)
+        print("test_profiling_disabled_passed")
+
+        app.config['PROFILING_ENABLED'] = True
+        app.config['PROFILING_SLOW_QUERY_MS'] = 0
+        app.config['PROFILING_N_PLUS_ONE_THRESHOLD'] = 0
+        data_cache.clear()
+        try:
+            with self.assertLogs('dpd.slow_query', level='WARNING') as slow_logs, \
+                    self.assertLogs(app.logger, level='WARNING') as app_logs:
+                response = self.app.get('/api/data/retrieve?key=profile_key')
+        finally:
+            app.config['PROFILING_ENABLED'] = False
+            app.config['PROFILING_SLOW_QUERY_MS'] = 100
+            app.config['PROFILING_N_PLUS_ONE_THRESHOLD'] = 10
+
+        # Tests the Server-Timing phases
+        timing = response.headers['Server-Timing']
+        for phase in ('auth;dur=', 'db;dur=', '1 queries', 'render;dur=', 'session;dur=', 'total;dur='):
+            self.assertIn(phase, timing)
+        print("test_server_timing_passed")
+
+        # Tests repeated statements are reported and slow queries are logged with parameters and plan
+        self.assertTrue(any('Possible N+1 query' in line for line in app_logs.output))
+        slow_query = slow_logs.output[0]
+        self.assertIn("'profile_key'", slow_query)
+        self.assertIn('ix_data_user_id_key', slow_query)
+        print("test_query_logs_passed")
+
+    def test_17_json_api_scenarios(self):
+        """Test JSON responses for clients that send Accept: application/json"""
+
+        json_headers = {'Accept': 'application/json'}
+
+        # Tests registration returns the message dict as JSON
+        response = self.app.post('/api/register', headers=json_headers, data={
+            'username': 'testuser',
+            'email': 'test@example.com',
+            'password': 'Test@123',
+            'full_name': 'Test User',
+            'age': '25',
+            'gender': 'Male'
+        })
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(response.get_json()['data']['username'], 'testuser')
+        print("test_json_registration_passed")
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        rendered = []
+        def record(sender, template, context, **extra):
+            rendered.append(template.name)
+        template_rendered.connect(record, app)
+        try:
+            # Tests data routes answer with compact JSON and no template is rendered
+            response = self.app.post('/api/data', headers=json_headers, data={'key': 'json_key', 'value': 'value'})
+            self.assertEqual(response.get_json(), {"status": "success", "message": "Data stored successfully."})
+            self.assertEqual(response.data, b'{"status":"success","message":"Data stored successfully."}')
+
+            response = self.app.get('/api/data/retrieve?key=json_key', headers=json_headers)
+            self.assertEqual(response.get_json()['data'], {"key": "json_key", "value": "value", "version": 1})
+
+            response = self.app.post('/api/data/update', headers=json_headers, data={'key': 'missing', 'value': 'v'})
+            self.assertEqual(response.get_json()['code'], 'KEY_NOT_FOUND')
+
+            response = self.app.post('/api/data/delete', headers=json_headers, data={'key': 'json_key'})
+            self.assertEqual(response.get_json()['status'], 'success')
+            self.assertEqual(rendered, [])
+            print("test_json_data_routes_passed")
+
+            # Tests browsers and clients without an Accept header still get HTML
+            response = self.app.get('/api/data/retrieve?key=missing')
+            self.assertIn('text/html', response.content_type)
+            response = self.app.get('/api/data/retrieve?key=missing', headers={'Accept': 'text/html,*/*;q=0.8'})
+            self.assertIn('text/html', response.content_type)
+            self.assertEqual(rendered, ['retrieve_data.html', 'retrieve_data.html'])
+            print("test_html_negotiation_passed")
+        finally:
+            template_rendered.disconnect(record, app)
+
+        # Tests error responses are still JSON with the same dicts
+        response = self.app.post('/api/data', headers=json_headers, data={'key': '', 'value': 'v'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['code'], 'INVALID_KEY')
+        print("test_json_errors_passed")
+
+    def test_18_conditional_request_scenarios(self):
+        """Test ETags, If-None-Match on retrieve and If-Match on update"""
+
+        self.app.post('/api/register', data={
+            'username': 'testuser',
+            'email': 'test@example.com',
+            'password': 'Test@123',
+            'full_name': 'Test User',
+            'age': '25',
+            'gender': 'Male'
+        })
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        self.app.post('/api/data', data={'key': 'etag_key', 'value': 'first'})
+
+        # Tests retrieve returns a strong ETag and answers a matching If-None-Match with 304
+        response = self.app.get('/api/data/retrieve?key=etag_key')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+
+        response = self.app.get('/api/data/retrieve?key=etag_key', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        print("test_not_modified_passed")
+
+        # Tests If-Match on update only replaces the value it was given the ETag of
+        response = self.app.post('/api/data/update', data={'key': 'etag_key', 'value': 'second'},
+                                 headers={'If-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        new_etag = response.headers['ETag']
+        self.assertNotEqual(new_etag, etag)
+
+        response = self.app.post('/api/data/update', data={'key': 'etag_key', 'value': 'third'},
+                                 headers={'If-Match': etag})
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(json.loads(response.data)['code'], 'PRECONDITION_FAILED')
+
+        response = self.app.post('/api/data/update', data={'key': 'etag_key', 'value': 'third'},
+                                 headers={'If-Match': '*'})
+        self.assertEqual(response.status_code, 200)
+        print("test_if_match_passed")
+
+        # Tests a changed value no longer matches the old ETag
+        response = self.app.get('/api/data/retrieve?key=etag_key', headers={'If-None-Match': new_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'third', response.data)
+        print("test_modified_passed")
+
+        # Tests a 304 is answered from the stored ETag without reading the value, also for old rows
+        etag = response.headers['ETag']
+        storage = app_module.data_storage
+        reads = []
+        get = storage.get
+        storage.get = lambda *args, **kwargs: reads.append(args) or get(*args, **kwargs)
+        try:
+            response = self.app.get('/api/data/retrieve?key=etag_key', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers['ETag'], etag)
+            self.assertEqual(reads, [])
+            Data.query.filter_by(key='etag_key').update({'etag': None})
+            db.session.commit()
+            response = self.app.get('/api/data/retrieve?key=etag_key', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+        finally:
+            del storage.get
+        self.app.post('/api/data', data={'key': 'etag_counter', 'value': '1'})
+        self.app.post('/api/data/increment', data={'key': 'etag_counter'})
+        self.assertEqual(storage.etag('1', 'etag_counter'), app_module.value_etag('2'))
+        print("test_not_modified_from_stored_etag_passed")
+
+    #Runs the data routes against data_storage in place of the configured storage
+    def _check_storage_routes(self, data_storage, name):
+        self.app.post('/api/register', data={
+            'username': 'testuser',
+            'email': 'test@example.com',
+            'password': 'Test@123',
+            'full_name': 'Test User',
+            'age': '25',
+            'gender': 'Male'
+        })
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        storage = app_module.data_storage
+        app_module.data_storage = data_storage
+        try:
+            # Tests the single key routes
+            response = self.app.post('/api/data', data={'key': 'mem_key', 'value': 'value'})
+            self.assertIn(b'Data stored successfully.', response.data)
+            response = self.app.post('/api/data', data={'key': 'mem_key', 'value': 'value'})
+            self.assertEqual(response.status_code, 409)
+            response = self.app.get('/api/data/retrieve?key=mem_key')
+            self.assertIn(b'value', response.data)
+            response = self.app.post('/api/data/update', data={'key': 'mem_key', 'value': 'changed'},
+                                     headers={'If-Match': '"stale"'})
+            self.assertEqual(response.status_code, 412)
+            response = self.app.post('/api/data/update', data={'key': 'mem_key', 'value': 'changed'})
+            self.assertIn(b'Data updated successfully.', response.data)
+            response = self.app.post('/api/data/delete', data={'key': 'mem_key'})
+            self.assertIn(b'Data deleted successfully.', response.data)
+            self.assertIsNone(data_storage.get('1', 'mem_key'))
+            self.assertIsNone(Data.query.filter_by(user_id=1, key='mem_key').first())
+            print(f"test_{name}_single_key_routes_passed")
+
+            # Tests batches, listing and export
+            response = self.app.post('/api/data/batch', json={'operations': [
+                {'op': 'store', 'key': 'b', 'value': '2'},
+                {'op': 'store', 'key': 'a', 'value': '1'},
+                {'op': 'delete', 'key': 'a'},
+                {'op': 'store', 'key': 'a', 'value': '3'},
+                {'op': 'store', 'key': 'c', 'value': '4'}
+            ]})
+            self.assertEqual([result['status'] for result in response.get_json()['data']['results']],
+                             ['success'] * 5)
+            response = self.app.get('/api/data/keys?limit=2&values=1')
+            data = response.get_json()['data']
+            self.assertEqual(data['keys'], [{'key': 'a', 'value': '3'}, {'key': 'b', 'value': '2'}])
+            response = self.app.get('/api/data/keys?cursor=' + data['next_cursor'])
+            self.assertEqual(response.get_json()['data']['keys'], ['c'])
+            response = self.app.get('/api/data/export')
+            self.assertEqual(response.data.count(b'\n'), 3)
+            print(f"test_{name}_batch_and_scan_passed")
+
+            # Tests a failing batch leaves the stored data untouched
+            def fail(values):
+                values['a'] = 'lost'
+                raise RuntimeError("batch failed")
+            with self.assertRaises(RuntimeError):
+                data_storage.apply('1', {'a'}, fail)
+            self.assertEqual(data_storage.get('1', 'a'), '3')
+            print(f"test_{name}_atomic_apply_passed")
+        finally:
+            app_module.data_storage = storage
+
+
+    def test_19_memory_storage_scenarios(self):
+        """Test the data routes on the in-memory storage and its snapshots"""
+
+        self._check_storage_routes(MemoryStorage(shards=4), "memory")
+
+        # Tests snapshots survive a restart
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'snapshot.json')
+            memory = MemoryStorage(shards=4, snapshot_path=path, snapshot_interval=0)
+            memory.put_many('1', [('x', '1'), ('y', '2'), ('x', '3')])
+            memory.put('2', 'z', '3')
+            memory.close()
+
+            restored = MemoryStorage(shards=2, snapshot_path=path, snapshot_interval=0)
+            self.assertEqual(restored.scan('1', with_values=True), [('x', '1'), ('y', '2')])
+            self.assertEqual(restored.get('2', 'z'), '3')
+            restored.close()
+        print("test_memory_snapshot_passed")
+
+    def test_20_log_storage_scenarios(self):
+        """Test the data routes on the log-structured storage, recovery and compaction"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            log = LogStorage(directory, compact_interval=0)
+            self._check_storage_routes(log, "log")
+            log.close()
+
+            # Tests the index is rebuilt from the segments on restart
+            log = LogStorage(directory, compact_interval=0)
+            self.assertEqual(log.scan('1', with_values=True), [('a', '3'), ('b', '2'), ('c', '4')])
+            print("test_log_recovery_passed")
+
+            # Tests a torn write at the end of the log is dropped along with its whole transaction
+            log.apply('1', {'d', 'e'}, lambda values: values.update(d='5', e='6'))
+            segment = os.path.join(directory, sorted(os.listdir(directory))[-1])
+            log.close()
+            with open(segment, 'r+b') as segment_file:
+                segment_file.truncate(os.path.getsize(segment) - 1)
+            log = LogStorage(directory, compact_interval=0)
+            self.assertIsNone(log.get('1', 'd'))
+            self.assertIsNone(log.get('1', 'e'))
+            self.assertEqual(log.get('1', 'c'), '4')
+            self.assertTrue(log.put('1', 'd', 'after'))
+            print("test_log_torn_write_passed")
+
+            # Tests an append that fails part way is cut off, so later records are indexed where they are
+            fsync = os.fsync
+            def failing_fsync(fd):
+                raise OSError("disk full")
+            os.fsync = failing_fsync
+            try:
+                with self.assertRaises(OSError):
+                    log.put('1', 'lost', 'lost value')
+            finally:
+                os.fsync = fsync
+            self.assertIsNone(log.get('1', 'lost'))
+            self.assertTrue(log.put('1', 'kept', 'kept value'))
+            self.assertEqual(log.get('1', 'kept'), 'kept value')
+            log.close()
+            log = LogStorage(directory, compact_interval=0)
+            self.assertEqual(log.get('1', 'kept'), 'kept value')
+            self.assertIsNone(log.get('1', 'lost'))
+            self.assertTrue(log.delete('1', 'kept'))
+            print("test_log_failed_append_passed")
+
+            # Tests compaction reclaims overwritten and deleted records and keeps the live ones
+            for index in range(50):
+                log.update('1', 'a', f'value{index}')
+            log.delete('1', 'b')
+            size_before = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+            self.assertGreater(log.compact(), 0)
+            size_after = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+            self.assertLess(size_after, size_before)
+            log.put('1', 'f', 'new')
+            log.close()
+
+            log = LogStorage(directory, compact_interval=0)
+            self.assertEqual(log.scan('1', with_values=True),
+                             [('a', 'value49'), ('c', '4'), ('d', 'after'), ('f', 'new')])
+            log.close()
+            print("test_log_compaction_passed")
+
+    def test_21_sharded_storage_scenarios(self):
+        """Test the data routes on sharded SQLite files and moving a user between shards"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            urls = [f"sqlite:///{os.path.join(directory, f'shard{index}.sqlite3')}" for index in range(3)]
+            sharded = ShardedStorage(Data, urls, app_module._user_shard)
+            self._check_storage_routes(sharded, "sharded")
+
+            # Tests the rows are only in the user's default shard
+            source = default_shard('1', 3)
+            counts = []
+            for index in range(3):
+                with sqlite3.connect(os.path.join(directory, f'shard{index}.sqlite3')) as connection:
+                    counts.append(connection.execute("SELECT COUNT(*) FROM data WHERE user_id = 1").fetchone()[0])
+            self.assertEqual(counts[source], 3)
+            self.assertEqual(sum(counts), 3)
+            self.assertIsNone(Data.query.filter_by(user_id=1).first())
+            print("test_shard_routing_passed")
+
+            # Tests writes are refused while the user is being moved
+            storage = app_module.data_storage
+            app_module.data_storage = sharded
+            try:
+                app_module._set_user_shard(1, source, True)
+                response = self.app.post('/api/data', data={'key': 'blocked', 'value': 'value'})
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(json.loads(response.data)['code'], 'SERVICE_BUSY')
+                response = self.app.get('/api/data/retrieve?key=a')
+                self.assertIn(b'Data retrieved successfully!', response.data)
+                app_module._set_user_shard(1, source, False)
+                print("test_shard_move_blocks_writes_passed")
+
+                # Tests a move copies the data, switches the route and clears the old shard
+                target = (source + 1) % 3
+                copied = sharded.move_user(1, target, app_module._set_user_shard, grace=0, batch_size=2,
+                                           log=lambda message: None)
+                self.assertEqual(copied, 3)
+                self.assertEqual(sharded.locate(1), (target, False))
+                self.assertEqual(sharded.shards[source].scan(1), [])
+                response = self.app.get('/api/data/keys?values=1')
+                self.assertEqual(response.get_json()['data']['keys'],
+                                 [{'key': 'a', 'value': '3'}, {'key': 'b', 'value': '2'}, {'key': 'c', 'value': '4'}])
+                response = self.app.post('/api/data', data={'key': 'after_move', 'value': 'value'})
+                self.assertIn(b'Data stored successfully.', response.data)
+                self.assertEqual(sharded.shards[target].get(1, 'after_move'), 'value')
+                print("test_shard_move_passed")
+            finally:
+                app_module.data_storage = storage
+                sharded.close()
+
+    def test_22_group_commit_scenarios(self):
+        """Test concurrent writes are committed together and a failing write is isolated"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'group.sqlite3')
+            Data.__table__.create(create_engine(f"sqlite:///{path}"))
+            groups = []
+            wal = WALDatabase(path, group_commit_window_ms=50, group_commit_max_ops=64,
+                              on_group_commit=lambda size, seconds: groups.append(size))
+            storage = SqlAlchemyStorage(Data, wal.write, wal.read_session)
+
+            def failing_write(session):
+                session.add(Data(user_id=1, key='poison', value='value'))
+                session.flush()
+                raise ValueError("write failed")
+
+            # Tests concurrent writes share a commit and a failure only affects its own write
+            results = {}
+            def write(index):
+                try:
+                    if index == 5:
+                        results[index] = wal.write(failing_write)
+                    else:
+                        results[index] = storage.put(1, f'key{index}', 'value')
+                except ValueError as e:
+                    results[index] = e
+
+            threads = [threading.Thread(target=write, args=(index,)) for index in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertIsInstance(results.pop(5), ValueError)
+            self.assertEqual(set(results.values()), {True})
+            self.assertEqual(len(storage.scan(1)), 19)
+            self.assertIsNone(storage.get(1, 'poison'))
+            self.assertLess(len(groups), 20)
+            self.assertEqual(sum(groups), 20)
+            print("test_group_commit_batches_passed")
+
+            # Tests writes that return early or roll back inside a group behave as on their own
+            self.assertFalse(storage.put(1, 'key0', 'again'))
+            self.assertTrue(storage.update(1, 'key0', 'changed'))
+            def failing_batch(values):
+                del values['key1']
+                raise RuntimeError("batch failed")
+            with self.assertRaises(RuntimeError):
+                storage.apply(1, {'key1'}, failing_batch)
+            self.assertEqual(storage.get(1, 'key0'), 'changed')
+            self.assertEqual(storage.get(1, 'key1'), 'value')
+            wal.close()
+            print("test_group_commit_isolation_passed")
+
+            # Tests a write that finds the writer's queue full is answered with 503 instead of 500
+            with app.app_context():
+                access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+            with self.app.session_transaction() as sess:
+                sess['user_id'] = 1
+                sess['username'] = 'testuser'
+                sess['access_token'] = access_token
+
+            wal = WALDatabase(path, queue_size=1, busy_timeout_ms=50)
+            release = threading.Event()
+            blocked = threading.Event()
+            def blocking_write(session):
+                blocked.set()
+                release.wait()
+            writers = [threading.Thread(target=wal.write, args=(blocking_write,))]
+            writers[0].start()
+            blocked.wait()
+            writers.append(threading.Thread(target=wal.write, args=(lambda session: None,)))
+            writers[1].start()
+            while wal._queue.qsize() < 1:
+                time.sleep(0.01)
+
+            wal_mode, wal_database = app.config['SQLITE_WAL_MODE'], app_module.wal_database
+            app.config['SQLITE_WAL_MODE'], app_module.wal_database = True, wal
+            try:
+                response = self.app.post('/api/data', data={'key': 'queued', 'value': 'value'})
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response.get_json()['code'], 'SERVICE_BUSY')
+                self.assertIn('Retry-After', response.headers)
+            finally:
+                app.config['SQLITE_WAL_MODE'], app_module.wal_database = wal_mode, wal_database
+                release.set()
+                for writer in writers:
+                    writer.join()
+                wal.close()
+            print("test_full_write_queue_busy_passed")
+
+    def test_23_admission_control_scenarios(self):
+        """Test per-user rate limits and shedding of auth and write requests under load"""
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        controller = app_module.admission_controller
+        config = {name: app.config[name] for name in
+                  ('ADMISSION_USER_RATE', 'ADMISSION_USER_BURST', 'ADMISSION_MAX_IN_FLIGHT')}
+        try:
+            # Tests a user past their burst is rate limited with a Retry-After
+            app.config['ADMISSION_USER_RATE'] = 1
+            app.config['ADMISSION_USER_BURST'] = 3
+            statuses = [self.app.get('/api/data/keys').status_code for _ in range(4)]
+            self.assertNotIn(429, statuses[:3])
+            response = self.app.get('/api/data/keys')
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.get_json()['code'], 'RATE_LIMITED')
+            self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+            self.assertEqual(self.app.get('/metrics').status_code, 200)
+            print("test_user_rate_limit_passed")
+
+            # Tests logged out clients at one address do not share a bucket for logout and login
+            with self.app.session_transaction() as sess:
+                sess.clear()
+            controller._buckets.clear()
+            statuses = [self.app.get('/api/logout').status_code for _ in range(5)]
+            self.assertNotIn(429, statuses)
+            statuses = [self.app.post('/api/token', data={'username': f'nobody{index}', 'password': 'x'}).status_code
+                        for index in range(4)]
+            self.assertNotIn(429, statuses)
+            statuses = [self.app.post('/api/token', data={'username': 'nobody', 'password': 'x'}).status_code
+                        for _ in range(4)]
+            self.assertEqual(statuses[-1], 429)
+            print("test_logged_out_rate_limit_passed")
+            with self.app.session_transaction() as sess:
+                sess['user_id'] = 1
+                sess['username'] = 'testuser'
+                sess['access_token'] = access_token
+            controller._buckets.clear()
+            app.config['ADMISSION_USER_RATE'] = config['ADMISSION_USER_RATE']
+            app.config['ADMISSION_USER_BURST'] = config['ADMISSION_USER_BURST']
+            time.sleep(0.1)
+
+            # Tests slow reads and writes shed auth first, then writes, but never reads
+            # A single slow request after a quiet spell is not enough to shed anything
+            controller._latency_updated = 0.0
+            controller.in_flight += 1
+            controller.leave(1.0, True, 1.0)
+            response = self.app.post('/api/data', data={'key': 'shed_key', 'value': 'value'})
+            self.assertEqual(response.status_code, 200)
+            controller.latency = 1.0
+            controller._latency_samples = app.config['ADMISSION_MIN_SAMPLES']
+            controller._latency_updated = time.monotonic()
+            response = self.app.post('/api/login', data={'username': 'testuser', 'password': 'Test@123'})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.get_json()['code'], 'SERVICE_BUSY')
+            self.assertIn('Retry-After', response.headers)
+            response = self.app.post('/api/data/update', data={'key': 'shed_key', 'value': 'value'})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(self.app.get('/api/data/keys').status_code, 200)
+            print("test_latency_shedding_passed")
+
+            # Tests auth only gets its share of the in-flight slots
+            controller._latency_updated = 0.0
+            app.config['ADMISSION_MAX_IN_FLIGHT'] = 4
+            controller.in_flight = 1
+            response = self.app.post('/api/token', data={'username': 'testuser', 'password': 'Test@123'})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(self.app.get('/api/data/keys').status_code, 200)
+            self.assertEqual(controller.in_flight, 1)
+            print("test_class_share_shedding_passed")
+
+            # Tests streamed responses take a slot but leave the latency average alone
+            app.config['ADMISSION_MAX_IN_FLIGHT'] = config['ADMISSION_MAX_IN_FLIGHT']
+            controller.in_flight = 0
+            controller._buckets.clear()
+            controller._latency_updated = 0.0
+            response = self.app.get('/api/data/export')
+            self.assertEqual(response.status_code, 200)
+            response.get_data()
+            self.assertEqual(controller._latency_updated, 0.0)
+            self.assertEqual(controller.in_flight, 0)
+            response = self.app.post('/api/data/import', data='{"key": "imported_key", "value": "value"}\n',
+                                     headers={'Content-Type': 'application/x-ndjson'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(controller._latency_updated, 0.0)
+            response = self.app.put('/api/data/blob?key=admission_blob', data=b'blob')
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(controller._latency_updated, 0.0)
+            self.app.get('/api/data/keys')
+            self.assertGreater(controller._latency_updated, 0.0)
+            print("test_streams_not_in_latency_passed")
+        finally:
+            controller.in_flight = 0
+            controller.latency = 0.0
+            controller._latency_samples = 0
+            controller._buckets.clear()
+            app.config.update(config)
+
+    def test_24_large_value_scenarios(self):
+        """Test streamed uploads are chunked and downloads honour Range"""
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        blob_store = app_module.blob_store
+        chunk_size = blob_store.chunk_size
+        max_bytes = app.config['BLOB_MAX_BYTES']
+        value = bytes(range(23))
+        try:
+            # Tests an upload is stored in fixed-size chunks and downloaded whole
+            blob_store.chunk_size = 5
+            response = self.app.put('/api/data/blob?key=document', data=value)
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.get_json()['data']['size'], 23)
+            etag = response.headers['ETag']
+            self.assertEqual(db.session.query(app_module.DataBlobChunk).count(), 5)
+
+            response = self.app.get('/api/data/blob?key=document')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, value)
+            self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+            self.assertEqual(response.headers['ETag'], etag)
+            print("test_chunked_upload_passed")
+
+            # Tests byte ranges across chunk boundaries, suffix ranges and unsatisfiable ranges
+            response = self.app.get('/api/data/blob?key=document', headers={'Range': 'bytes=3-11'})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.data, value[3:12])
+            self.assertEqual(response.headers['Content-Range'], 'bytes 3-11/23')
+            response = self.app.get('/api/data/blob?key=document', headers={'Range': 'bytes=-4'})
+            self.assertEqual(response.data, value[-4:])
+            response = self.app.get('/api/data/blob?key=document', headers={'Range': 'bytes=100-'})
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response.headers['Content-Range'], 'bytes */23')
+            response = self.app.get('/api/data/blob?key=document',
+                                    headers={'Range': 'bytes=0-1', 'If-Range': '"stale"'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, value)
+            response = self.app.get('/api/data/blob?key=document',
+                                    headers={'Range': 'bytes=0-1', 'If-Range': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, value)
+            response = self.app.get('/api/data/blob?key=document', headers={'Range': 'bytes=0-1', 'If-Range': etag})
+            self.assertEqual(response.status_code, 206)
+            response = self.app.get('/api/data/blob?key=document', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            print("test_range_download_passed")
+
+            # Tests a new upload replaces the value and an oversized one leaves nothing behind
+            response = self.app.put('/api/data/blob?key=document', data=b'replaced')
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(self.app.get('/api/data/blob?key=document').data, b'replaced')
+            app.config['BLOB_MAX_BYTES'] = 10
+            response = self.app.put('/api/data/blob?key=document', data=value)
+            self.assertEqual(response.status_code, 413)
+            with self.assertRaises(BlobTooLarge):
+                blob_store.write(1, 'document', io.BytesIO(value), max_bytes=10)
+            self.assertEqual(db.session.query(app_module.DataBlob).count(), 1)
+            self.assertEqual(db.session.query(app_module.DataBlobChunk).count(), 2)
+            self.assertEqual(self.app.get('/api/data/blob?key=document').data, b'replaced')
+
+            response = self.app.delete('/api/data/blob?key=document')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.app.get('/api/data/blob?key=document').status_code, 404)
+            self.assertEqual(self.app.delete('/api/data/blob?key=document').status_code, 404)
+            self.assertEqual(db.session.query(app_module.DataBlobChunk).count(), 0)
+            print("test_blob_replace_and_delete_passed")
+
+            # Tests a download fails instead of ending short when the blob is replaced part way through
+            blob_store.write(1, 'document', io.BytesIO(value))
+            chunks = blob_store.read(blob_store.stat(1, 'document'))
+            self.assertEqual(next(chunks), value[:5])
+            blob_store.write(1, 'document', io.BytesIO(b'replaced'))
+            with self.assertRaises(BlobChanged):
+                list(chunks)
+            print("test_blob_replaced_during_download_passed")
+
+            # Tests stalled uploads are cleaned up, and one that carries on afterwards is refused
+            blob_id = blob_store.run_write(blob_store._create, 1, 'stalled')
+            blob_store.run_write(blob_store._write_chunk, blob_id, 0, b'part')
+            self.assertEqual(blob_store.sweep_incomplete(time.time(), 10), 0)
+            self.assertEqual(blob_store.sweep_incomplete(time.time() + blob_store.incomplete_timeout + 1, 10), 1)
+            self.assertEqual(db.session.query(app_module.DataBlob).filter_by(key='stalled').count(), 0)
+            self.assertEqual(db.session.query(app_module.DataBlobChunk).filter_by(blob_id=blob_id).count(), 0)
+            with self.assertRaises(BlobAbandoned):
+                blob_store.run_write(blob_store._write_chunk, blob_id, 1, b'more')
+            with self.assertRaises(BlobAbandoned):
+                blob_store.run_write(blob_store._complete, blob_id, 1, 'document', 4, 'etag')
+            self.assertEqual(self.app.get('/api/data/blob?key=document').data, b'replaced')
+            print("test_stalled_upload_cleanup_passed")
+        finally:
+            blob_store.chunk_size = chunk_size
+            app.config['BLOB_MAX_BYTES'] = max_bytes
+
+    def test_25_compression_scenarios(self):
+        """Test compressed rows read back unchanged and recompress-data trains dictionaries"""
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        value_codec = app_module.value_codec
+        document = json.dumps({"type": "event", "status": "active", "tags": ["alpha", "beta"] * 10})
+        try:
+            # Tests values are compressed when stored and decoded on every read path
+            self.app.post('/api/data', data={'key': 'plain', 'value': document})
+            value_codec.mode = 'zlib'
+            self.app.post('/api/data', data={'key': 'zipped', 'value': document})
+            self.app.post('/api/data', data={'key': 'short', 'value': 'tiny'})
+            rows = {row.key: row for row in Data.query.all()}
+            self.assertEqual(rows['plain'].codec, 0)
+            self.assertEqual(rows['zipped'].codec, 1)
+            self.assertEqual(rows['zipped'].value, '')
+            self.assertLess(len(rows['zipped'].packed), len(document))
+            self.assertEqual(rows['short'].codec, 0)
+
+            response = self.app.get('/api/data/retrieve?key=zipped', headers={'Accept': 'application/json'})
+            self.assertEqual(response.get_json()['data']['value'], document)
+            response = self.app.post('/api/data/update', data={'key': 'zipped', 'value': document + ' '},
+                                     headers={'If-Match': response.headers['ETag']})
+            self.assertEqual(response.status_code, 200)
+            export = [json.loads(line) for line in self.app.get('/api/data/export').data.splitlines()]
+            self.assertEqual({record['key']: record['value'] for record in export},
+                             {'plain': document, 'short': 'tiny', 'zipped': document + ' '})
+            print("test_transparent_compression_passed")
+
+            # Tests recompress-data trains a dictionary, compresses small values and reports the saving
+            value_codec.mode = 'dictionary'
+            value_codec.min_bytes = 8
+            for index in range(20):
+                self.app.post('/api/data', data={'key': f'event{index}',
+                                                 'value': json.dumps({"type": "event", "id": index})})
+            result = app.test_cli_runner().invoke(args=['recompress-data', '--batch-size', '7'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('Recompressed 23 rows', result.output)
+            self.assertIn('bytes saved', result.output)
+            db.session.expire_all()
+            codecs = {row.key: row.codec for row in Data.query.all()}
+            self.assertEqual(codecs['event3'], 2)
+            self.assertEqual(codecs['plain'], 2)
+            self.assertEqual(app_module.CompressionDictionary.query.count(), 1)
+            response = self.app.get('/api/data/retrieve?key=event3', headers={'Accept': 'application/json'})
+            self.assertEqual(response.get_json()['data']['value'], json.dumps({"type": "event", "id": 3}))
+
+            # Tests rows stay readable once compression is turned off, and decompression is measured
+            value_codec.mode = 'none'
+            value_codec._dictionaries.clear()
+            response = self.app.get('/api/data/retrieve?key=plain', headers={'Accept': 'application/json'})
+            self.assertEqual(response.get_json()['data']['value'], document)
+            metrics = self.app.get('/metrics').data.decode('utf-8')
+            self.assertIn('dpd_value_decompress_seconds_count{codec="dictionary"}', metrics)
+            print("test_dictionary_recompression_passed")
+        finally:
+            value_codec.mode = app.config['DATA_COMPRESSION']
+            value_codec.min_bytes = app.config['DATA_COMPRESSION_MIN_BYTES']
+            value_codec._dictionaries.clear()
+            value_codec._latest.clear()
+
+    def test_26_key_expiry_scenarios(self):
+        """Test keys stored with a ttl expire, are swept in batches and are reported in metrics"""
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        # Tests the ttl is validated and stored as an expiry time
+        response = self.app.post('/api/data', data={'key': 'bad', 'value': 'v', 'ttl': '-5'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['code'], 'INVALID_TTL')
+        response = self.app.post('/api/data', data={'key': 'session', 'value': 'v', 'ttl': '60'})
+        self.assertIn(b'Data stored successfully.', response.data)
+        self.app.post('/api/data', data={'key': 'forever', 'value': 'v'})
+        expires_at = Data.query.filter_by(key='session').one().expires_at
+        self.assertAlmostEqual(expires_at, time.time() + 60, delta=5)
+        self.assertIsNone(Data.query.filter_by(key='forever').one().expires_at)
+        response = self.app.post('/api/data/update', data={'key': 'session', 'value': 'w'})
+        self.assertEqual(Data.query.filter_by(key='session').one().expires_at, expires_at)
+        print("test_ttl_store_passed")
+
+        # Tests an expired key reads as missing before the sweeper has deleted it, and can be stored again
+        for index in range(12):
+            self.app.post('/api/data', data={'key': f'temp{index}', 'value': 'v', 'ttl': '60'})
+        Data.query.filter(Data.expires_at.isnot(None)).update({'expires_at': time.time() - 10})
+        db.session.commit()
+        response = self.app.get('/api/data/retrieve?key=session', headers={'Accept': 'application/json'})
+        self.assertEqual(response.get_json()['code'], 'KEY_NOT_FOUND')
+        response = self.app.post('/api/data/update', data={'key': 'session', 'value': 'x'})
+        self.assertIn(b'The provided key does not exist in the database.', response.data)
+        response = self.app.get('/api/data/keys', headers={'Accept': 'application/json'})
+        self.assertEqual(response.get_json()['data']['keys'], ['forever'])
+        response = self.app.post('/api/data', data={'key': 'temp0', 'value': 'again'})
+        self.assertIn(b'Data stored successfully.', response.data)
+        print("test_expired_key_hidden_passed")
+
+        # Tests the sweeper deletes expired rows in bounded batches and reports its progress
+        sweeper = app_module.expiry_sweeper
+        batches = []
+        sweep = sweeper.sweep
+        sweeper.sweep = lambda now, limit: batches.append(sweep(now, limit)) or batches[-1]
+        sweeper.batch_size = 5
+        try:
+            self.assertEqual(sweeper.run_once(), 12)
+        finally:
+            sweeper.sweep = sweep
+            sweeper.batch_size = app.config['EXPIRY_SWEEP_BATCH_SIZE']
+        self.assertEqual(batches, [5, 5, 2])
+        db.session.expire_all()
+        self.assertEqual(sorted(row.key for row in Data.query.all()), ['forever', 'temp0'])
+        metrics = self.app.get('/metrics').data.decode('utf-8')
+        self.assertIn('dpd_expiry_swept_total', metrics)
+        self.assertIn('dpd_expiry_backlog 0.0', metrics)
+        print("test_expiry_sweep_passed")
+
+        # Tests the other storages expire and sweep keys too, and the log keeps expiries across restarts
+        with tempfile.TemporaryDirectory() as directory:
+            for storage in (MemoryStorage(shards=2), LogStorage(directory, compact_interval=0)):
+                storage.put('1', 'gone', 'v', expires_at=time.time() - 1)
+                storage.put('1', 'later', 'v', expires_at=time.time() + 60)
+                storage.put('1', 'kept', 'v')
+                self.assertIsNone(storage.get('1', 'gone'))
+                self.assertEqual([key for key, _ in storage.scan('1')], ['kept', 'later'])
+                self.assertEqual(storage.expiry_backlog(time.time())[0], 1)
+                self.assertEqual(storage.sweep(time.time(), 10), 1)
+                self.assertEqual(storage.expiry_backlog(time.time()), (0, None))
+                storage.close()
+            log = LogStorage(directory, compact_interval=0)
+            self.assertEqual(log.sweep(time.time() + 120, 10), 1)
+            self.assertEqual([key for key, _ in log.scan('1')], ['kept'])
+            log.close()
+        print("test_storage_expiry_passed")
+
+        # Tests a page is filled past expired keys and the backlog skips stale heap entries
+        with tempfile.TemporaryDirectory() as directory:
+            for storage in (MemoryStorage(shards=2), LogStorage(directory, compact_interval=0)):
+                for index in range(6):
+                    expires_at = time.time() - 1 if index % 2 else time.time() + 60
+                    storage.put('1', f'k{index}', 'v', expires_at=expires_at)
+                self.assertEqual([key for key, _ in storage.scan('1', limit=2)], ['k0', 'k2'])
+                self.assertEqual([key for key, _ in storage.scan('1', after='k2', limit=2)], ['k4'])
+                self.assertEqual([key for key, _ in storage.scan('1', prefix='k', limit=5)], ['k0', 'k2', 'k4'])
+                storage.put('1', 'k1', 'v', expires_at=time.time() + 60)
+                storage.delete('1', 'k3')
+                count, oldest = storage.expiry_backlog(time.time())
+                self.assertEqual(count, 1)
+                self.assertLess(oldest, time.time())
+                storage.close()
+        print("test_scan_skips_expired_keys_passed")
+
+
+    def test_27_increment_and_compare_and_swap_scenarios(self):
+        """Test atomic increments and version checked compare-and-swap updates"""
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        # Tests increments and decrements return the new value and version
+        self.app.post('/api/data', data={'key': 'counter', 'value': '10'})
+        response = self.app.post('/api/data/increment', data={'key': 'counter', 'delta': '5'})
+        self.assertEqual(response.get_json()['data'], {'key': 'counter', 'value': 15, 'version': 2})
+        response = self.app.post('/api/data/increment', data={'key': 'counter', 'delta': '-20'})
+        self.assertEqual(response.get_json()['data']['value'], -5)
+        response = self.app.post('/api/data/increment', data={'key': 'counter'})
+        self.assertEqual(response.get_json()['data'], {'key': 'counter', 'value': -4, 'version': 4})
+        self.assertEqual(Data.query.filter_by(key='counter').one().value, '-4')
+        print("test_increment_passed")
+
+        # Tests increments are refused for missing keys, bad deltas and values that are not integers
+        response = self.app.post('/api/data/increment', data={'key': 'missing'})
+        self.assertEqual(response.status_code, 404)
+        response = self.app.post('/api/data/increment', data={'key': 'counter', 'delta': '1.5'})
+        self.assertEqual(response.get_json()['code'], 'INVALID_DELTA')
+        self.app.post('/api/data', data={'key': 'text', 'value': '007'})
+        response = self.app.post('/api/data/increment', data={'key': 'text'})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()['code'], 'VALUE_NOT_INTEGER')
+        self.app.post('/api/data', data={'key': 'big', 'value': str(2 ** 63 - 1)})
+        response = self.app.post('/api/data/increment', data={'key': 'big'})
+        self.assertEqual(response.get_json()['code'], 'VALUE_NOT_INTEGER')
+        print("test_increment_errors_passed")
+
+        # Tests concurrent increments are never lost
+        def increment():
+            with app.app_context():
+                for _ in range(10):
+                    app_module.data_storage.increment('1', 'counter', 1)
+        threads = [threading.Thread(target=increment) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        db.session.expire_all()
+        self.assertEqual(Data.query.filter_by(key='counter').one().value, '76')
+        print("test_concurrent_increment_passed")
+
+        # Tests compare-and-swap only replaces the value at the expected version
+        self.app.post('/api/data', data={'key': 'lock', 'value': 'free'})
+        response = self.app.get('/api/data/retrieve?key=lock', headers={'Accept': 'application/json'})
+        self.assertEqual(response.get_json()['data']['version'], 1)
+        response = self.app.post('/api/data/cas', data={'key': 'lock', 'value': 'held', 'version': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['data']['version'], 2)
+        response = self.app.post('/api/data/cas', data={'key': 'lock', 'value': 'stolen', 'version': '1'})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()['code'], 'VERSION_CONFLICT')
+        self.assertEqual(response.get_json()['data']['version'], 2)
+        self.app.post('/api/data/update', data={'key': 'lock', 'value': 'free'})
+        response = self.app.get('/api/data/retrieve?key=lock', headers={'Accept': 'application/json'})
+        self.assertEqual(response.get_json()['data'], {'key': 'lock', 'value': 'free', 'version': 3})
+        response = self.app.post('/api/data/cas', data={'key': 'none', 'value': 'v', 'version': '1'})
+        self.assertEqual(response.status_code, 404)
+        response = self.app.post('/api/data/cas', data={'key': 'lock', 'value': 'v', 'version': 'x'})
+        self.assertEqual(response.get_json()['code'], 'INVALID_VERSION')
+        print("test_compare_and_swap_passed")
+
+        # Tests the other storages keep versions, and the log and snapshots keep them across restarts
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot_path = os.path.join(directory, 'snapshot.json')
+            log_path = os.path.join(directory, 'log')
+            for reopen in (lambda: MemoryStorage(shards=2, snapshot_path=snapshot_path, snapshot_interval=0),
+                           lambda: LogStorage(log_path, compact_interval=0)):
+                storage = reopen()
+                storage.put('1', 'n', '1')
+                self.assertEqual(storage.increment('1', 'n', 2), (3, 2))
+                self.assertIsNone(storage.increment('1', 'missing', 1))
+                self.assertEqual(storage.compare_and_swap('1', 'n', '10', 2), 3)
+                with self.assertRaises(app_module.VersionConflict):
+                    storage.compare_and_swap('1', 'n', '11', 2)
+                storage.close()
+                storage = reopen()
+                self.assertEqual(storage.get('1', 'n', with_meta=True), ('10', None, 3))
+                storage.close()
+        print("test_storage_versions_passed")
+
+        # Tests a key deleted and stored again in one batch starts over at version 1 without its expiry
+        self.app.post('/api/data', data={'key': 'reborn', 'value': 'same', 'ttl': '60'})
+        self.app.post('/api/data/cas', data={'key': 'reborn', 'value': 'same', 'version': '1'})
+        response = self.app.post('/api/data/batch', json={'operations': [
+            {'op': 'delete', 'key': 'reborn'},
+            {'op': 'store', 'key': 'reborn', 'value': 'same'},
+            {'op': 'store', 'key': 'fresh', 'value': 'v'},
+            {'op': 'delete', 'key': 'fresh'},
+            {'op': 'store', 'key': 'fresh', 'value': 'v'}
+        ]})
+        self.assertEqual([result['status'] for result in response.get_json()['data']['results']], ['success'] * 5)
+        db.session.expire_all()
+        for key in ('reborn', 'fresh'):
+            row = Data.query.filter_by(key=key).one()
+            self.assertEqual((row.value, row.version, row.expires_at), ('same' if key == 'reborn' else 'v', 1, None))
+
+        def delete_and_store(values):
+            del values['n']
+            values['n'] = '10'
+        with tempfile.TemporaryDirectory() as directory:
+            for storage in (MemoryStorage(shards=2), LogStorage(directory, compact_interval=0)):
+                storage.put('1', 'n', '10', expires_at=time.time() + 60)
+                storage.increment('1', 'n', 0)
+                storage.apply('1', {'n'}, delete_and_store)
+                self.assertEqual(storage.get('1', 'n', with_meta=True), ('10', None, 1))
+                storage.close()
+        print("test_batch_delete_then_store_version_passed")
+
+#########################################################
+#test for the change feed
+    def test_28_change_feed_watch_scenarios(self):
+        """Test the change log and watching keys with long polls and event streams"""
+
+        with app.app_context():
+            access_token = create_access_token(identity='1', expires_delta=timedelta(minutes=5))
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['username'] = 'testuser'
+            sess['access_token'] = access_token
+
+        # A fresh feed, as the sequence numbers start over with the tables
+        feed = ChangeFeed(app_module.DataChange, app_module._run_write, app_module._change_feed_session,
+                          retention=60, poll_interval=0.05)
+        original_feed = app_module.change_feed
+        app_module.change_feed = app_module.data_storage.change_log = feed
+        notifier = WatchNotifier(app, feed, host='127.0.0.1', port=0)
+        notifier.start()
+        notifier_url = f"http://127.0.0.1:{notifier.port}"
+        app.config['CHANGE_FEED_NOTIFIER_URL'] = notifier_url
+        cookies = {'session': self.app.get_cookie('session').value}
+        try:
+            # Tests every successful write is logged in order, and failed writes are not
+            self.app.post('/api/data', data={'key': 'user:a', 'value': 'one'})
+            self.app.post('/api/data', data={'key': 'user:a', 'value': 'again'})
+            self.app.post('/api/data/update', data={'key': 'user:a', 'value': 'two'})
+            self.app.post('/api/data/delete', data={'key': 'user:a'})
+            self.app.post('/api/data/batch', json={'operations': [
+                {'op': 'store', 'key': 'user:b', 'value': 'three'},
+                {'op': 'update', 'key': 'missing', 'value': 'x'},
+                {'op': 'store', 'key': 'other', 'value': 'four'}
+            ]})
+            self.app.post('/api/data/update', data={'key': 'other', 'value': 'x'}, headers={'If-Match': '"stale"'})
+            response = self.app.get('/api/data/watch?since=0&timeout=0')
+            self.assertEqual(response.status_code, 200)
+            changes = response.get_json()['data']['changes']
+            self.assertEqual([(change['key'], change['op'], change['value']) for change in changes], [
+                ('user:a', 'store', 'one'), ('user:a', 'update', 'two'), ('user:a', 'delete', None),
+                ('user:b', 'store', 'three'), ('other', 'store', 'four')
+            ])
+            self.assertEqual(response.get_json()['data']['next'], changes[-1]['sequence'])
+            print("test_change_log_passed")
+
+            # Tests a write whose change cannot be logged is not committed either
+            add = feed.add
+            def failing_add(session, user_id, changes):
+                add(session, user_id, changes)
+                raise RuntimeError("log unavailable")
+            feed.add = failing_add
+            try:
+                response = self.app.post('/api/data', data={'key': 'unlogged', 'value': 'v'})
+                self.assertEqual(response.status_code, 500)
+            finally:
+                feed.add = add
+            db.session.remove()
+            self.assertIsNone(Data.query.filter_by(user_id=1, key='unlogged').first())
+            self.assertEqual(app_module.DataChange.query.filter_by(key='unlogged').count(), 0)
+            print("test_change_log_atomic_passed")
+
+            # Tests watching one key, or the keys under a prefix
+            response = self.app.get('/api/data/watch?since=0&timeout=0&key=user:a')
+            self.assertEqual([change['op'] for change in response.get_json()['data']['changes']],
+                             ['store', 'update', 'delete'])
+            response = self.app.get('/api/data/watch?since=0&timeout=0&prefix=user:')
+            self.assertEqual([change['key'] for change in response.get_json()['data']['changes']],
+                             ['user:a', 'user:a', 'user:a', 'user:b'])
+            response = self.app.get('/api/data/watch?since=abc')
+            self.assertEqual(response.get_json()['code'], 'INVALID_SEQUENCE')
+            print("test_watch_filters_passed")
+
+            # Tests a long poll returns as soon as a change is made, without since from now on
+            head = feed.head()
+            response = self.app.get('/api/data/watch?timeout=0')
+            self.assertEqual(response.get_json()['data'], {'changes': [], 'next': head})
+            def store_later():
+                time.sleep(0.2)
+                with app.app_context():
+                    app_module.data_storage.put('1', 'user:c', 'five')
+            response = self.app.get(f'/api/data/watch?since={head}&timeout=10&prefix=user:')
+            self.assertEqual(response.status_code, 307)
+            self.assertEqual(response.headers['Location'],
+                             f"{notifier_url}/api/data/watch?since={head}&timeout=10&prefix=user:")
+            thread = threading.Thread(target=store_later)
+            thread.start()
+            started = time.monotonic()
+            response = requests.get(response.headers['Location'], cookies=cookies, timeout=15)
+            thread.join()
+            self.assertLess(time.monotonic() - started, 5)
+            self.assertEqual([change['key'] for change in response.json()['data']['changes']], ['user:c'])
+            self.assertEqual(feed._watchers, 0)
+            print("test_long_poll_passed")
+
+            # Tests waiting watchers hold no thread each, and one change wakes all of them
+            head = feed.head()
+            threads = threading.active_count()
+            clients = []
+            for _ in range(20):
+                client = socket.create_connection(('127.0.0.1', notifier.port))
+                client.sendall(f"GET /api/data/watch?since={head}&timeout=10 HTTP/1.1\r\nHost: localhost\r\n"
+                               f"Cookie: session={cookies['session']}\r\n\r\n".encode())
+                clients.append(client)
+            deadline = time.monotonic() + 5
+            while feed._watchers < 20 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(feed._watchers, 20)
+            self.assertLessEqual(threading.active_count() - threads, notifier.threads + 1)
+            with app.app_context():
+                app_module.data_storage.put('1', 'user:e', 'seven')
+            for client in clients:
+                with client.makefile('rb') as reply:
+                    status = reply.readline()
+                    body = reply.read()
+                client.close()
+                self.assertIn(b" 200 ", status)
+                self.assertIn(b'"user:e"', body)
+            self.assertEqual(feed._watchers, 0)
+            print("test_watchers_without_threads_passed")
+
+            # Tests changes recorded by another process are picked up by the poller
+            head = feed.head()
+            database_path = db.engine.url.database
+            def store_elsewhere():
+                time.sleep(0.2)
+                connection = sqlite3.connect(database_path)
+                connection.execute("INSERT INTO data_change (user_id, key, op, value, created_at) "
+                                   "VALUES (1, 'user:d', 'store', 'six', ?)", (time.time(),))
+                connection.commit()
+                connection.close()
+            thread = threading.Thread(target=store_elsewhere)
+            thread.start()
+            response = requests.get(f'{notifier_url}/api/data/watch?since={head}&timeout=10', cookies=cookies,
+                                    timeout=15)
+            thread.join()
+            self.assertEqual([change['key'] for change in response.json()['data']['changes']], ['user:d'])
+            print("test_long_poll_other_process_passed")
+
+            # Tests an event stream sends changes after Last-Event-ID, then ends and gives its slot back
+            app.config['CHANGE_FEED_STREAM_SECONDS'] = 0.2
+            headers = {'Accept': 'text/event-stream', 'Last-Event-ID': str(changes[0]['sequence'])}
+            response = self.app.get('/api/data/watch?key=user:a', headers=headers)
+            self.assertEqual(response.status_code, 307)
+            response = requests.get(response.headers['Location'], headers=headers, cookies=cookies, timeout=15)
+            self.assertEqual(response.headers['Content-Type'].split(';')[0], 'text/event-stream')
+            body = response.text
+            events = [event for event in body.split("\n\n") if event.startswith("id: ")]
+            self.assertEqual([event.split("\n")[0] for event in events],
+                             [f"id: {change['sequence']}" for change in changes[1:3]])
+            self.assertEqual(json.loads(events[0].split("data: ")[1])['value'], 'two')
+            self.assertEqual(feed._watchers, 0)
+            print("test_event_stream_passed")
+
+            # Tests watchers past the cap are shed while waiting is still free of in-flight slots
+            feed.max_watchers = 0
+            response = requests.get(f'{notifier_url}/api/data/watch?since={feed.head()}&timeout=1', cookies=cookies,
+                                    timeout=15)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.json()['code'], 'SERVICE_BUSY')
+            self.assertEqual(requests.post(f'{notifier_url}/api/data/watch', timeout=15).status_code, 405)
+            feed.max_watchers = 1000
+            print("test_watch_limit_passed")
+
+            # Tests compaction keeps the newest change, and resuming from before it is refused
+            self.assertEqual(feed.compact(time.time(), 1000), 0)
+            total = app_module.DataChange.query.count()
+            self.assertEqual(feed.compact(time.time() + 120, 2), 2)
+            self.assertEqual(feed.compact(time.time() + 120, 1000), total - 3)
+            self.assertEqual(app_module.DataChange.query.count(), 1)
+            response = self.app.get('/api/data/watch?since=0&timeout=0')
+            self.assertEqual(response.status_code, 410)
+            self.assertEqual(response.get_json()['code'], 'CHANGES_EXPIRED')
+            response = self.app.get(f'/api/data/watch?since={feed.head() - 1}&timeout=0')
+            self.assertEqual(len(response.get_json()['data']['changes']), 1)
+            print("test_change_log_compaction_passed")
+        finally:
+            notifier.stop()
+            feed.stop()
+            app_module.change_feed = app_module.data_storage.change_log = original_feed
+            app.config['CHANGE_FEED_STREAM_SECONDS'] = 300
+            app.config['CHANGE_FEED_NOTIFIER_URL'] = None
+
 if __name__ == '__main__':
     test_suite = unittest.TestLoader().loadTestsFromTestCase(FlaskAppTests)
     test_result = unittest.TextTestRunner(verbosity=2).run(test_suite)
@@ -261,4 +2002,4 @@ if __name__ == '__main__':
     print(f"Number of tests run: {test_result.testsRun}")
     print(f"Number of tests passed: {test_result.testsRun - len(test_result.failures) - len(test_result.errors)}")
     print(f"Number of tests failed: {len(test_result.failures)}")
-    print(f"Number of test errors: {len(test_result.errors)}")
\ No newline at end of file
+    print(f"Number of test errors: {len(test_result.errors)}")